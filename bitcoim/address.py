@@ -1,14 +1,57 @@
 from addressable import Addressable
-from bitcoin.address import Address as BCAddress
+from bitcoin.address import Address as BCAddress, InvalidBitcoinAddressError
 from i18n import _, DISCO, DEFAULT, ROSTER
 from jid import JID
+from logging import debug
+from offload import renderPhoto
 from paymentorder import PaymentOrder
+from rpc import Controller
 from xmpp.protocol import Presence, NodeProcessed, NS_VCARD, NS_VERSION, \
                           NS_DISCO_INFO, NS_DISCO_ITEMS
 
 ENCODING_SEP = '-'
 ENCODING_BASE = 36 # Any value from 2 to 36 would work - smaller values produce longer suffixes
 
+def encodeNode(address):
+    '''Return the node of the JID of a bitcoin address. JIDs are case
+       insensitive, so the address is lowercased, and the positions of its
+       uppercase letters are given by a mask, appended as a suffix.'''
+    # 1DXFn72VHrXRVYJTTxjbmNXyXpYXmgiWfw
+    # 1dxfn72vhrxrvyjttxjbmnxyxpyxmgiwfw (lowercase)
+    # 1110  110111111100001101011000100 (mask on uppercase)
+    # -> mask in base36 (should return x0l0p0)
+    mask = long(0)
+    gaps = 0
+    for i, char in enumerate(reversed(address)):
+        if char.isupper():
+            mask += 2 ** (i - gaps)
+        elif char.isdigit():
+            gaps += 1
+    suffix = ""
+    while mask > 0:
+        suffix = "0123456789abcdefghijklmnopqrstuvwxyz"[mask % ENCODING_BASE] + suffix
+        mask //= ENCODING_BASE
+    if ("" != suffix):
+        suffix = ENCODING_SEP + suffix
+    return address.lower() + suffix
+
+def decodeNode(node):
+    '''Return the bitcoin address whose JID has the given node (see
+       encodeNode()).'''
+    parts = node.partition(ENCODING_SEP)
+    if not len(parts[2]):
+        return node
+    positions = int(parts[2], ENCODING_BASE)
+    address = ''
+    for c in reversed(parts[0]):
+        if c.isalpha():
+            if (positions % 2):
+                c = c.upper()
+            positions //= 2
+        address = c + address
+    return address
+
+
 class Address(Addressable, BCAddress):
     '''A Bitcoin address, but with some xmpp-specific capabilities. In particular, it has
        a 'jid' attribute that represents is encoding as a JID. Reciprocally, it's possible
@@ -16,63 +59,60 @@ class Address(Addressable, BCAddress):
     '''
 
     def __init__(self, address=None):
-        '''Constructor. Initialize a bitcoin address normally.
+        '''Constructor. Initialize a bitcoin address normally: a new one is
+           generated if none is given, otherwise it's validated.
            If the argument is a JID object, though, decode it first.
+           Unlike the bitcoin library, the controller is called through
+           rpc.Controller.
         '''
         self._jid = None
         self._owner = None
         if 'JID' == address.__class__.__name__:
             address.setResource('')
             self._jid = address
-            address = address.getNode()
-            parts = address.partition(ENCODING_SEP)
-            if len(parts[2]):
-                positions = int(parts[2], ENCODING_BASE)
-                address = ''
-                for c in reversed(parts[0]):
-                    if c.isalpha():
-                        if (positions % 2):
-                            c = c.upper()
-                        positions //= 2
-                    address = c + address
-        BCAddress.__init__(self, address)
+            address = decodeNode(address.getNode())
+        if address is None:
+            address = Controller().getnewaddress()
+        elif not Controller().validateaddress(address)['isvalid']:
+            raise InvalidBitcoinAddressError, address
+        self.address = address
+
+    @staticmethod
+    def assigned(address):
+        '''Return the Address for a string the wallet just gave out (e.g.
+           from the address pool), without having the controller validate
+           it again.'''
+        result = object.__new__(Address)
+        result._jid = None
+        result._owner = None
+        result.address = address
+        return result
 
     def __getattr__(self, name):
         if 'jid' == name:
             if self._jid is None: # Wait first call to compute it
-                # 1DXFn72VHrXRVYJTTxjbmNXyXpYXmgiWfw
-                # 1dxfn72vhrxrvyjttxjbmnxyxpyxmgiwfw (lowercase)
-                # 1110  110111111100001101011000100 (mask on uppercase)
-                # -> mask in base36 (should return x0l0p0)
-                mask = long(0)
-                gaps = 0
-                for i, char in enumerate(reversed(self.address)):
-                    if char.isupper():
-                        mask += 2 ** (i - gaps)
-                    elif char.isdigit():
-                        gaps += 1
-                suffix = ""
-                while mask > 0:
-                    suffix = "0123456789abcdefghijklmnopqrstuvwxyz"[mask % ENCODING_BASE] + suffix
-                    mask //= ENCODING_BASE
-                if ("" != suffix):
-                    suffix = ENCODING_SEP + suffix
-                self._jid = JID(node=self.address.lower() + suffix)
+                self._jid = JID(node=encodeNode(self.address))
             return self._jid
         elif 'owner' == name:
             if self._owner is None: # Wait first call to compute it
                 from useraccount import UserAccount
                 self._owner = UserAccount(JID(node=self.account))
             return self._owner
+        elif 'account' == name:
+            return Controller().getaccount(self.address)
         else:
             return BCAddress.__getattr__(self, name)
 
-    def getPercentageReceived(self):
+    def getPercentageReceived(self, received=None):
         '''Returns the percentage of bitcoins received on this address over the total received
-           by the same user. If nothing was received yet, return None.'''
-        total = self.owner.getTotalReceived()
+           by the same user. If nothing was received yet, return None.
+           `received` is the result of the owner's getReceivedByAddress(),
+           if it's already known.'''
+        if received is None:
+            received = self.owner.getReceivedByAddress()
+        total = sum(received.values())
         if 0 != total:
-            return self.getReceived() * 100 / total
+            return received.get(self.address, 0) * 100 / total
         else:
             return None
 
@@ -87,6 +127,10 @@ class Address(Addressable, BCAddress):
                 items.append({'jid': self.owner.getLocalJID(), 'name': _(DISCO, 'address_owner')})
             return items
 
+    def discoTemplate(self, user, what, node):
+        if ('info' == what) and (node is None):
+            return (('disco-address', node), {'name': self.address})
+
     def iqReceived(self, cnx, iq):
         queries = iq.getChildren() # there should be only one
         if 0 == len(queries):
@@ -94,21 +138,29 @@ class Address(Addressable, BCAddress):
         ns = queries[0].getNamespace()
         typ = iq.getType()
         if NS_VCARD == ns and ('get' == typ):
-            reply = iq.buildReply('result')
-            query = reply.getQuery()
-            query.addChild('FN', payload=[self.address])
-            #TODO: More generic URL generation
-            query.addChild('URL', payload=[_(DEFAULT, 'url_bitcoin_address').format(address=self.address)])
-            pic = self.qrCode(level='H', formt='PNG')
-            if pic is not None:
-                photo = query.addChild('PHOTO')
-                photo.addChild('TYPE', payload='image/png')
-                from base64 import b64encode
-                photo.addChild('BINVAL', payload=[b64encode(pic)])
-            cnx.send(reply)
+            if cnx.offloader is None:
+                cnx.send(self.vCard(iq, renderPhoto(self.address)))
+            elif not cnx.offloader.submit(renderPhoto, (self.address,), \
+                                          lambda photo: cnx.send(self.vCard(iq, photo))):
+                debug("Too many photos being rendered, sending the vCard of %s without one" % self.address)
+                cnx.send(self.vCard(iq))
             raise NodeProcessed
         Addressable.iqReceived(self, cnx, iq)
 
+    def vCard(self, iq, photo=None):
+        '''Return the reply to a vCard request. photo is the QR code of the
+           address, base64-encoded (see offload.renderPhoto()).'''
+        reply = iq.buildReply('result')
+        query = reply.getQuery()
+        query.addChild('FN', payload=[self.address])
+        #TODO: More generic URL generation
+        query.addChild('URL', payload=[_(DEFAULT, 'url_bitcoin_address').format(address=self.address)])
+        if photo is not None:
+            node = query.addChild('PHOTO')
+            node.addChild('TYPE', payload='image/png')
+            node.addChild('BINVAL', payload=[photo])
+        return reply
+
     def messageReceived(self, cnx, msg):
         from command import parse as parseCommand, Command
         from useraccount import UserAccount
@@ -126,25 +178,34 @@ class Address(Addressable, BCAddress):
         typ = prs.getType()
         if typ == 'subscribe':
             cnx.send(Presence(typ='subscribed', frm=to, to=user.jid))
-            self.sendBitcoinPresence(cnx, user)
+            self.sendBitcoinPresence(cnx, user, force=True)
         elif typ == 'unsubscribe':
             cnx.send(Presence(typ='unsubscribed', frm=to, to=user.jid))
         elif typ == 'probe':
-            self.sendBitcoinPresence(cnx, user)
+            self.sendBitcoinPresence(cnx, user, force=True)
         raise NodeProcessed
 
-    def sendBitcoinPresence(self, cnx, user):
-        '''Send a presence information to the user, from this address.'''
+    def sendBitcoinPresence(self, cnx, user, force=False, received=None):
+        '''Send a presence information to the user, from this address. Unless
+           force is True, it's not sent if it's the same as the last one.
+           `received` is the result of the user's getReceivedByAddress(), if
+           it's already known: when sending presences from many addresses,
+           this saves calls to the controller.'''
         if not user.isRegistered():
             return
-        if user.ownsAddress(self):
+        if received is None:
+            if self.account == user.jid:
+                received = user.getReceivedByAddress()
+            else:
+                received = {}
+        if self.address in received:
             status = _(ROSTER, 'own_address')
-            percentage = self.getPercentageReceived()
+            percentage = self.getPercentageReceived(received)
             if percentage is not None:
                 status += '\n' + _(ROSTER, 'percentage_balance_received').format(percent=percentage)
         else:
             status = None
-        cnx.send(Presence(to=user.jid, typ='available', show='online', status=status, frm=self.jid))
+        cnx.sendPresence(Presence(to=user.jid, typ='available', show='online', status=status, frm=self.jid), force)
 
 
 class CommandSyntaxError(Exception):
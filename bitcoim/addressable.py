@@ -3,8 +3,9 @@ from bitcoin.address import InvalidBitcoinAddressError
 from datetime import datetime
 from jid import JID
 from logging import debug
+from templates import field
 from xmpp.jep0106 import JIDDecode
-from xmpp.protocol import Presence, NodeProcessed, NS_LAST, NS_VERSION, \
+from xmpp.protocol import Iq, Presence, NodeProcessed, NS_LAST, NS_VERSION, \
                           NS_DISCO_INFO
 from xmpp.simplexml import Node
 
@@ -41,6 +42,24 @@ def generate(jid, components, requester):
 # Time of last activity (XEP-0012)
 last = None
 
+def versionReply():
+    '''Build the template of the reply to software version queries.'''
+    name = Node('name')
+    name.setData(LIB_NAME)
+    version = Node('version')
+    version.setData(LIB_VERSION)
+    reply = Iq(typ='result', queryNS=NS_VERSION)
+    query = reply.getTag('query')
+    query.addChild(node=name)
+    query.addChild(node=version)
+    return reply
+
+def lastReply():
+    '''Build the template of the reply to last activity queries.'''
+    reply = Iq(typ='result', queryNS=NS_LAST)
+    reply.getTag('query').setAttr('seconds', field('seconds'))
+    return reply
+
 class Addressable(object):
     '''An addressable object'''
 
@@ -54,27 +73,28 @@ class Addressable(object):
             ids = [{'category': 'hierarchy', 'type': 'leaf'}]
             return {'ids': ids, 'features': [NS_DISCO_INFO]}
 
+    def discoTemplate(self, user, what, node=None):
+        '''If the reply to a disco query doesn't depend on this particular
+           object (except for a few values), return a tuple (name, fields),
+           where name identifies the reply and fields gives those values:
+           the reply is then made from a template (see templates.py).
+           Otherwise, return None. This must be kept consistent with
+           discoReceived().
+        '''
+        if 'info' == what:
+            return (('disco-leaf', node), {})
+
     def iqReceived(self, cnx, iq):
         '''Default handler for IQ stanzas.'''
         typ = iq.getType()
         ns = iq.getQueryNS()
         if (NS_VERSION == ns) and ('get' == typ):
-            name = Node('name')
-            name.setData(LIB_NAME)
-            version = Node('version')
-            version.setData(LIB_VERSION)
-            reply = iq.buildReply('result')
-            query = reply.getQuery()
-            query.addChild(node=name)
-            query.addChild(node=version)
-            cnx.send(reply)
+            cnx.send(cnx.templates.reply('version', iq, versionReply))
             raise NodeProcessed
         elif (NS_LAST == ns) and ('get' == typ):
             if self.last is not None:
-                reply = iq.buildReply('result')
-                query = reply.getQuery()
-                query.setAttr('seconds', (datetime.now() - self.last).seconds)
-                cnx.send(reply)
+                seconds = (datetime.now() - self.last).seconds
+                cnx.send(cnx.templates.reply('last', iq, lastReply, seconds=seconds))
                 raise NodeProcessed
         else:
             debug("Unhandled IQ namespace '%s'." % ns)
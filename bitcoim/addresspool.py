@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Pre-generated bitcoin addresses, so that registering doesn't wait for the
+   wallet to generate one (and possibly refill its key pool). The addresses
+   of the pool belong to a dedicated account of the wallet, POOL_ACCOUNT,
+   which is no valid JID: they survive restarts, and assigning one to a
+   user is a single setaccount call, which also takes it out of the pool.
+   A thread generates new addresses in batches whenever the pool gets
+   below its low watermark.
+   Only one pool may draw from a given wallet: several components of the
+   same process (see cluster.py) share the same AddressPool.'''
+
+from collections import deque
+from logging import debug, info, warning, exception
+from rpc import Controller, WalletUnavailableError
+from threading import Event, Lock, Thread
+
+POOL_ACCOUNT = 'address pool'
+'''Account of the wallet the unassigned addresses belong to'''
+
+LOW_WATERMARK = 20
+'''Number of unassigned addresses below which the pool is refilled'''
+
+BATCH_SIZE = 50
+'''Number of addresses generated by each refill'''
+
+RETRY_DELAY = 60
+'''How long (in seconds) the refill waits when the wallet is unavailable'''
+
+_current = None
+
+def current():
+    '''Return the address pool in use, or None if there's none.'''
+    return _current
+
+
+class AddressPool(object):
+    '''The pool of unassigned addresses. Set the component's `addressPool`
+       attribute before calling its start() method to use it; the same pool
+       may be given to several components. The following counters are kept:
+       taken, missed (the pool was empty), generated.'''
+
+    def __init__(self, lowWatermark=LOW_WATERMARK, batchSize=BATCH_SIZE, retryDelay=RETRY_DELAY):
+        self.lowWatermark = lowWatermark
+        self.batchSize = batchSize
+        self.retryDelay = retryDelay
+        self.addresses = deque()
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.thread = None
+        self.running = False
+        self.taken = 0
+        self.missed = 0
+        self.generated = 0
+
+    def start(self, component=None):
+        '''Start the refill thread, which first loads the addresses left in
+           the pool by a previous run, and make this pool the current one.
+           Nothing is done if it's already started.'''
+        global _current
+        if self.running:
+            return
+        _current = self
+        self.running = True
+        self.thread = Thread(target=self.run, name='bitcoim-addresses')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        global _current
+        if _current is self:
+            _current = None
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def take(self, account):
+        '''Assign an address of the pool to the given account, and return
+           it. Return None if the pool is empty: the caller should have the
+           wallet generate one. The address is left in the pool if the call
+           to the controller fails.'''
+        self.lock.acquire()
+        try:
+            try:
+                address = self.addresses.popleft()
+            except IndexError:
+                address = None
+            left = len(self.addresses)
+        finally:
+            self.lock.release()
+        if left < self.lowWatermark:
+            self.wakeup.set()
+        if address is None:
+            self.missed += 1
+            debug("The address pool is empty")
+            return None
+        try:
+            Controller().setaccount(address, account)
+        except:
+            self.lock.acquire()
+            try:
+                self.addresses.appendleft(address)
+            finally:
+                self.lock.release()
+            raise
+        self.taken += 1
+        return address
+
+    def load(self):
+        '''Fill the pool with the addresses of POOL_ACCOUNT.'''
+        addresses = Controller().getaddressesbyaccount(POOL_ACCOUNT)
+        self.lock.acquire()
+        try:
+            self.addresses = deque(addresses)
+        finally:
+            self.lock.release()
+        info("%s addresses in the address pool" % len(addresses))
+
+    def refill(self):
+        '''Generate a batch of addresses, if the pool is below its low
+           watermark.'''
+        if len(self.addresses) >= self.lowWatermark:
+            return
+        for i in range(self.batchSize):
+            if not self.running:
+                return
+            address = Controller().getnewaddress(POOL_ACCOUNT)
+            self.lock.acquire()
+            try:
+                self.addresses.append(address)
+            finally:
+                self.lock.release()
+            self.generated += 1
+        debug("Generated %s addresses, %s in the address pool" % (self.batchSize, len(self.addresses)))
+
+    def run(self):
+        loaded = False
+        while self.running:
+            self.wakeup.clear()
+            delay = None
+            try:
+                if not loaded:
+                    self.load()
+                    loaded = True
+                self.refill()
+            except WalletUnavailableError:
+                warning("The wallet is unavailable, the address pool will be refilled later")
+                delay = self.retryDelay
+            except Exception:
+                exception("The address pool couldn't be refilled")
+                delay = self.retryDelay
+            self.wakeup.wait(delay)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Benchmark of the database at scale. A database is created at the first
+   version of the schema and filled with synthetic registrations and pending
+   payment orders (millions of rows if need be). Then, for each version of
+   the schema, the statements run by UserAccount and PaymentOrder are timed
+   on random rows, before the database is upgraded to the next version: the
+   report gives percentiles per statement and version, and the time each
+   upgrade took.
+   Usage: python -m bitcoim.benchmark [options] [<database>]'''
+
+from datetime import datetime, timedelta
+from db import SQL, Database, LATEST_VERSION
+from itertools import islice
+from logging import info
+from optparse import OptionParser
+from os import close, remove
+from os.path import exists
+from profiling import percentile
+from random import Random
+from tempfile import mkstemp
+from time import time
+
+USERS = 100000
+'''Default number of registrations generated'''
+
+PAYMENTS = 100000
+'''Default number of pending payment orders generated'''
+
+SAMPLES = 1000
+'''Default number of times each statement is timed, for each version'''
+
+BATCH_SIZE = 10000
+'''Number of rows inserted per transaction by the generator'''
+
+_alphabet = 'abcdefghjkmnpqrstuvwxyz23456789'
+
+BENCH_CODE = 'bench0'
+'''Confirmation code of the payment orders queued by the benchmark, which no
+   generated one has (0 isn't part of the alphabet)'''
+
+def jid(index):
+    return u'user%d@example%d.org' % (index, index % 97)
+
+def username(index):
+    '''Return the username of a generated user: one in ten has none.'''
+    if 0 == index % 10:
+        return u''
+    return u'User%d' % index
+
+def code(index):
+    '''Return a confirmation code unique for each index.'''
+    chars = []
+    while True:
+        chars.append(_alphabet[index % len(_alphabet)])
+        index //= len(_alphabet)
+        if 0 == index:
+            break
+    return ''.join(chars).ljust(4, _alphabet[0])
+
+def namedUser(random, users):
+    '''Return the index of a random generated user who has a username.'''
+    return random.randrange(users // 10) * 10 + 1
+
+def insertInBatches(statement, rows):
+    '''Insert rows (an iterable) with executemany(), BATCH_SIZE per
+       transaction.'''
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, BATCH_SIZE))
+        if 0 == len(batch):
+            return
+        SQL().execute('begin')
+        SQL().conn.executemany(statement, batch)
+        SQL().execute('commit')
+
+
+class Generator(object):
+    '''Fills a database, at version 1 of the schema, with `users`
+       registrations and `payments` pending payment orders, sent by random
+       users. Randomness comes from the given seed, so that runs are
+       comparable.'''
+
+    def __init__(self, users=USERS, payments=PAYMENTS, seed=0):
+        self.users = users
+        self.payments = payments
+        self.random = Random(seed)
+
+    def run(self):
+        start = time()
+        req = 'insert into registrations (registered_jid, username) values (?, ?)'
+        insertInBatches(req, ((jid(i), username(i)) for i in xrange(self.users)))
+        info("Generated %s registrations in %.1fs" % (self.users, time() - start))
+        start = time()
+        req = '''insert into payments (from_jid, date, recipient, amount, comment,
+                 confirmation_code, fee) values (?, ?, ?, ?, ?, ?, ?)'''
+        insertInBatches(req, (self.payment(i) for i in xrange(self.payments)))
+        info("Generated %s payment orders in %.1fs" % (self.payments, time() - start))
+
+    def payment(self, index):
+        # Codes are made unique per payment, hence per sender.
+        date = datetime(2011, 1, 1) + timedelta(seconds=self.random.randint(0, 86400 * 365))
+        if self.random.random() < 0.5:
+            recipient = username(namedUser(self.random, self.users))
+        else:
+            recipient = '1' + ''.join([self.random.choice(_alphabet) for i in range(33)])
+        return (jid(self.random.randrange(self.users)), date, recipient, \
+                round(self.random.uniform(0.01, 10), 2), u'', code(index), 0)
+
+
+class Benchmark(object):
+    '''Times the statements of UserAccount and PaymentOrder on random rows of
+       a generated database, `samples` times each.'''
+
+    def __init__(self, users=USERS, payments=PAYMENTS, samples=SAMPLES, seed=1):
+        self.users = users
+        self.payments = payments
+        self.samples = samples
+        self.random = Random(seed)
+        self.results = []
+
+    def patterns(self, version):
+        '''Return the statements to time at the given version of the schema,
+           as tuples (name, function returning the statement and its
+           arguments). Statements that write are followed by the one that
+           undoes them.'''
+        items = (version >= 4) and ', items' or ''
+        lower = (version >= 6) and ', username_lower' or ''
+        state = (version >= 7) and " and state='pending'" or ''
+        randomUser = lambda: self.random.randrange(self.users)
+        randomPayment = lambda: self.random.randrange(self.payments)
+        randomName = lambda: username(namedUser(self.random, self.users))
+        patterns = [
+            ('isRegistered', lambda: ('select id from registrations where registered_jid=?', \
+                                      (jid(randomUser()),))),
+            ('username of JID', lambda: ('select username from registrations where registered_jid=?', \
+                                         (jid(randomUser()),))),
+            ('JID of username', lambda: ('select registered_jid from registrations where username=?', \
+                                         (randomName(),))),
+            ('canUseUsername', lambda: ('''select id from registrations where username=? and
+                                           registered_jid!=?''', \
+                                        (randomName(), jid(randomUser())))),
+            ('pendingPayments', lambda: ('''select date, recipient, amount, comment,
+                                            confirmation_code%s from payments where from_jid=?%s''' % \
+                                         (items, state), \
+                                         (jid(randomUser()),))),
+            ('code lookup', lambda: self.codeLookup(randomPayment(), items, state)),
+            ('register', lambda: ('''insert into registrations (registered_jid, username%s)
+                                     values (?, ?%s)''' % (lower, lower and ', ?'), \
+                                  (u'bench@example.org', u'Bench') + (lower and (u'bench',) or ()))),
+            ('unregister', lambda: ('delete from registrations where registered_jid=?', \
+                                    (u'bench@example.org',))),
+            ('queue', lambda: ('''insert into payments (from_jid, date, recipient, amount, comment,
+                                  confirmation_code, fee%s) values (?, ?, ?, ?, ?, ?, ?%s)''' % \
+                               (items, items and ', ?'), (jid(randomUser()), datetime.now(), \
+                               username(1), 1.0, u'', BENCH_CODE, 0) + (items and (0,) or ()))),
+            ('delete payment', lambda: ('delete from payments where id=?', (SQL().cursor.lastrowid,)))]
+        return patterns
+
+    def codeLookup(self, index, items, state=''):
+        '''Return the statement PaymentOrder uses to fetch a pending payment
+           order by its code, for the payment order at `index`.'''
+        SQL().execute('select from_jid, confirmation_code from payments where id=?', (index + 1,))
+        row = SQL().fetchone()
+        return ('''select id, date, recipient, amount, comment, fee%s from payments
+                   where from_jid=? and confirmation_code=?%s''' % (items, state), tuple(row))
+
+    def run(self, version, upgradeTime=None):
+        '''Time the statements at the given version of the schema.'''
+        timings = {}
+        patterns = self.patterns(version)
+        for i in xrange(self.samples):
+            for (name, pattern) in patterns:
+                (statement, args) = pattern()
+                start = time()
+                SQL().execute(statement, args)
+                SQL().fetchall()
+                timings.setdefault(name, []).append(time() - start)
+        self.results.append((version, upgradeTime, [(name, sorted(timings[name])) \
+                                                    for (name, pattern) in patterns]))
+
+    def report(self):
+        '''Return the report of the benchmark, as text.'''
+        lines = []
+        for (version, upgradeTime, timings) in self.results:
+            if upgradeTime is None:
+                lines.append("Version %s" % version)
+            else:
+                lines.append("Version %s (upgrade: %.3fs)" % (version, upgradeTime))
+            lines.append("%-16s %9s %9s %9s %9s" % ('', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)'))
+            for (name, values) in timings:
+                lines.append("%-16s %9.3f %9.3f %9.3f %9.3f" % (name, \
+                             percentile(values, 0.5) * 1000, percentile(values, 0.9) * 1000, \
+                             percentile(values, 0.99) * 1000, values[-1] * 1000))
+            lines.append('')
+        return "\n".join(lines)
+
+def main():
+    parser = OptionParser(usage="%prog [options] [<database>]")
+    parser.add_option('-u', '--users', type='int', default=USERS,
+                      help="number of registrations generated")
+    parser.add_option('-p', '--payments', type='int', default=PAYMENTS,
+                      help="number of pending payment orders generated")
+    parser.add_option('-n', '--samples', type='int', default=SAMPLES,
+                      help="number of times each statement is timed")
+    parser.add_option('-k', '--keep', action='store_true', default=False,
+                      help="keep the database")
+    (options, args) = parser.parse_args()
+    if len(args) > 1:
+        parser.error("only one database can be given")
+    if 0 != len(args):
+        path = args[0]
+        if exists(path):
+            parser.error("%s already exists" % path)
+    else:
+        (fd, path) = mkstemp(suffix='.db')
+        close(fd)
+    try:
+        SQL(path)
+        Database(path).upgrade(1)
+        Generator(options.users, options.payments).run()
+        benchmark = Benchmark(options.users, options.payments, options.samples)
+        benchmark.run(1)
+        for version in range(2, LATEST_VERSION + 1):
+            start = time()
+            Database(path).upgrade(version)
+            benchmark.run(version, time() - start)
+        print benchmark.report()
+    finally:
+        SQL.close(path)
+        if not options.keep:
+            remove(path)
+
+if __name__ == '__main__':
+    main()
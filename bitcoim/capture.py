@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Capture of the inbound traffic of a component, to be replayed later (see
+   replay.py). Each stanza is written to a gzipped file, one JSON line per
+   stanza, with the time it was received (relative to the start of the
+   capture). Real JIDs, usernames and free text are anonymized with a keyed
+   hash: the same key can be used to anonymize a copy of the database (see
+   anonymizeDatabase()), so that the stanzas still refer to the registered
+   users when they are replayed against it.'''
+
+from gzip import GzipFile
+from hashlib import sha1
+from hmac import new as hmac
+from json import dumps, loads
+from logging import exception, info
+from re import compile as re_compile
+from threading import Lock
+from time import time
+from xmpp.jep0106 import JIDDecode, JIDEncode
+from xmpp.protocol import JID
+
+FORMAT_VERSION = 1
+'''Version of the capture file format'''
+
+ANONYMOUS_DOMAIN = 'anonymous.invalid'
+'''Domain of the anonymized real JIDs'''
+
+_kept = re_compile(r'^([0-9]+(\.[0-9]+)?|[123mn][1-9A-HJ-NP-Za-km-z]{25,34})$')
+'''Words of a message body that are kept as is: amounts and bitcoin
+   addresses'''
+
+class Anonymizer(object):
+    '''Replaces real JIDs, usernames and words by pseudonyms derived from
+       a secret key. `isUsername` tells whether a word is a registered
+       username.'''
+
+    def __init__(self, key, domain, isUsername):
+        self.key = key
+        self.domain = domain
+        self.isUsername = isUsername
+
+    def pseudonym(self, prefix, value):
+        return prefix + hmac(self.key, value.encode('utf-8'), sha1).hexdigest()[:12]
+
+    def jid(self, jid):
+        '''Anonymize a real JID (the resource is anonymized too).'''
+        jid = JID(jid)
+        result = JID(node=self.pseudonym('u', jid.getStripped()), domain=ANONYMOUS_DOMAIN)
+        if jid.getResource():
+            result.setResource(self.pseudonym('r', jid.getResource()))
+        return result
+
+    def username(self, username):
+        return self.pseudonym('n', username)
+
+    def localJID(self, jid):
+        '''Anonymize a JID hosted at the gateway: usernames and real JIDs
+           (in their "hosted" form) are replaced, bitcoin addresses are
+           kept.'''
+        jid = JID(jid)
+        node = jid.getNode()
+        if not node:
+            return jid
+        decoded = JIDDecode(node)
+        if self.isUsername(decoded):
+            node = JIDEncode(self.username(decoded))
+        elif '@' in decoded:
+            node = JIDEncode(unicode(self.jid(decoded)))
+        return JID(node=node, domain=jid.getDomain(), resource=jid.getResource())
+
+    def words(self, text, command=True):
+        '''Anonymize free text: the first word (the command, unless command
+           is False), amounts, addresses and usernames are kept (usernames
+           are replaced by their pseudonym), other words are blanked out.'''
+        words = text.split()
+        for i in range(len(words)):
+            if (command and (0 == i)) or _kept.match(words[i]):
+                continue
+            if self.isUsername(words[i]):
+                words[i] = self.username(words[i])
+            else:
+                words[i] = 'x' * len(words[i])
+        return ' '.join(words)
+
+    def stanza(self, stanza):
+        '''Return an anonymized copy of the stanza.'''
+        stanza = stanza.__class__(node=stanza)
+        if stanza.getFrom() is not None:
+            stanza.setFrom(self.jid(stanza.getFrom()))
+        if stanza.getTo() is not None:
+            stanza.setTo(self.localJID(stanza.getTo()))
+        for child in stanza.getTags('status'):
+            child.setData('')
+        body = stanza.getTag('body')
+        if body is not None:
+            body.setData(self.words(body.getData()))
+        for query in stanza.getTags('query'):
+            for name in ['username', 'nick', 'prompt']:
+                for child in query.getTags(name):
+                    child.setData(self.words(child.getData(), False))
+        return stanza
+
+
+class Capture(object):
+    '''Records the stanzas received by a component to the file at `path`.
+       Set the component's `capture` attribute before calling its start()
+       method to use it.'''
+
+    def __init__(self, path, key, domain):
+        from useraccount import UserAccount, UnknownUserError
+        def isUsername(word):
+            try:
+                UserAccount(word)
+                return True
+            except UnknownUserError:
+                return False
+        self.anonymizer = Anonymizer(key, domain, isUsername)
+        self.file = GzipFile(path, 'wb')
+        self.lock = Lock()
+        self.start = time()
+        self.count = 0
+        self.write({'version': FORMAT_VERSION, 'domain': domain, 'start': self.start})
+        info("Capturing the inbound stanzas to %s" % path)
+
+    def write(self, entry):
+        self.lock.acquire()
+        try:
+            self.file.write(dumps(entry) + '\n')
+        finally:
+            self.lock.release()
+
+    def record(self, stanza, what=None):
+        '''Record a stanza. For disco queries, `what` is 'info' or
+           'items'.'''
+        offset = time() - self.start
+        xml = unicode(self.anonymizer.stanza(stanza))
+        self.write({'t': round(offset, 4), 'what': what, 'xml': xml})
+        self.count += 1
+
+    def wrap(self, handler):
+        '''Return a handler, to be registered instead of `handler`, that
+           records the stanzas before handling them.'''
+        def captured(cnx, stanza, *args):
+            try:
+                self.record(stanza, *args)
+            except Exception:
+                exception("Couldn't capture a stanza")
+            return handler(cnx, stanza, *args)
+        return captured
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.file.close()
+        finally:
+            self.lock.release()
+        info("Captured %s stanzas" % self.count)
+
+def read(path):
+    '''Read a capture file. Return its header, and an iterator over its
+       entries: dictionaries with keys 't' (time offset), 'what' and 'xml'.'''
+    f = GzipFile(path, 'rb')
+    header = loads(f.readline())
+    if FORMAT_VERSION != header.get('version'):
+        raise ValueError, "Unknown capture format %s" % header.get('version')
+    def entries():
+        try:
+            for line in f:
+                yield loads(line)
+        finally:
+            f.close()
+    return (header, entries())
+
+def anonymizeDatabase(key, domain):
+    '''Anonymize the current database (which should be a copy!) with the
+       same key as a capture: real JIDs and usernames are replaced by their
+       pseudonyms. The comments of payment orders are blanked out. Note that
+       the wallet's accounts are named after the real JIDs: the replay should
+       use a test wallet.'''
+    from db import SQL
+    anonymizer = Anonymizer(key, domain, lambda word: False)
+    SQL().execute('select id, registered_jid, username from registrations')
+    rows = SQL().fetchall()
+    usernames = {}
+    SQL().execute('begin')
+    try:
+        req = 'update registrations set registered_jid=?, username=?, username_lower=? where id=?'
+        for row in rows:
+            username = row['username'] and anonymizer.username(row['username'])
+            usernames[row['username']] = username
+            SQL().execute(req, (unicode(anonymizer.jid(row['registered_jid'])), \
+                                username, username.lower(), row['id']))
+        SQL().execute('select id, from_jid, recipient, comment from payments')
+        req = 'update payments set from_jid=?, recipient=?, comment=? where id=?'
+        for row in SQL().fetchall():
+            SQL().execute(req, (unicode(anonymizer.jid(row['from_jid'])), \
+                                usernames.get(row['recipient'], row['recipient']), \
+                                'x' * len(row['comment']), row['id']))
+        SQL().execute('select id, recipient from payment_items')
+        req = 'update payment_items set recipient=? where id=?'
+        for row in SQL().fetchall():
+            SQL().execute(req, (usernames.get(row['recipient'], row['recipient']), row['id']))
+        for (table, column) in [('ledger', 'account'), ('ledger', 'otheraccount'), \
+                                ('ledger_addresses', 'account')]:
+            SQL().execute('select distinct %s from %s where %s like ?' % (column, table, column), ('%@%',))
+            req = 'update %s set %s=? where %s=?' % (table, column, column)
+            for row in SQL().fetchall():
+                SQL().execute(req, (unicode(anonymizer.jid(row[0])), row[0]))
+    except:
+        SQL().execute('rollback')
+        raise
+    SQL().execute('commit')
+    info("Anonymized %s registrations" % len(rows))
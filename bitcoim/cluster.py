@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Several components running in the same process. Each component has its
+   own connection to the XMPP server, for its own domain (or for the same
+   domain, if the server balances the load between component connections),
+   while they all share the process' connections to the bitcoin controller
+   and to the database.'''
+
+from logging import debug
+from select import select
+
+class ComponentGroup(object):
+    '''A group of components sharing the registered users: each of them
+       only takes care of a shard of the users when starting (see
+       Component.isInShard()), while any of them answers the stanzas it
+       receives.'''
+
+    def __init__(self, components):
+        self.components = list(components)
+        for (index, component) in enumerate(self.components):
+            component.shard = (index, len(self.components))
+
+    def start(self, proxy=None):
+        '''Start all components.'''
+        for component in self.components:
+            debug("Starting component %s" % component.jid)
+            component.start(proxy)
+
+    def Process(self, timeout=0):
+        '''Wait at most `timeout` seconds for any of the components to
+           receive data, then let each of them process what it received. This
+           is the equivalent of Component.Process() for the whole group.
+           Return None if any of the connections was lost.'''
+        sockets = [component.Connection._sock for component in self.components]
+        select(sockets, [], [], timeout)
+        result = 0
+        for component in self.components:
+            received = component.Process(0)
+            if received is None:
+                return None
+            result += int(received)
+        return result
+
+    def sayGoodbye(self):
+        '''Stop all components.'''
+        for component in self.components:
+            component.sayGoodbye()
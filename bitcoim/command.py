@@ -3,17 +3,45 @@
 '''This module contains everything that is related to commands.
 '''
 
+from address import Address
+from bitcoin.address import InvalidBitcoinAddressError
 from bitcoin.transaction import CATEGORY_MOVE, CATEGORY_SEND
-from i18n import _, COMMANDS, TX
+from context import current
+from db import SQL
+from i18n import _, ADMIN, COMMANDS, TX
 from jid import JID
 from logging import debug, info
+import memory
 from paymentorder import PaymentOrder, PaymentError, PaymentNotFoundError, \
-                         NotEnoughBitcoinsError, PaymentToSelfError
-from useraccount import UserAccount
+                         NotEnoughBitcoinsError, PartialPaymentError, PaymentToSelfError, \
+                         STATE_SENDING
+from rpc import WalletUnavailableError
+import stats
+from useraccount import UserAccount, UnknownUserError
 
 WARNING_LIMIT = 10
 '''The amount above which you will be warned when inserting a payment order'''
 
+HISTORY_PAGE_SIZE = 10
+'''The number of transactions listed in each page of the history'''
+
+HISTORY_STABLE_CONFIRMATIONS = 6
+'''A page of the history is only cached if its transactions have at least
+   that many confirmations, since the number shown would change'''
+
+QUERIES_LISTED = 10
+'''The number of statements listed by the queries command'''
+
+ACTIONS = ['pay', 'batch', 'history', 'cancel', 'confirm', 'help', 'queries', 'memory', 'stats']
+'''The available actions. Their translated names are found in the Commands
+   section of the messages, as command_<action>.'''
+
+ADMIN_ACTIONS = ['queries', 'memory', 'stats']
+'''The actions only admins can execute. For other users, they don't exist.'''
+
+EXPENSIVE_ACTIONS = ['batch', 'history', 'confirm']
+'''The actions that cost the most to execute, and are more strictly limited'''
+
 def parse(line):
     '''Parse a command line and return a tuple (action, arguments), where
        action is a word, and arguments is an array of words.
@@ -43,17 +71,37 @@ class Command(object):
     def usage(self):
         """Return an explanation message about how to use the command. Raise an
            exception if the command doesn't exist."""
-        for action in ['pay', 'history', 'cancel', 'confirm', 'help']:
+        for action in ACTIONS:
             if _(COMMANDS, 'command_'+action) == self.action:
                 return _(COMMANDS, 'command_'+action+'_usage')
         raise UnknownCommandError, self.action
 
+    def isAdminOnly(self):
+        '''Return whether the command is one of ADMIN_ACTIONS, once
+           expanded.'''
+        for action in ADMIN_ACTIONS:
+            if _(COMMANDS, 'command_'+action) == self.action:
+                return True
+        return False
+
+    def isExpensive(self):
+        '''Return whether the command is one of EXPENSIVE_ACTIONS, once
+           expanded. Ambiguous commands are cheap: they won't be executed.'''
+        try:
+            self.expandAction()
+        except AmbiguousCommandError:
+            return False
+        for action in EXPENSIVE_ACTIONS:
+            if _(COMMANDS, 'command_'+action) == self.action:
+                return True
+        return False
+
     def expandAction(self):
         '''Try to guess the action from its first letters. If a match is found,
            replace self.action. Raise AmbiguousCommandError if more than one
            match is found. If there's no match, don't change anything.'''
         matches = []
-        for a in ['pay', 'history', 'cancel', 'confirm', 'help']:
+        for a in ACTIONS:
             command = _(COMMANDS, 'command_'+a)
             if 0 == command.find(self.action):
                 matches.append(command)
@@ -68,6 +116,8 @@ class Command(object):
         """Actually execute the command, on behalf of the given user."""
         debug("A command was sent: %s" % self.action)
         self.expandAction()
+        if self.isAdminOnly() and not user.isAdmin():
+            raise UnknownCommandError, self.action
         if _(COMMANDS, 'command_pay') == self.action:
             if self.target is None:
                 raise CommandTargetError, _(TX, 'error_payment_to_gateway')
@@ -77,6 +127,12 @@ class Command(object):
                 raise CommandSyntaxError, _(TX, 'error_no_amount')
             comment = ' '.join(self.arguments)
             return self._executePay(user, amount, self.target, comment)
+        elif _(COMMANDS, 'command_batch') == self.action:
+            if self.target is not None:
+                raise CommandTargetError, _(TX, 'error_batch_to_target')
+            if (0 == len(self.arguments)) or (0 != len(self.arguments) % 2):
+                raise CommandSyntaxError, _(TX, 'error_batch_syntax')
+            return self._executeBatch(user, zip(self.arguments[0::2], self.arguments[1::2]))
         elif _(COMMANDS, 'command_cancel') == self.action:
             try:
                 code = self.arguments.pop(0)
@@ -96,7 +152,29 @@ class Command(object):
                 targetCommand = None
             return self._executeHelp(user, self.target, targetCommand)
         elif _(COMMANDS, 'command_history') == self.action:
-            return self._executeHistory(user)
+            try:
+                page = int(self.arguments.pop(0))
+            except IndexError:
+                page = 1
+            except ValueError:
+                raise CommandSyntaxError, _(COMMANDS, 'error_page_non_number')
+            if page <= 0:
+                raise CommandSyntaxError, _(COMMANDS, 'error_page_non_number')
+            return self._executeHistory(user, page)
+        elif _(COMMANDS, 'command_queries') == self.action:
+            if self.target is not None:
+                raise CommandTargetError, _(ADMIN, 'error_admin_to_target')
+            reset = (0 != len(self.arguments)) and ('reset' == self.arguments[0])
+            return self._executeQueries(reset)
+        elif _(COMMANDS, 'command_memory') == self.action:
+            if self.target is not None:
+                raise CommandTargetError, _(ADMIN, 'error_admin_to_target')
+            trim = (0 != len(self.arguments)) and ('trim' == self.arguments[0])
+            return self._executeMemory(trim)
+        elif _(COMMANDS, 'command_stats') == self.action:
+            if self.target is not None:
+                raise CommandTargetError, _(ADMIN, 'error_admin_to_target')
+            return self._executeStats()
         else:
             raise UnknownCommandError, self.action
 
@@ -114,6 +192,9 @@ class Command(object):
             order = PaymentOrder(sender, target, amount, comment)
         except PaymentToSelfError:
             raise CommandSyntaxError, _(TX, 'error_payment_to_self')
+        # Before queueing it: if the wallet is unavailable, there's no
+        # payment order left behind with a code the sender never saw.
+        balance = sender.getBalance()
         order.queue()
         info("Payment order valid, queued: %s -> %s (BTC %s, %s)" % \
              (sender, target, amount, order.code))
@@ -122,44 +203,156 @@ class Command(object):
         else:
             reply = _(TX, 'confirm_recap_comment').format(amount=amount, recipient=order.recipient, comment=comment)
         reply += ' ' + _(COMMANDS, 'confirm_prompt').format(code=order.code)
-        if sender.getBalance() - amount < WARNING_LIMIT:
-            reply += ' ' + _(TX, 'warning_low_balance').format(amount=sender.getBalance())
+        if balance - amount < WARNING_LIMIT:
+            reply += ' ' + _(TX, 'warning_low_balance').format(amount=balance)
         return reply
 
-    def _executeHistory(self, user):
-        """Called internally. List the past transactions related to the user."""
-        reply = ''
-        for payment in user.pastPayments():
-            if self.target is not None and (self.target.jid != payment.otheraccount):
-                continue
+    def _executeBatch(self, sender, pairs):
+        """Called internally. Place a grouped payment order, made of
+           (recipient, amount) pairs, in the pending list and generate the
+           reply. A recipient is either a bitcoin address or a username."""
+        debug("Grouped pay order (%s recipients from %s)" % (len(pairs), sender))
+        items = []
+        for (recipient, amount) in pairs:
+            try:
+                amount = int(amount)
+            except ValueError:
+                raise CommandSyntaxError, _(TX, 'error_amount_non_number')
+            if amount <= 0:
+                raise CommandSyntaxError, _(TX, 'error_amount_non_positive')
+            try:
+                target = Address(recipient)
+            except InvalidBitcoinAddressError:
+                try:
+                    target = UserAccount(recipient)
+                except UnknownUserError:
+                    raise CommandSyntaxError, _(TX, 'error_unknown_recipient').format(recipient=recipient)
+            items.append((target, amount))
+        try:
+            order = PaymentOrder(sender, items=items)
+        except PaymentToSelfError:
+            raise CommandSyntaxError, _(TX, 'error_payment_to_self')
+        balance = sender.getBalance()
+        order.queue()
+        info("Grouped payment order valid, queued: %s -> %s recipients (BTC %s, %s)" % \
+             (sender, len(items), order.amount, order.code))
+        reply = _(TX, 'batch_recap').format(amount=order.amount, count=len(items))
+        for (target, amount) in items:
+            reply += "\n" + _(TX, 'batch_recap_item').format(amount=amount, \
+                                     recipient=PaymentOrder.itemRecipient(target))
+        reply += "\n" + _(COMMANDS, 'confirm_prompt').format(code=order.code)
+        if balance - order.amount < WARNING_LIMIT:
+            reply += ' ' + _(TX, 'warning_low_balance').format(amount=balance)
+        return reply
+
+    def _executeHistory(self, user, page=1):
+        """Called internally. List one page of the past transactions related
+           to the user, the first page being the most recent. The reply is
+           cached until a new transaction is known to the wallet, unless
+           it shows transactions that aren't confirmed enough."""
+        if self.target is None:
+            key = (None, page)
+        else:
+            key = (unicode(self.target.jid), page)
+        marker = user.lastTransaction()
+        reply = user.cachedHistory(key, marker)
+        if reply is not None:
+            debug("History of %s didn't change, reusing it" % user)
+            return reply
+        payments = user.pastPayments(HISTORY_PAGE_SIZE, (page - 1) * HISTORY_PAGE_SIZE, self.target)
+        usernames = UserAccount.getUsernames(set([payment.otheraccount for payment in payments \
+                                                  if payment.otheraccount is not None]))
+        lines = []
+        for payment in payments:
             amount = payment.amount
-            reply += "\n"
-            if payment.otheraccount is None:
-                reply += _(TX, 'history_recap_item').format(amount=amount)
+            if (payment.otheraccount is None) or (self.target is not None):
+                line = _(TX, 'history_recap_item').format(amount=amount)
             else:
-                other = UserAccount(JID(payment.otheraccount))
-                if other == self.target:
-                    reply += _(TX, 'history_recap_item').format(amount=amount)
-                else:
-                    tofrom = 'to' if amount < 0 else 'from'
-                    reply += _(TX, 'history_recap_item_%s' % tofrom).format(amount=abs(amount), dest=other.username)
+                tofrom = 'to' if amount < 0 else 'from'
+                line = _(TX, 'history_recap_item_%s' % tofrom).format(amount=abs(amount), \
+                                                  dest=usernames.get(payment.otheraccount, ''))
             if payment.message is not None:
-                reply = _(TX, 'tx_comment').format(message=reply, comment=payment.message)
+                line = _(TX, 'tx_comment').format(message=line, comment=payment.message)
             confirmations = payment.confirmations
             if 0 <= confirmations:
-                reply = _(TX, 'tx_confirmations').format(message=reply, confirmations=payment.confirmations)
-        if 0 == len(reply):
+                line = _(TX, 'tx_confirmations').format(message=line, confirmations=payment.confirmations)
+            lines.append(line)
+        if 0 == len(lines):
             if self.target is None:
                 reply = _(TX, 'history_recap_nothing_global')
             else:
                 reply = _(TX, 'history_recap_nothing_target')
         else:
+            summary = ''.join(["\n" + line for line in lines])
             if self.target is None:
-                reply = _(TX, 'history_recap_global').format(summary=reply)
+                reply = _(TX, 'history_recap_global').format(summary=summary)
             else:
-                reply = _(TX, 'history_recap_target').format(summary=reply)
+                reply = _(TX, 'history_recap_target').format(summary=summary)
+        if HISTORY_PAGE_SIZE == len(payments):
+            reply += "\n" + _(COMMANDS, 'history_next_page').format(page=page + 1)
+        if 0 == len([payment for payment in payments \
+                     if 0 <= payment.confirmations < HISTORY_STABLE_CONFIRMATIONS]):
+            user.cacheHistory(key, marker, reply)
         return reply
 
+    def _executeQueries(self, reset=False):
+        """Called internally. Generate the report of the SQL query log: the
+           statements that took the most time, and the latest slow ones."""
+        log = SQL.queryLog
+        if log is None:
+            return _(ADMIN, 'queries_disabled')
+        lines = [_(ADMIN, 'queries_header')]
+        for (statement, count, total, longest) in log.top(QUERIES_LISTED):
+            lines.append(_(ADMIN, 'queries_item').format(statement=statement, count=count, \
+                             total=total, average=total * 1000 / count, max=longest * 1000))
+        lines.append(_(ADMIN, 'queries_slow_header').format(threshold=log.threshold))
+        for (date, duration, statement, site, plan) in reversed(log.slow):
+            lines.append(_(ADMIN, 'queries_slow_item').format(date=date.strftime('%Y-%m-%d %H:%M:%S'), \
+                             duration=duration, statement=statement, site=site))
+            for step in plan:
+                lines.append(_(ADMIN, 'queries_plan_item').format(step=step))
+        if reset:
+            log.reset()
+            lines.append(_(ADMIN, 'queries_reset'))
+        return "\n".join(lines)
+
+    def _executeMemory(self, trim=False):
+        """Called internally. Generate the report of the memory used by the
+           component: its structures, the hit rates of its caches, and the
+           most numerous types of objects. If trim is True, forget about
+           offline users first."""
+        component = current().component
+        lines = []
+        if trim:
+            lines.append(_(ADMIN, 'memory_trimmed').format(count=memory.trim(component)))
+        lines.append(_(ADMIN, 'memory_header'))
+        for (name, entries, size) in memory.structures(component):
+            lines.append(_(ADMIN, 'memory_item').format(name=name, entries=entries, \
+                                                         size=size / 1024.0))
+        lines.append(_(ADMIN, 'memory_rates_header'))
+        for (name, hits, misses) in memory.hitRates(component):
+            lines.append(_(ADMIN, 'memory_rate_item').format(name=name, hits=hits, \
+                             misses=misses, rate=100.0 * hits / max(hits + misses, 1)))
+        lines.append(_(ADMIN, 'memory_types_header'))
+        for (name, count) in memory.topTypes():
+            lines.append(_(ADMIN, 'memory_type_item').format(name=name, count=count))
+        return "\n".join(lines)
+
+    def _executeStats(self):
+        """Called internally. Generate the report of the gateway's
+           statistics."""
+        (result, age) = stats.gather(current().component)
+        lines = [_(ADMIN, 'stats_users').format(**result),
+                 _(ADMIN, 'stats_pending').format(**result)]
+        if result['accounts'] is None:
+            lines.append(_(ADMIN, 'stats_wallet_unavailable'))
+        else:
+            lines.append(_(ADMIN, 'stats_wallet').format(**result))
+            for (account, balance) in result['top']:
+                lines.append(_(ADMIN, 'stats_account_item').format(account=account, balance=balance))
+        lines.append(_(ADMIN, 'stats_age').format(age=age))
+        return "\n".join(lines)
+
     def _executeCancel(self, user, code=None):
         """Called internally. Do the cancellation of a pending payment order
            and generate the reply."""
@@ -172,7 +365,14 @@ class Command(object):
         debug("Payment %s (BTC %s to %s) was cancelled by %s" % \
               (code, payment.amount, payment.recipient, user))
         target = self.target
-        if target == payment.target:
+        if payment.items:
+            # Grouped payment orders are made from the gateway's JID.
+            recipient = _(TX, 'batch_recipients').format(count=len(payment.items))
+            if 0 == len(payment.comment):
+                reply = _(TX, 'cancel_recap_other').format(amount=payment.amount, recipient=recipient)
+            else:
+                reply = _(TX, 'cancel_recap_other_comment').format(amount=payment.amount, recipient=recipient, comment=payment.comment)
+        elif target == payment.target:
             if 0 == len(payment.comment):
                 reply = _(TX, 'cancel_recap_target').format(amount=payment.amount)
             else:
@@ -190,18 +390,53 @@ class Command(object):
 
     def _executeConfirm(self, user, code=None):
         """Called internally. Do the actual confirmation of a given payment
-           order and generate the reply."""
+           order and generate the reply. If the component has a payment
+           worker, the payment order is only queued: the worker sends it.
+           Otherwise it's sent right away; if the wallet stopped answering
+           while it was being sent, confirming it again later makes the
+           payments that weren't made, and only them (see
+           PaymentOrder.resume())."""
         debug("Confirmation attempt from %s (%s)" % (user, code))
+        worker = current().component and current().component.paymentWorker
         try:
             payment = PaymentOrder(user, code=code)
         except PaymentNotFoundError:
-            raise CommandError, _(TX, 'error_tx_not_found').format(code=code)
+            if worker is not None:
+                raise CommandError, _(TX, 'error_tx_not_found').format(code=code)
+            try:
+                payment = PaymentOrder(user, code=code, state=STATE_SENDING)
+            except PaymentNotFoundError:
+                raise CommandError, _(TX, 'error_tx_not_found').format(code=code)
+        if worker is not None:
+            if not payment.enqueue():
+                raise CommandError, _(TX, 'error_tx_not_found').format(code=code)
+            worker.notify()
+            return _(TX, 'pay_queued').format(code=code)
+        if not payment.claim():
+            raise CommandError, _(TX, 'error_payment_unknown').format(code=code)
         try:
-            transactionId = payment.confirm()
+            done = None
+            if STATE_SENDING == payment.state:
+                if not payment.resumable():
+                    raise CommandError, _(TX, 'error_payment_unknown').format(code=code)
+                done = payment.resume()
+            transactionId = payment.confirm(done)
+        except PaymentNotFoundError:
+            raise CommandError, _(TX, 'error_tx_not_found').format(code=code)
+        except PartialPaymentError, made:
+            raise CommandError, _(TX, 'error_payment_partial').format(made=made)
         except NotEnoughBitcoinsError:
             raise CommandError, _(TX, 'error_insufficient_funds')
         except PaymentError, message:
             raise CommandError, _(TX, 'error_payment_impossible').format(reason=message)
+        except WalletUnavailableError:
+            if STATE_SENDING != payment.state:
+                raise
+            # Some payments may have been made: the sender must not be told
+            # to simply try again.
+            raise CommandError, _(TX, 'error_payment_unknown').format(code=code)
+        finally:
+            payment.release()
         info("BTC %s paid from %s to %s. Transaction ID: %s" % \
               (payment.amount, user, payment.recipient, transactionId))
         if 0 == transactionId:
@@ -217,10 +452,14 @@ class Command(object):
             label = _(TX, 'pending_header_global')
             empty = _(TX, 'pending_nothing_global')
             for row in user.pendingPayments():
+                if 0 == row['items']:
+                    recipient = row['recipient']
+                else:
+                    recipient = _(TX, 'batch_recipients').format(count=row['items'])
                 reply += "\n" + _(TX, 'pending_item_global').format(code=row['confirmation_code'],\
                                                                     date=row['date'].date().isoformat(),\
                                                                     amount=row['amount'],\
-                                                                    recipient=row['recipient'])
+                                                                    recipient=recipient)
                 if 0 != len(row['comment']):
                     reply = _(TX, 'tx_comment').format(message=reply, comment=row['comment'])
         else:
@@ -245,7 +484,9 @@ class Command(object):
             if (target is not None) and (target.jid != user.jid):
                 possibleCommands.extend([_(COMMANDS, 'command_pay'), _(COMMANDS, 'command_confirm'), _(COMMANDS, 'command_cancel')])
             elif (target is None):
-                possibleCommands.extend([_(COMMANDS, 'command_confirm'), _(COMMANDS, 'command_cancel')])
+                possibleCommands.extend([_(COMMANDS, 'command_batch'), _(COMMANDS, 'command_confirm'), _(COMMANDS, 'command_cancel')])
+            if (target is None) and user.isAdmin():
+                possibleCommands.extend([_(COMMANDS, 'command_'+action) for action in ADMIN_ACTIONS])
             reply = _(COMMANDS, 'command_list_prompt').format(lst=', '.join(possibleCommands))
             if target is None:
                 reply += ' ' + _(COMMANDS, 'command_list_prompt_address')
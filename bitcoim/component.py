@@ -5,26 +5,76 @@ from address import Address
 from addressable import Addressable, generate as generateAddressable
 from bitcoim import LIB_NAME, LIB_DESCRIPTION, LIB_VERSION
 from bitcoin.address import InvalidBitcoinAddressError
-from bitcoin.controller import Controller
 from command import Command, parse as parseCommand, CommandError, \
                     CommandSyntaxError, CommandTargetError, \
                     AmbiguousCommandError, UnknownCommandError
+from context import Context, activate
 from datetime import datetime
-from i18n import _, COMMANDS, DISCO, REGISTRATION, ROSTER
+from i18n import _, COMMANDS, DISCO, LIMITS, REGISTRATION, ROSTER, TX
 from jid import JID
-from logging import debug, info, warning
+from logging import debug, info, warning, exception
+from outbound import OutboundBuffer
+from ratelimit import RateLimiter, LoadShedder, prune as pruneRateLimits, \
+                      RATE, BURST, EXPENSIVE_RATE, EXPENSIVE_BURST, \
+                      PRUNE_INTERVAL
+from rpc import Controller, WalletUnavailableError
+import state
+from templates import TemplateCache, discoInfo, field
+from time import time
+from zlib import crc32
 from useraccount import UserAccount, AlreadyRegisteredError, UnknownUserError,\
                         UsernameNotAvailableError
 from xmpp.browser import Browser
 from xmpp.client import Component as XMPPComponent
-from xmpp.jep0106 import JIDDecode
+from xmpp.jep0106 import JIDDecode, JIDEncode
 from xmpp.protocol import Message, Iq, Presence, NodeProcessed, \
                           Error, ErrorNode, \
                           NS_IQ, NS_MESSAGE, NS_PRESENCE, NS_DISCO_INFO, \
                           NS_DISCO_ITEMS, NS_GATEWAY, NS_REGISTER, \
-                          NS_NICK, NS_VERSION, NS_LAST, NS_VCARD
+                          NS_NICK, NS_VERSION, NS_LAST, NS_VCARD, NS_SEARCH
 from xmpp.simplexml import Node
 
+def registrationForm(registered):
+    '''Build the template of the registration form.'''
+    instructions = Node('instructions')
+    username = Node('username')
+    if registered:
+        instructions.setData(_(REGISTRATION, 'set_username'))
+        username.setData(field('username'))
+    else:
+        instructions.setData(_(REGISTRATION, 'introduction'))
+    reply = Iq(typ='result', queryNS=NS_REGISTER)
+    query = reply.getTag('query')
+    if registered:
+        query.addChild('registered')
+    query.addChild(node=instructions)
+    query.addChild(node=username)
+    return reply
+
+def searchForm():
+    '''Build the template of the search form (XEP-0055).'''
+    reply = Iq(typ='result', queryNS=NS_SEARCH)
+    query = reply.getTag('query')
+    query.addChild('instructions', payload=[_(DISCO, 'search_instructions')])
+    query.addChild('nick')
+    return reply
+
+def gatewayPrompt():
+    '''Build the template of the reply to jabber:iq:gateway queries.'''
+    reply = Iq(typ='result', queryNS=NS_GATEWAY)
+    query = reply.getTag('query')
+    query.addChild('desc', payload=[_(ROSTER, 'address2jid_description')])
+    query.addChild('prompt', payload=[_(ROSTER, 'address2jid_prompt')])
+    return reply
+
+def vCard():
+    '''Build the template of the gateway's vCard.'''
+    reply = Iq(typ='result')
+    query = reply.addChild('vCard', namespace=NS_VCARD)
+    query.addChild('FN', payload=["%s v%s" % (LIB_NAME, LIB_VERSION)])
+    query.addChild('DESC', payload=[LIB_DESCRIPTION])
+    return reply
+
 class Component(Addressable, XMPPComponent):
     '''The component itself.'''
 
@@ -36,38 +86,160 @@ class Component(Addressable, XMPPComponent):
            - Send initial presence broadcasts to all users, from the gateway
              and from each of their "contacts" (bitcoin addresses)
         '''
-        JID.domain = jid
+        self.context = Context(jid, self)
+        activate(self.context)
         self.last = datetime.now()
         self.jid = jid
+        self.shard = (0, 1)
         self.password = password
         self.connectedUsers = set()
+        self.sentPresences = {}
+        self.presencesSuppressed = 0
+        self.lastSeen = {}
+        self.statePath = None
+        self.periodicTasks = []
+        self.rateLimits = {'default': RateLimiter(RATE, BURST),
+                           'expensive': RateLimiter(EXPENSIVE_RATE, EXPENSIVE_BURST)}
+        self.loadShedder = LoadShedder()
+        self.runtime = None
+        self.profiler = None
+        self.capture = None
+        self.offloader = None
+        self.outbound = OutboundBuffer()
+        self.paymentWorker = None
+        self.addressPool = None
+        self.addPeriodicTask(PRUNE_INTERVAL, pruneRateLimits)
         XMPPComponent.__init__(self, server, port, debug=debuglevel, \
                                domains=[jid])
+        self.templates = TemplateCache(self.Namespace)
 
     def start(self, proxy=None):
+        activate(self.context)
+        if self.offloader is not None:
+            self.offloader.start(self)
         if not self.connect(None, proxy):
             raise Exception(_('Console', 'cannot_connect').format(server=self.Server, port=self.Port))
         if not self.auth(self.jid, self.password):
             raise Exception(_('Console', 'cannot_auth').format(jid=self.jid))
         self._RegisterHandlers()
+        if self.outbound is not None:
+            self.outbound.start(self)
+        if self.runtime is not None:
+            self.runtime.start(self)
+        if self.paymentWorker is not None:
+            self.paymentWorker.start(self)
+        if self.addressPool is not None:
+            self.addressPool.start(self)
+        if self.statePath is not None:
+            self.addPeriodicTask(state.SAVE_INTERVAL, state.save)
+            if state.restore(self):
+                return
         debug("Sending initial presence to all contacts...")
+        try:
+            received = UserAccount.getAllReceived()
+        except WalletUnavailableError:
+            warning("The wallet is unavailable, the presences won't show the amounts received")
+            received = None
         for jid in UserAccount.getAllMembers():
+            if not self.isInShard(jid):
+                continue
             self.send(Presence(to=jid, frm=self.jid, typ='probe'))
             user = UserAccount(JID(jid))
             self.sendBitcoinPresence(self, user)
-            for addr in user.getRoster():
-                Address(JID(addr)).sendBitcoinPresence(self, user)
+            self.sendRosterPresences(user, received)
 
     def _RegisterHandlers(self):
         '''Define the Service Discovery information for automatic handling
            by the xmpp library.
         '''
-        self.RegisterHandler(NS_MESSAGE, self.messageHandler)
-        self.RegisterHandler(NS_PRESENCE, self.presenceHandler)
-        self.RegisterHandler(NS_IQ, self.iqHandler)
+        for (name, handler) in [(NS_MESSAGE, self.messageHandler),
+                                (NS_PRESENCE, self.presenceHandler),
+                                (NS_IQ, self.iqHandler)]:
+            if self.profiler is not None:
+                handler = self.profiler.wrap(handler)
+            if self.runtime is not None:
+                handler = self.runtime.defer(handler)
+            if self.capture is not None:
+                handler = self.capture.wrap(handler)
+            self.RegisterHandler(name, handler)
+        self.RegisterCycleHandler(self.cycleHandler)
         browser = Browser()
         browser.PlugIn(self)
-        browser.setDiscoHandler(self.discoHandler)
+        handler = self.discoHandler
+        if self.profiler is not None:
+            handler = self.profiler.wrap(handler)
+        if self.capture is not None:
+            handler = self.capture.wrap(handler)
+        browser.setDiscoHandler(handler)
+
+    def isInShard(self, jid):
+        '''When several components share the registered users, each of them
+           takes care of a shard: return whether the given (bare) JID belongs
+           to this component's shard. The `shard` attribute is a tuple
+           (index, number of shards).'''
+        (index, count) = self.shard
+        return index == crc32(jid.encode('utf-8')) % count
+
+    def addPeriodicTask(self, interval, task):
+        '''Have task(component) called every `interval` seconds. Tasks are
+           run from the component's main loop, between two stanzas, so they
+           should return quickly.'''
+        self.periodicTasks.append([interval, time() + interval, task])
+
+    def cycleHandler(self, dispatcher):
+        '''Called by the dispatcher at the beginning of each Process() loop.
+           Run the periodic tasks that are due.'''
+        activate(self.context)
+        now = time()
+        for task in self.periodicTasks:
+            if task[1] <= now:
+                task[1] = now + task[0]
+                try:
+                    task[2](self)
+                except Exception:
+                    exception("Periodic task %s failed" % task[2])
+
+    def admit(self, cnx, stanza, expensive=False):
+        '''Apply the sender's rate limits to a stanza, and for expensive
+           requests, the global load shedding. If the stanza is refused, a
+           "resource-constraint" error is sent back (presences are simply
+           dropped) and NodeProcessed is raised. Otherwise, expensive requests
+           count as in flight until release() is called.'''
+        sender = stanza.getFrom().getStripped()
+        if not self.rateLimits['default'].allow(sender):
+            reason = 'error_rate_limited'
+        elif expensive and not self.rateLimits['expensive'].allow(sender):
+            reason = 'error_rate_limited'
+        elif expensive and not self.loadShedder.acquire():
+            reason = 'error_overloaded'
+        else:
+            return
+        debug("Refusing a %s stanza from %s (%s)" % (stanza.getName(), sender, reason))
+        if stanza.getType() in ['error', 'result']:
+            raise NodeProcessed
+        if isinstance(stanza, Iq):
+            reply = stanza.buildReply(typ='error')
+        elif isinstance(stanza, Message):
+            reply = stanza.buildReply()
+            reply.setType('error')
+        else:
+            raise NodeProcessed
+        reply.addChild(node=ErrorNode('resource-constraint', 500, 'wait', _(LIMITS, reason)))
+        cnx.send(reply)
+        raise NodeProcessed
+
+    def walletUnavailable(self, cnx, iq):
+        '''Reply to an IQ that couldn't be handled because the wallet is
+           unavailable.'''
+        debug("The wallet is unavailable, can't answer %s" % iq.getID())
+        reply = iq.buildReply(typ='error')
+        reply.addChild(node=ErrorNode('service-unavailable', 503, 'wait', _(TX, 'error_wallet_unavailable')))
+        cnx.send(reply)
+        raise NodeProcessed
+
+    def release(self):
+        '''An expensive request that was admitted is done.'''
+        self.loadShedder.release()
 
     def discoHandler(self, cnx, iq, what):
         '''Dispatcher for disco queries addressed to any JID hosted at the
@@ -77,69 +249,172 @@ class Component(Addressable, XMPPComponent):
            their username. If you're an admin, you can additionally query them
            from their real JID, in any case.
         '''
+        activate(self.context)
+        self.admit(cnx, iq)
         fromUser = UserAccount(iq.getFrom())
-        target = generateAddressable(iq.getTo(), [self], fromUser)
-        if target is not None:
-            return target.discoReceived(fromUser, what, iq.getQuerynode())
+        try:
+            # Telling an address from a username asks the wallet.
+            target = generateAddressable(iq.getTo(), [self], fromUser)
+            if target is not None:
+                node = iq.getQuerynode()
+                template = target.discoTemplate(fromUser, what, node)
+                if template is not None:
+                    (name, fields) = template
+                    builder = lambda: discoInfo(node, target.discoReceived(fromUser, what, node), fields)
+                    cnx.send(self.templates.reply(name, iq, builder, **fields))
+                    raise NodeProcessed
+                return target.discoReceived(fromUser, what, node)
+        except WalletUnavailableError:
+            self.walletUnavailable(cnx, iq)
         # otherwise the default handler will send a "not supported" error
 
     def iqHandler(self, cnx, iq):
         '''IQ received'''
-        fromUser = UserAccount(iq.getFrom())
-        target = generateAddressable(iq.getTo(), [self], fromUser)
-        if target is not None:
-            return target.iqReceived(cnx, iq)
+        activate(self.context)
+        queries = iq.getChildren()
+        expensive = (0 != len(queries)) and (NS_VCARD == queries[0].getNamespace())
+        self.admit(cnx, iq, expensive)
+        try:
+            fromUser = UserAccount(iq.getFrom())
+            target = generateAddressable(iq.getTo(), [self], fromUser)
+            if target is not None:
+                return target.iqReceived(cnx, iq)
+        except WalletUnavailableError:
+            self.walletUnavailable(cnx, iq)
+        finally:
+            if expensive:
+                self.release()
         # otherwise the default handler will send a "not supported" error
 
     def messageHandler(self, cnx, msg):
         '''Message received'''
+        activate(self.context)
+        (action, args) = parseCommand(msg.getBody() or '')
+        expensive = (action is not None) and Command(action).isExpensive()
+        self.admit(cnx, msg, expensive)
+        try:
+            return self.dispatchMessage(cnx, msg)
+        finally:
+            if expensive:
+                self.release()
+
+    def dispatchMessage(self, cnx, msg):
+        '''Give a message to its recipient, and send back the errors raised
+           by the command it contains, if any.'''
         fromUser = UserAccount(msg.getFrom())
-        target = generateAddressable(msg.getTo(), [self], fromUser)
-        if target is not None:
-            try:
-                return target.messageReceived(cnx, msg)
-            except CommandTargetError, reason:
-                error = reason
-            except AmbiguousCommandError, e:
-                args = list(e.args)
-                error = _(COMMANDS, 'ambiguous_command').format(command=args.pop(0), matches=', '.join(args[0]))
-            except UnknownCommandError, command:
-                error = (_(COMMANDS, 'unknown_command').format(command=command))
-            except CommandSyntaxError, reason:
-                error = reason
-            except CommandError, reason:
-                error = reason
-            msg = msg.buildReply(_(COMMANDS, 'error_message').format(\
-                                   message=error))
-            msg.setType('chat')
-            cnx.send(msg)
-            raise NodeProcessed
-        # otherwise the default handler will send a "not supported" error
+        try:
+            # Telling an address from a username asks the wallet.
+            target = generateAddressable(msg.getTo(), [self], fromUser)
+            if target is None:
+                # the default handler will send a "not supported" error
+                return
+            return target.messageReceived(cnx, msg)
+        except CommandTargetError, reason:
+            error = reason
+        except AmbiguousCommandError, e:
+            args = list(e.args)
+            error = _(COMMANDS, 'ambiguous_command').format(command=args.pop(0), matches=', '.join(args[0]))
+        except UnknownCommandError, command:
+            error = (_(COMMANDS, 'unknown_command').format(command=command))
+        except CommandSyntaxError, reason:
+            error = reason
+        except CommandError, reason:
+            error = reason
+        except WalletUnavailableError:
+            error = _(TX, 'error_wallet_unavailable')
+        msg = msg.buildReply(_(COMMANDS, 'error_message').format(\
+                               message=error))
+        msg.setType('chat')
+        cnx.send(msg)
+        raise NodeProcessed
 
     def presenceHandler(self, cnx, prs):
-        '''Presence received.'''
+        '''Presence received. Presences sent by the users' servers when they
+           log in or out are not rate limited.'''
+        activate(self.context)
+        if prs.getType() not in [None, 'available', 'unavailable']:
+            self.admit(cnx, prs)
         fromUser = UserAccount(prs.getFrom())
-        target = generateAddressable(prs.getTo(), [self], fromUser)
-        if target is not None:
-            return target.presenceReceived(cnx, prs)
+        try:
+            target = generateAddressable(prs.getTo(), [self], fromUser)
+            if target is not None:
+                return target.presenceReceived(cnx, prs)
+        except WalletUnavailableError:
+            debug("The wallet is unavailable, ignoring a presence from %s" % fromUser)
+            raise NodeProcessed
         # otherwise the default handler will send a "not supported" error
 
     def sayGoodbye(self):
-        '''Ending method. Doesn't do anything interesting yet.'''
+        '''Ending method. Let the workers finish their job, if any, then tell
+           the connected users we're leaving.'''
+        activate(self.context)
+        if self.runtime is not None:
+            self.runtime.stop()
+        if self.offloader is not None:
+            self.offloader.stop()
+        if self.paymentWorker is not None:
+            self.paymentWorker.stop()
+            self.paymentWorker.deliver(self)
+        if self.addressPool is not None:
+            self.addressPool.stop()
+        if self.statePath is not None:
+            state.save(self)
+        if self.capture is not None:
+            self.capture.close()
         message = _(ROSTER, 'announce_disconnect')
         for user in self.connectedUsers:
-            self.send(Presence(to=user.jid, frm=self.jid, typ='unavailable', status=message))
+            self.sendPresence(Presence(to=user.jid, frm=self.jid, typ='unavailable', status=message))
             for addr in user.getRoster():
-                self.send(Presence(to=user.jid, frm=addr, typ='unavailable', status=message))
+                self.sendPresence(Presence(to=user.jid, frm=addr, typ='unavailable', status=message))
         debug("Bye.")
         self.send('</stream:stream>')
+        if self.outbound is not None:
+            self.outbound.stop()
+
+    def sendBitcoinPresence(self, cnx, user, force=False):
+        '''Send a presence information to the user, from the component. Unless
+           force is True, it's not sent if it's the same as the last one.'''
+        if not user.isRegistered():
+            return
+        try:
+            status = _(ROSTER, 'current_balance').format(nick=user.username, amount=user.getBalance(cached=True))
+        except WalletUnavailableError:
+            status = _(ROSTER, 'wallet_unavailable')
+        self.sendPresence(Presence(to=user.jid, typ='available', show='online', status=status, frm=self.jid), force)
 
-    def sendBitcoinPresence(self, cnx, user):
-        '''Send a presence information to the user, from the component.'''
+    def sendRosterPresences(self, user, received=None):
+        '''Send the user a presence from each address in their roster. The
+           amounts received on the user's addresses are fetched once for all
+           of them, unless `received` (the result of
+           UserAccount.getAllReceived()) is given.'''
         if not user.isRegistered():
             return
-        status = _(ROSTER, 'current_balance').format(nick=user.username, amount=user.getBalance())
-        self.send(Presence(to=user.jid, typ='available', show='online', status=status, frm=self.jid))
+        received = user.getReceivedByAddress(received)
+        for jid in user.getRoster():
+            Address(JID(jid)).sendBitcoinPresence(self, user, received=received)
+
+    def sendPresence(self, prs, force=False):
+        '''Send a presence stanza sent from one of our JIDs, and remember the
+           last available presence sent from each of them to each user, with
+           a fingerprint of its content. If the same available presence was
+           already sent, don't send it again, unless force is True (e.g. when
+           answering a probe). Presences of other types make us forget it.'''
+        key = (JID(prs.getFrom()).getStripped(), JID(prs.getTo()).getStripped())
+        self.context.lock.acquire()
+        try:
+            if prs.getType() in [None, 'available']:
+                status = prs.getStatus()
+                content = u'%s|%s|%s' % (prs.getShow(), prs.getPriority(), status)
+                fingerprint = crc32(content.encode('utf-8'))
+                if not force and (fingerprint == self.sentPresences.get(key, (None,))[0]):
+                    self.presencesSuppressed += 1
+                    return
+                self.sentPresences[key] = (fingerprint, status)
+            else:
+                self.sentPresences.pop(key, None)
+        finally:
+            self.context.lock.release()
+        self.send(prs)
 
     def addAddressToRoster(self, address, user):
         '''Add the JID corresponding to a given bitcoin address to user's
@@ -155,7 +430,7 @@ class Component(Addressable, XMPPComponent):
             if node is None:
                 ids = [{'category': 'gateway', 'type': 'bitcoin',
                         'name':LIB_DESCRIPTION}]
-                return {'ids': ids, 'features': [NS_DISCO_INFO, NS_DISCO_ITEMS, NS_REGISTER, NS_VERSION, NS_GATEWAY, NS_LAST]}
+                return {'ids': ids, 'features': [NS_DISCO_INFO, NS_DISCO_ITEMS, NS_REGISTER, NS_VERSION, NS_GATEWAY, NS_LAST, NS_SEARCH]}
             elif 'users' == node:
                 ids = [{'category': 'directory', 'type': 'user', 'name': _(DISCO, 'user_list')}]
                 return {'ids': ids, 'features': [NS_DISCO_INFO, NS_DISCO_ITEMS]}
@@ -176,6 +451,10 @@ class Component(Addressable, XMPPComponent):
                         items.append({'jid': member.getLocalJID(), 'name': name})
             return items
 
+    def discoTemplate(self, user, what, node):
+        if ('info' == what) and (node in [None, 'users']):
+            return (('disco-gateway', node), {})
+
     def messageReceived(self, cnx, msg):
         '''Message received, addressed to the component. The command execution
            can raise exceptions, but those will be taken care of by the
@@ -192,8 +471,12 @@ class Component(Addressable, XMPPComponent):
                     return
                 msg = msg.buildReply(Command(action, args).execute(user))
                 msg.setType('chat')
-                if user.checkBalance() is not None:
-                    self.sendBitcoinPresence(cnx, user)
+                # The command was executed: its reply must be sent anyway.
+                try:
+                    if user.checkBalance() is not None:
+                        self.sendBitcoinPresence(cnx, user)
+                except WalletUnavailableError:
+                    debug("Couldn't check the balance of %s after a command" % user)
         else:
             error = _(REGISTRATION, 'error_not_registered')
             msg = msg.buildReply(_(COMMANDS, 'error_message').format(message=error))
@@ -214,7 +497,7 @@ class Component(Addressable, XMPPComponent):
         typ = prs.getType()
         if typ == 'subscribe':
             cnx.send(Presence(typ='subscribed', frm=to, to=user.jid))
-            self.sendBitcoinPresence(cnx, user)
+            self.sendBitcoinPresence(cnx, user, force=True)
         elif typ == 'subscribed':
             debug('We were allowed to see %s\'s presence.' % user)
         elif typ == 'unsubscribe':
@@ -222,7 +505,7 @@ class Component(Addressable, XMPPComponent):
         elif typ == 'unsubscribed':
             debug('Unsubscribed. Any interest in this information?')
         elif typ == 'probe':
-            self.sendBitcoinPresence(cnx, user)
+            self.sendBitcoinPresence(cnx, user, force=True)
         elif (typ == 'available') or (typ is None):
             self.userResourceConnects(user, resource)
         elif typ == 'unavailable':
@@ -248,22 +531,13 @@ class Component(Addressable, XMPPComponent):
                     self.registrationRequested(iq)
                 raise NodeProcessed
             elif 'get' == typ:
-                instructions = Node('instructions')
-                username = Node('username')
                 user = UserAccount(iq.getFrom())
-                registered = user.isRegistered()
-                if registered:
-                    instructions.setData(_(REGISTRATION, 'set_username'))
-                    username.setData(user.username)
+                if user.isRegistered():
+                    reply = self.templates.reply('register-registered', iq, \
+                                lambda: registrationForm(True), username=user.username)
                 else:
                     debug("A new user is preparing a registration")
-                    instructions.setData(_(REGISTRATION, 'introduction'))
-                reply = iq.buildReply('result')
-                query = reply.getQuery()
-                if registered:
-                    query.addChild('registered')
-                query.addChild(node=instructions)
-                query.addChild(node=username)
+                    reply = self.templates.reply('register', iq, lambda: registrationForm(False))
                 cnx.send(reply)
                 raise NodeProcessed
             else:
@@ -271,11 +545,7 @@ class Component(Addressable, XMPPComponent):
                 debug("Unknown IQ with ns '%s' and type '%s'." % (ns, typ))
         elif NS_GATEWAY == ns:
             if 'get' == typ:
-                reply = iq.buildReply('result')
-                query = reply.getQuery()
-                query.addChild('desc', payload=[_(ROSTER, 'address2jid_description')])
-                query.addChild('prompt', payload=[_(ROSTER, 'address2jid_prompt')])
-                cnx.send(reply)
+                cnx.send(self.templates.reply('gateway', iq, gatewayPrompt))
                 raise NodeProcessed
             elif 'set' == typ:
                 children = iq.getQueryChildren()
@@ -300,26 +570,56 @@ class Component(Addressable, XMPPComponent):
                     raise NodeProcessed
         elif NS_VCARD == ns:
             if 'get' == typ:
-                reply = iq.buildReply('result')
-                query = reply.getQuery()
-                query.addChild('FN', payload=["%s v%s" % (LIB_NAME, LIB_VERSION)])
-                query.addChild('DESC', payload=[LIB_DESCRIPTION])
-                cnx.send(reply)
+                cnx.send(self.templates.reply('vcard', iq, vCard))
                 raise NodeProcessed
+        elif NS_SEARCH == ns:
+            if typ in ['get', 'set']:
+                self.searchRequested(cnx, iq)
         Addressable.iqReceived(self, cnx, iq)
 
+    def searchRequested(self, cnx, iq):
+        '''A user search (XEP-0055) was received. Only registered users may
+           search. Users are found by the beginning of their username, and
+           are given by their local JID, not their real one.'''
+        if not UserAccount(iq.getFrom()).isRegistered():
+            reply = iq.buildReply(typ='error')
+            reply.addChild(node=ErrorNode('registration-required', 407, 'auth', _(REGISTRATION, 'error_not_registered')))
+            cnx.send(reply)
+            raise NodeProcessed
+        if 'get' == iq.getType():
+            cnx.send(self.templates.reply('search', iq, searchForm))
+            raise NodeProcessed
+        prefix = iq.getTag('query').getTagData('nick') or ''
+        if 0 == len(prefix.strip()):
+            reply = iq.buildReply(typ='error')
+            reply.addChild(node=ErrorNode('bad-request', 400, 'modify', _(DISCO, 'error_search_empty')))
+            cnx.send(reply)
+            raise NodeProcessed
+        reply = iq.buildReply('result')
+        query = reply.getQuery()
+        for username in UserAccount.search(prefix):
+            item = query.addChild('item', {'jid': JID(node=JIDEncode(username))})
+            item.addChild('nick', payload=[username])
+        cnx.send(reply)
+        raise NodeProcessed
+
     def userResourceConnects(self, user, resource):
         '''Called when the component receives a presence"available" from a
            user. This method first registers the resource. Then, if it's the
            user's first online resource: sends them a presence packet, and
            internally adds them to the list of online users.'''
         debug("New resource (%s) for user %s" % (resource, user))
-        user.resourceConnects(resource)
-        if not user in self.connectedUsers:
-            self.sendBitcoinPresence(self, user)
+        self.context.lock.acquire()
+        try:
+            user.resourceConnects(resource)
+            self.lastSeen[user.jid] = time()
+            connects = user not in self.connectedUsers
             self.connectedUsers.add(user)
-            for jid in user.getRoster():
-                Address(JID(jid)).sendBitcoinPresence(self, user)
+        finally:
+            self.context.lock.release()
+        if connects:
+            self.sendBitcoinPresence(self, user)
+            self.sendRosterPresences(user)
 
     def userResourceDisconnects(self, user, resource):
         '''Called when the component receives a presence "unavailable" from
@@ -327,14 +627,21 @@ class Component(Addressable, XMPPComponent):
            user has no more online resource, sends them an "unavailable" presence,
            and internally removes them from the list of online users.'''
         debug("Resource %s of user %s went offline" % (resource, user))
-        user.resourceDisconnects(resource)
-        if (user in self.connectedUsers) and (0 == len(user.resources)):
+        self.context.lock.acquire()
+        try:
+            user.resourceDisconnects(resource)
+            self.lastSeen[user.jid] = time()
+            disconnects = (user in self.connectedUsers) and (0 == len(user.resources))
+            if disconnects:
+                self.connectedUsers.remove(user)
+        finally:
+            self.context.lock.release()
+        if disconnects:
             jid = JID(user.jid)
             jid.setResource(resource=resource)
-            self.send(Presence(typ='unavailable', frm=self.jid, to=jid))
-            self.connectedUsers.remove(user)
+            self.sendPresence(Presence(typ='unavailable', frm=self.jid, to=jid))
             for address in user.getRoster():
-                self.send(Presence(typ='unavailable', frm=address, to=jid))
+                self.sendPresence(Presence(typ='unavailable', frm=address, to=jid))
 
     def registrationRequested(self, iq):
         '''A registration request was received. If an invalid username is
@@ -391,4 +698,4 @@ class Component(Addressable, XMPPComponent):
         self.send(iq.buildReply('result'))
         self.send(Presence(to=user.jid, frm=self.jid, typ='unsubscribe'))
         self.send(Presence(to=user.jid, frm=self.jid, typ='unsubscribed'))
-        self.send(Presence(to=user.jid, frm=self.jid, typ='unavailable', status=_(REGISTRATION, 'bye')))
+        self.sendPresence(Presence(to=user.jid, frm=self.jid, typ='unavailable', status=_(REGISTRATION, 'bye')))
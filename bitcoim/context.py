@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Several components may run in the same process. What depends on the
+   component (its domain, the users it knows about) is held by a Context,
+   and the context of the component doing the current job is given by
+   current(). Outside of any component, a default context is used.'''
+
+from threading import local, RLock
+
+class Context(object):
+    '''The state of a component that other objects need to know about:
+       - domain: the component's domain, used by JID() when no domain is
+         given.
+       - component: the component itself, if any.
+       - cacheByJID, cacheByUsername: the UserAccount instances.
+       - hits, misses: how many UserAccount lookups were answered by the
+         caches, and how many needed the database or a new instance.
+       - lock: held while the caches, or the component's online users and
+         the presences sent to them, are read or changed, since several
+         threads may do so (see runtime.py).'''
+
+    def __init__(self, domain='', component=None):
+        self.domain = domain
+        self.component = component
+        self.cacheByJID = {}
+        self.cacheByUsername = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = RLock()
+
+default = Context()
+
+_local = local()
+
+def current():
+    '''Return the context activated in this thread, or the default one.'''
+    return getattr(_local, 'context', default)
+
+def activate(context):
+    '''Make `context` the current context of this thread.'''
+    _local.context = context
@@ -1,8 +1,118 @@
 # -*- coding: utf-8 -*-
 # vi: sts=4 et sw=4
 
-from logging import info
-from sqlite3 import connect, OperationalError, Row, PARSE_DECLTYPES, PARSE_COLNAMES
+from collections import deque
+from datetime import datetime
+from logging import info, warning
+from os.path import basename
+from profiling import record
+from re import compile as re_compile
+from sqlite3 import connect, Error, OperationalError, Row, PARSE_DECLTYPES, PARSE_COLNAMES
+from threading import local, Lock
+from time import time
+from traceback import extract_stack
+
+SLOW_QUERY_THRESHOLD = 0.05
+'''Statements taking longer than this (in seconds) are logged as slow'''
+
+SLOW_QUERIES_KEPT = 50
+'''Number of slow statements the query log remembers'''
+
+_literals = re_compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_lists = re_compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_spaces = re_compile(r"\s+")
+
+def normalize(statement):
+    '''Return the statement with its literal values replaced by "?" and
+       the lists of values collapsed, so that statements which only differ
+       by their values are counted together.'''
+    statement = _literals.sub('?', statement)
+    statement = _lists.sub('(...)', statement)
+    return _spaces.sub(' ', statement).strip()
+
+def callSite():
+    '''Return the place, outside this module, where a statement was run.'''
+    for (filename, line, function, text) in reversed(extract_stack()):
+        if basename(filename) not in ['db.py', 'db.pyc']:
+            return "%s:%s (%s)" % (basename(filename), line, function)
+    return None
+
+
+class QueryLog(object):
+    '''Statistics about the statements run through SQL, per normalized
+       statement, and the latest slow statements with their query plan and
+       call site. Set SQL.queryLog to use it.'''
+
+    def __init__(self, threshold=SLOW_QUERY_THRESHOLD, kept=SLOW_QUERIES_KEPT):
+        self.threshold = threshold
+        self.lock = Lock()
+        self.reset(kept)
+
+    def reset(self, kept=None):
+        '''Forget everything that was logged.'''
+        if kept is None:
+            kept = self.slow.maxlen
+        self.stats = {}
+        self.slow = deque(maxlen=kept)
+
+    def record(self, sql, statement, args, duration):
+        '''Note that `statement` took `duration` seconds on the connection
+           `sql`.'''
+        normalized = normalize(statement)
+        self.lock.acquire()
+        try:
+            try:
+                stats = self.stats[normalized]
+            except KeyError:
+                stats = self.stats[normalized] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+        finally:
+            self.lock.release()
+        if duration >= self.threshold:
+            plan = self.explain(sql, statement, args)
+            site = callSite()
+            warning("Slow SQL statement (%.3fs) at %s: %s" % (duration, site, normalized))
+            self.slow.append((datetime.now(), duration, normalized, site, plan))
+
+    def explain(self, sql, statement, args):
+        '''Return the query plan of a statement, as a list of lines. The
+           statement isn't run, and the results of the SQL object's cursor
+           are left untouched.'''
+        if statement.split(None, 1)[0].lower() not in ['select', 'insert', 'update', 'delete']:
+            return []
+        try:
+            rows = sql.conn.execute('EXPLAIN QUERY PLAN ' + statement, *args).fetchall()
+        except Error, e:
+            return ['(%s)' % e]
+        return [row[-1] for row in rows]
+
+    def top(self, count=10):
+        '''Return the `count` statements that took the most time in total,
+           as tuples (statement, count, total, max).'''
+        self.lock.acquire()
+        try:
+            stats = [(statement, s[0], s[1], s[2]) for (statement, s) in self.stats.iteritems()]
+        finally:
+            self.lock.release()
+        stats.sort(key=lambda s: -s[2])
+        return stats[:count]
+
+def timed(sql):
+    '''Wrap the execute() method of the SQL object's cursor to note how
+       long statements take (see profiling.record() and SQL.queryLog).'''
+    execute = sql.cursor.execute
+    def timedExecute(statement, *args):
+        start = time()
+        try:
+            return execute(statement, *args)
+        finally:
+            duration = time() - start
+            record('sql', statement, duration)
+            if SQL.queryLog is not None:
+                SQL.queryLog.record(sql, statement, args, duration)
+    return timedExecute
 
 class SQL(object):
     '''
@@ -11,52 +121,68 @@ class SQL(object):
     If you simply call SQL(), any connection will be used.
     Obviously, you need to provide an URL on the first call at least. If
     you don't, None will be returned.
+    Connections are never shared between threads: each thread gets its own
+    connection to each URL, made the first time it needs it. Note that an
+    in-memory database (":memory:") is thus different for each thread.
+    Set SQL.queryLog to a QueryLog to keep statistics about the statements.
     '''
-    cache = {}
+    urls = []
+    local = local()
+    queryLog = None
 
     def __new__(cls, url=None):
         '''The first time a given URL is given, the connection is made and
            stored in a cache. On subsequent calls (with the same URL), it
            will be reused.
-           If no URL is given, assume we can use any cached connection (if
-           there's no cached connection, return None).
+           If no URL is given, assume we can use any URL already given (if
+           there's none, return None).
         '''
         if url is None:
             try:
-                url = cls.cache.keys()[0]
+                url = cls.urls[0]
             except IndexError:
                 return None
-        if (url not in cls.cache):
-            cls.cache[url] = object.__new__(cls)
-            cls.cache[url].conn = connect(url, isolation_level=None, detect_types=PARSE_DECLTYPES|PARSE_COLNAMES)
-            cls.cache[url].conn.row_factory = Row
-            cls.cache[url].cursor = cls.cache[url].conn.cursor()
-            cls.cache[url].execute = cls.cache[url].cursor.execute
-            cls.cache[url].commit = cls.cache[url].conn.commit
-            cls.cache[url].close = cls.cache[url].conn.close
-            cls.cache[url].fetchone = cls.cache[url].cursor.fetchone
-            cls.cache[url].fetchall = cls.cache[url].cursor.fetchall
-            cls.cache[url].lastrowid = cls.cache[url].cursor.lastrowid
-        return cls.cache[url]
+        try:
+            cache = cls.local.cache
+        except AttributeError:
+            cache = cls.local.cache = {}
+        if (url not in cache):
+            if url not in cls.urls:
+                cls.urls.append(url)
+            cache[url] = object.__new__(cls)
+            cache[url].conn = connect(url, isolation_level=None, detect_types=PARSE_DECLTYPES|PARSE_COLNAMES)
+            cache[url].conn.row_factory = Row
+            cache[url].cursor = cache[url].conn.cursor()
+            cache[url].execute = timed(cache[url])
+            cache[url].commit = cache[url].conn.commit
+            cache[url].close = cache[url].conn.close
+            cache[url].fetchone = cache[url].cursor.fetchone
+            cache[url].fetchall = cache[url].cursor.fetchall
+            cache[url].lastrowid = cache[url].cursor.lastrowid
+        return cache[url]
 
     @classmethod
     def close(cls, url=None):
+        '''Close the current thread's connection to the given URL (or to
+           any URL) and forget it.'''
         try:
             if url is None:
-                url = cls.cache.keys()[0]
-            cls.cache[url].close()
-            del cls.cache[url]
-        except IndexError:
+                url = cls.urls[0]
+            cls.local.cache.pop(url).close()
+        except (IndexError, AttributeError, KeyError):
             pass # No cached connection, or URL not in cache: nothing to close.
 
 
+LATEST_VERSION = 8
+'''The version of the database structure this module works with'''
+
 class Database(object):
     '''This class represents the bitcoIM database.'''
 
     def __init__(self, url=None):
         self.url = url
 
-    def upgrade(self, new_version):
+    def upgrade(self, new_version=LATEST_VERSION):
         try:
             SQL(self.url).execute("select value from meta where name='db_version'")
             row = SQL(self.url).fetchone()
@@ -96,7 +222,136 @@ class Database(object):
                          PRIMARY KEY (id)
                          )'''
                 SQL(self.url).execute(req)
+            elif 1 == current_version:
+                # Let deleted pages be reclaimed incrementally (see vacuum()).
+                # The setting only applies to an existing database after a
+                # full VACUUM.
+                SQL(self.url).execute('PRAGMA auto_vacuum=INCREMENTAL')
+                SQL(self.url).execute('VACUUM')
+                req = 'CREATE INDEX IF NOT EXISTS payments_date ON payments (date)'
+                SQL(self.url).execute(req)
+            elif 2 == current_version:
+                # Confirmation codes must be unique for each sender. Older
+                # versions didn't check it: make duplicates unique by
+                # appending the entry's id.
+                req = '''UPDATE payments SET confirmation_code=confirmation_code||id
+                         WHERE id NOT IN (SELECT min(id) FROM payments
+                                          GROUP BY from_jid, confirmation_code)'''
+                SQL(self.url).execute(req)
+                req = '''CREATE UNIQUE INDEX IF NOT EXISTS payments_code
+                         ON payments (from_jid, confirmation_code)'''
+                SQL(self.url).execute(req)
+            elif 3 == current_version:
+                # Grouped payment orders: the entry in payments holds the
+                # total amount and the number of items, the recipients are in
+                # payment_items.
+                req = 'ALTER TABLE payments ADD COLUMN items INTEGER NOT NULL DEFAULT 0'
+                SQL(self.url).execute(req)
+                req = '''CREATE TABLE IF NOT EXISTS payment_items (
+                         id INTEGER NOT NULL,
+                         payment_id INTEGER NOT NULL,
+                         recipient varchar(256) NOT NULL,
+                         amount real NOT NULL,
+                         PRIMARY KEY (id)
+                         )'''
+                SQL(self.url).execute(req)
+                req = '''CREATE INDEX IF NOT EXISTS payment_items_payment
+                         ON payment_items (payment_id)'''
+                SQL(self.url).execute(req)
+            elif 4 == current_version:
+                # Local mirror of the wallet (see ledger.py). Moves have no
+                # txid, and the address is empty when there's none, so that
+                # the unique index identifies each entry of a transaction.
+                req = '''CREATE TABLE IF NOT EXISTS ledger (
+                         id INTEGER NOT NULL,
+                         account varchar(256) NOT NULL,
+                         category varchar(16) NOT NULL,
+                         amount real NOT NULL,
+                         fee real NOT NULL,
+                         txid varchar(64),
+                         vout INTEGER NOT NULL,
+                         address varchar(64) NOT NULL,
+                         otheraccount varchar(256),
+                         comment varchar(256),
+                         time INTEGER NOT NULL,
+                         height INTEGER,
+                         PRIMARY KEY (id)
+                         )'''
+                SQL(self.url).execute(req)
+                req = '''CREATE UNIQUE INDEX IF NOT EXISTS ledger_entry
+                         ON ledger (txid, account, category, address, vout)'''
+                SQL(self.url).execute(req)
+                req = '''CREATE INDEX IF NOT EXISTS ledger_account_time
+                         ON ledger (account, time)'''
+                SQL(self.url).execute(req)
+                req = '''CREATE INDEX IF NOT EXISTS ledger_account_other
+                         ON ledger (account, otheraccount, time)'''
+                SQL(self.url).execute(req)
+                req = '''CREATE INDEX IF NOT EXISTS ledger_account_address
+                         ON ledger (account, address, time)'''
+                SQL(self.url).execute(req)
+                req = '''CREATE TABLE IF NOT EXISTS ledger_addresses (
+                         address varchar(64) NOT NULL,
+                         account varchar(256) NOT NULL,
+                         PRIMARY KEY (address)
+                         )'''
+                SQL(self.url).execute(req)
+                req = '''CREATE INDEX IF NOT EXISTS ledger_addresses_account
+                         ON ledger_addresses (account)'''
+                SQL(self.url).execute(req)
+            elif 5 == current_version:
+                # Case-insensitive username search: the lowercase username is
+                # kept in its own indexed column. It's computed by Python,
+                # since SQLite's lower() only knows about ASCII.
+                req = "ALTER TABLE registrations ADD COLUMN username_lower varchar(256) NOT NULL DEFAULT ''"
+                SQL(self.url).execute(req)
+                SQL(self.url).execute('select id, username from registrations')
+                rows = SQL(self.url).fetchall()
+                req = 'update registrations set username_lower=? where id=?'
+                SQL(self.url).execute('begin')
+                SQL(self.url).conn.executemany(req, [(row['username'].lower(), row['id']) \
+                                                     for row in rows])
+                SQL(self.url).execute('commit')
+                req = '''CREATE INDEX IF NOT EXISTS registrations_username_lower
+                         ON registrations (username_lower)'''
+                SQL(self.url).execute(req)
+                req = '''CREATE INDEX IF NOT EXISTS registrations_username
+                         ON registrations (username)'''
+                SQL(self.url).execute(req)
+                req = '''CREATE INDEX IF NOT EXISTS registrations_jid
+                         ON registrations (registered_jid)'''
+                SQL(self.url).execute(req)
+            elif 6 == current_version:
+                # Confirmed payment orders are sent by the payment worker
+                # (see paymentworker.py): they're kept, with their state,
+                # until their receipt is delivered.
+                for column in ["state varchar(16) NOT NULL DEFAULT 'pending'",
+                               'txid varchar(64)',
+                               'error varchar(256)',
+                               'attempts INTEGER NOT NULL DEFAULT 0',
+                               'started real']:
+                    SQL(self.url).execute('ALTER TABLE payments ADD COLUMN ' + column)
+                # The sender comes second, so that the pending payment
+                # orders of a user are found with this index alone.
+                req = '''CREATE INDEX IF NOT EXISTS payments_state
+                         ON payments (state, from_jid)'''
+                SQL(self.url).execute(req)
+            elif 7 == current_version:
+                # Which steps of a payment order being sent were made (see
+                # PaymentOrder.confirm()), as a JSON list.
+                req = 'ALTER TABLE payments ADD COLUMN progress varchar(1024)'
+                SQL(self.url).execute(req)
             current_version += 1
             req = 'update meta set value=? where name=?'
             SQL(self.url).execute(req, (current_version, 'db_version'))
             info("Upgraded to DB version %s" % current_version)
+
+    def vacuum(self, pages=None):
+        '''Give free pages back to the filesystem. If pages is given, only
+           reclaim that many pages at most, so that the call stays short.
+        '''
+        if pages is None:
+            SQL(self.url).execute('PRAGMA incremental_vacuum')
+        else:
+            SQL(self.url).execute('PRAGMA incremental_vacuum(%d)' % pages)
+        SQL(self.url).fetchall()
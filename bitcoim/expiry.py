@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''This module takes care of the payment orders that were never confirmed.'''
+
+from datetime import datetime, timedelta
+from db import SQL, Database
+from i18n import _, TX
+from logging import debug, info
+from paymentorder import STATE_PENDING
+from time import time
+from xmpp.protocol import Message
+
+MAX_AGE = timedelta(days=7)
+'''Pending payment orders older than this are expired'''
+
+BATCH_SIZE = 500
+'''Number of payment orders deleted by each SQL statement'''
+
+VACUUM_EVERY = 24
+'''Run an incremental vacuum every that many expiry runs'''
+
+VACUUM_PAGES = 1000
+'''Maximum number of pages reclaimed by each incremental vacuum'''
+
+class PaymentExpirer(object):
+    '''Expire old pending payment orders. An instance is meant to be given to
+       Component.addPeriodicTask(). Each run deletes the payment orders older
+       than maxAge, batchSize at a time, and sends one message to each sender
+       listing the orders that expired. Every vacuumEvery runs, free pages are
+       given back to the filesystem.
+       The following counters are kept: runs, expired (total number of
+       expired orders), timeSpent (in seconds) and lastRun.
+    '''
+
+    def __init__(self, maxAge=MAX_AGE, batchSize=BATCH_SIZE, vacuumEvery=VACUUM_EVERY):
+        self.maxAge = maxAge
+        self.batchSize = batchSize
+        self.vacuumEvery = vacuumEvery
+        self.runs = 0
+        self.expired = 0
+        self.timeSpent = 0.0
+        self.lastRun = None
+
+    def __call__(self, component):
+        start = time()
+        expired = self.expire()
+        for jid, rows in expired.iteritems():
+            self.notify(component, jid, rows)
+        self.runs += 1
+        if (0 != self.vacuumEvery) and (0 == self.runs % self.vacuumEvery):
+            debug("Reclaiming free pages in the database")
+            Database().vacuum(VACUUM_PAGES)
+        count = sum([len(rows) for rows in expired.itervalues()])
+        elapsed = time() - start
+        self.expired += count
+        self.timeSpent += elapsed
+        self.lastRun = datetime.now()
+        if 0 != count:
+            info("Expired %s payment orders in %.3fs" % (count, elapsed))
+
+    def expire(self):
+        '''Delete the expired payment orders that are still pending and
+           return them, as a dictionary whose keys are the senders' JIDs.'''
+        limit = datetime.now() - self.maxAge
+        expired = {}
+        while True:
+            req = 'select %s, %s, %s, %s, %s, %s, %s, %s from %s where %s<? and %s=? order by %s limit ?' % \
+                  ('id', 'from_jid', 'date', 'recipient', 'amount', 'comment', \
+                   'confirmation_code', 'items', 'payments', 'date', 'state', 'date')
+            SQL().execute(req, (limit, STATE_PENDING, self.batchSize))
+            rows = SQL().fetchall()
+            if 0 == len(rows):
+                break
+            # A payment order may have been confirmed since it was selected:
+            # only the ones still pending are deleted, and reported.
+            deleted = []
+            SQL().execute('begin')
+            try:
+                req = 'delete from %s where %s=? and %s=?' % ('payments', 'id', 'state')
+                for row in rows:
+                    SQL().execute(req, (row['id'], STATE_PENDING))
+                    if 0 != SQL().cursor.rowcount:
+                        deleted.append(row)
+                if deleted:
+                    ids = tuple([row['id'] for row in deleted])
+                    req = 'delete from %s where %s in (%s)' % \
+                          ('payment_items', 'payment_id', ', '.join(['?'] * len(ids)))
+                    SQL().execute(req, ids)
+            except:
+                SQL().execute('rollback')
+                raise
+            SQL().execute('commit')
+            for row in deleted:
+                expired.setdefault(row['from_jid'], []).append(row)
+            if len(rows) < self.batchSize:
+                break
+        return expired
+
+    def notify(self, component, jid, rows):
+        '''Tell the sender that their payment orders expired.'''
+        body = _(TX, 'expired_header')
+        for row in rows:
+            if 0 == row['items']:
+                recipient = row['recipient']
+            else:
+                recipient = _(TX, 'batch_recipients').format(count=row['items'])
+            body += "\n" + _(TX, 'pending_item_global').format(code=row['confirmation_code'],\
+                                                               date=row['date'].date().isoformat(),\
+                                                               amount=row['amount'],\
+                                                               recipient=recipient)
+            if 0 != len(row['comment']):
+                body = _(TX, 'tx_comment').format(message=body, comment=row['comment'])
+        component.send(Message(to=jid, frm=component.jid, typ='chat', body=body))
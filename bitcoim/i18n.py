@@ -5,9 +5,11 @@ from os.path import join as j
 from os import sep
 from sys import prefix
 
+ADMIN = 'Administration'
 COMMANDS = 'Commands'
 DEFAULT = 'DEFAULT'
 DISCO = 'Service discovery'
+LIMITS = 'Limits'
 REGISTRATION = 'Registration'
 ROSTER = 'Roster interaction'
 TX = 'Transactions'
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Local mirror of the wallet's transactions. The transactions of all the
+   accounts are copied into the ledger tables, and kept current with
+   listsinceblock, starting from the last block seen (the cursor, stored in
+   the meta table). Once a Ledger has synced, it's the current one (see
+   current()), and balances, received amounts and history are read from
+   the database instead of being asked to the controller.
+   Moves between accounts don't appear in listsinceblock: the ones made
+   by the gateway are recorded as they're made, as soon as there's a
+   Ledger (see recorder()), and the first sync replaces them with all the
+   moves of the wallet. That first sync imports the wallet's past
+   transactions, which may take a while: it's run by its own thread, on a
+   dedicated connection to the controller with a long timeout, and reads
+   them a page at a time.'''
+
+from db import SQL
+from logging import debug, info, exception
+from rpc import Controller
+from threading import Lock, RLock, Thread
+from time import time
+
+SYNC_INTERVAL = 30
+'''How often (in seconds) the ledger is synced, as a periodic task'''
+
+ADDRESSES_EVERY = 10
+'''Refresh the list of addresses every that many syncs'''
+
+IMPORT_PAGE = 1000
+'''Number of past transactions read by each call of the first sync'''
+
+IMPORT_TIMEOUT = 300
+'''How long (in seconds) the first sync waits for each of its calls to the
+   controller'''
+
+CLOCK_SKEW = 60
+'''A move of the wallet up to that many seconds older than the start of
+   the first sync may be one the gateway recorded meanwhile'''
+
+ENTRY_FIELDS = ('account', 'category', 'amount', 'txid', 'vout', 'address', \
+                'otheraccount', 'time', 'comment')
+'''The fields telling apart the entries returned by listtransactions'''
+
+_current = None
+
+_recorder = None
+
+def current():
+    '''Return the ledger reads are served from, or None if there's none
+       yet.'''
+    return _current
+
+def recorder():
+    '''Return the ledger the moves and addresses made by the gateway are
+       recorded by, or None if there's none. Unlike current(), it doesn't
+       wait for the first sync.'''
+    return _recorder
+
+
+class Ledger(object):
+    '''The local ledger. An instance is meant to be given to
+       Component.addPeriodicTask(), with SYNC_INTERVAL: each run syncs
+       the ledger, except the import, which is started in its own thread.
+       The first successful sync makes it the current one. Creating it
+       makes it record the gateway's moves and addresses.'''
+
+    def __init__(self, addressesEvery=ADDRESSES_EVERY):
+        global _recorder
+        self.addressesEvery = addressesEvery
+        self.lock = RLock()
+        self.syncing = Lock()
+        self.syncs = 0
+        self.importer = None
+        self.height = self.getMeta('ledger_height')
+        if self.height is not None:
+            self.height = int(self.height)
+        _recorder = self
+
+    def __call__(self, component):
+        if self.height is None:
+            if (self.importer is None) or not self.importer.isAlive():
+                self.importer = Thread(target=self.importTransactions, name='bitcoim-ledger')
+                self.importer.setDaemon(True)
+                self.importer.start()
+            return
+        start = time()
+        self.sync(0 == self.syncs % self.addressesEvery)
+        debug("Ledger synced in %.3fs" % (time() - start))
+
+    def importTransactions(self):
+        '''First sync, run by its own thread: if it fails, it's tried again
+           at the next run.'''
+        start = time()
+        try:
+            self.sync(True)
+        except Exception:
+            exception("Couldn't import the wallet's transactions into the ledger")
+            return
+        info("Ledger imported in %.3fs" % (time() - start))
+
+    def getMeta(self, name):
+        SQL().execute('select value from meta where name=?', (name,))
+        row = SQL().fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def setMeta(self, name, value):
+        SQL().execute('update meta set value=? where name=?', (value, name))
+        if 0 == SQL().cursor.rowcount:
+            SQL().execute('insert into meta (name, value) values (?, ?)', (name, value))
+
+    def sync(self, addresses=False):
+        '''Copy the transactions that happened since the last sync. If
+           addresses is True, refresh the list of addresses too. The lock is
+           only held while the database is written to, not during the calls
+           to the controller.'''
+        global _current
+        self.syncing.acquire()
+        try:
+            cursor = self.getMeta('ledger_cursor')
+            if cursor is None:
+                info("Importing the wallet's transactions into the ledger")
+                controller = Controller(timeout=IMPORT_TIMEOUT)
+                mark = self.lastEntry()
+                started = time()
+                result = controller.listsinceblock()
+                moves = self.importMoves(controller)
+                addresses = True
+            else:
+                controller = Controller()
+                result = controller.listsinceblock(cursor)
+            height = controller.getblock(result['lastblock'])['height']
+            if addresses:
+                received = controller.listreceivedbyaddress(0, True)
+            self.lock.acquire()
+            try:
+                SQL().execute('begin')
+                try:
+                    for item in result['transactions']:
+                        self.store(item, height)
+                    if cursor is None:
+                        self.replaceMoves(moves, mark, started, height)
+                    if addresses:
+                        for entry in received:
+                            self.recordAddress(entry['address'], entry['account'])
+                    self.setMeta('ledger_cursor', result['lastblock'])
+                    self.setMeta('ledger_height', height)
+                except:
+                    SQL().execute('rollback')
+                    raise
+                SQL().execute('commit')
+                self.height = height
+            finally:
+                self.lock.release()
+            self.syncs += 1
+            debug("Ledger: %s transactions since %s, now at height %s" % \
+                  (len(result['transactions']), cursor, height))
+        finally:
+            self.syncing.release()
+        if _current is not self:
+            _current = self
+            info("Reading balances and transactions from the ledger")
+
+    def lastEntry(self):
+        '''Return the id of the latest entry of the ledger, 0 if it's empty.
+           The moves made by the gateway are made and recorded holding the
+           lock: the ones made so far are recorded up to that id.'''
+        self.lock.acquire()
+        try:
+            SQL().execute('select coalesce(max(%s), 0) from %s' % ('id', 'ledger'))
+            return SQL().fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def importMoves(self, controller):
+        '''Return the moves of the wallet, reading its transactions
+           IMPORT_PAGE at a time, from the most recent. The transactions
+           that happen meanwhile shift the pages: the entries a page shares
+           with the one read before it are left out.'''
+        key = lambda item: tuple([item.get(field) for field in ENTRY_FIELDS])
+        moves = []
+        previous = []
+        skip = 0
+        while True:
+            page = controller.listtransactions('*', IMPORT_PAGE, skip)
+            keys = [key(item) for item in page]
+            # Each page is oldest first: its end may repeat the start of
+            # the newer one read before.
+            overlap = 0
+            if previous:
+                for (i, itemKey) in enumerate(keys):
+                    count = len(keys) - i
+                    if (itemKey == previous[0]) and (keys[i:] == previous[:count]):
+                        overlap = count
+                        break
+            moves.extend([item for item in page[:len(page) - overlap] \
+                          if 'move' == item['category']])
+            if len(page) < IMPORT_PAGE:
+                return moves
+            previous = keys
+            skip += IMPORT_PAGE
+
+    def replaceMoves(self, moves, mark, started, height):
+        '''Replace the moves recorded before the first sync started, up to
+           the entry `mark` (see lastEntry()), with the moves of the wallet.
+           The moves recorded since then may or may not be among the
+           wallet's: those are left out of the latter.'''
+        req = 'delete from %s where %s=? and %s<=?' % ('ledger', 'category', 'id')
+        SQL().execute(req, ('move', mark))
+        req = 'select %s, %s, %s, %s from %s where %s=? and %s>?' % \
+              ('account', 'otheraccount', 'amount', 'comment', 'ledger', 'category', 'id')
+        SQL().execute(req, ('move', mark))
+        recent = [(row[0], row[1], row[2], row[3] or '') for row in SQL().fetchall()]
+        for item in moves:
+            moveKey = (item.get('account', ''), item.get('otheraccount'), item['amount'], \
+                       item.get('comment') or '')
+            if (item['time'] >= started - CLOCK_SKEW) and (moveKey in recent):
+                recent.remove(moveKey)
+                continue
+            self.store(item, height)
+
+    def store(self, item, height):
+        '''Insert or update a transaction entry, as returned by the
+           controller.'''
+        confirmations = item.get('confirmations', 0)
+        if confirmations > 0:
+            blockHeight = height - confirmations + 1
+        else:
+            blockHeight = None
+        req = '''insert or replace into %s (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                 values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''' % \
+              ('ledger', 'account', 'category', 'amount', 'fee', 'txid', 'vout', \
+               'address', 'otheraccount', 'comment', 'time', 'height')
+        SQL().execute(req, (item.get('account', ''), item['category'], item['amount'], \
+                            item.get('fee', 0), item.get('txid'), item.get('vout', -1), \
+                            item.get('address', ''), item.get('otheraccount'), \
+                            item.get('comment', item.get('message')), item['time'], blockHeight))
+
+    def recordMove(self, fromAccount, toAccount, amount, comment=''):
+        '''Record a move between accounts, made by the gateway.'''
+        now = int(time())
+        req = '''insert into %s (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                 values (?, ?, ?, 0, -1, '', ?, ?, ?)''' % \
+              ('ledger', 'account', 'category', 'amount', 'fee', 'vout', \
+               'address', 'otheraccount', 'comment', 'time')
+        self.lock.acquire()
+        try:
+            SQL().execute(req, (fromAccount, 'move', -amount, toAccount, comment, now))
+            SQL().execute(req, (toAccount, 'move', amount, fromAccount, comment, now))
+        finally:
+            self.lock.release()
+
+    def recordAddress(self, address, account):
+        '''Record which account an address belongs to.'''
+        req = 'insert or replace into %s (%s, %s) values (?, ?)' % \
+              ('ledger_addresses', 'address', 'account')
+        SQL().execute(req, (address, account))
+
+    def balance(self, account, minconf=1):
+        '''Return the balance of the account, like getbalance.'''
+        req = '''select coalesce(sum(%s), 0) from %s where %s=? and
+                 (%s in ('send', 'move') or (%s is not null and %s<=?))''' % \
+              ('amount', 'ledger', 'account', 'category', 'height', 'height')
+        SQL().execute(req, (account, self.height - minconf + 1))
+        total = SQL().fetchone()[0]
+        # The fee appears in each entry of a transaction with several outputs.
+        req = '''select coalesce(sum(%s), 0) from (select min(%s) as %s from %s
+                 where %s=? and %s='send' group by %s)''' % \
+              ('fee', 'fee', 'fee', 'ledger', 'account', 'category', 'txid')
+        SQL().execute(req, (account,))
+        return total + SQL().fetchone()[0]
+
+    def balances(self, minconf=1):
+        '''Return the balance of every account, like listaccounts, as a
+           dictionary {account: balance}.'''
+        balances = {}
+        req = 'select distinct %s from %s' % ('account', 'ledger_addresses')
+        SQL().execute(req)
+        for row in SQL().fetchall():
+            balances[row[0]] = 0
+        req = '''select %s, sum(%s) from %s where %s in ('send', 'move') or
+                 (%s is not null and %s<=?) group by %s''' % \
+              ('account', 'amount', 'ledger', 'category', 'height', 'height', 'account')
+        SQL().execute(req, (self.height - minconf + 1,))
+        for row in SQL().fetchall():
+            balances[row[0]] = row[1]
+        req = '''select %s, sum(%s) from (select %s, min(%s) as %s from %s
+                 where %s='send' group by %s, %s) group by %s''' % \
+              ('account', 'fee', 'account', 'fee', 'fee', 'ledger', 'category', \
+               'account', 'txid', 'account')
+        SQL().execute(req)
+        for row in SQL().fetchall():
+            balances[row[0]] = balances.get(row[0], 0) + row[1]
+        return balances
+
+    def received(self, minconf=1):
+        '''Return the amount received on each address of the wallet, like
+           listreceivedbyaddress with includeempty, as a dictionary
+           {account: {address: amount}}.'''
+        received = {}
+        SQL().execute('select %s, %s from %s' % ('address', 'account', 'ledger_addresses'))
+        for row in SQL().fetchall():
+            received.setdefault(row['account'], {})[row['address']] = 0
+        req = '''select %s, %s, sum(%s) from %s where %s='receive' and %s is not null
+                 and %s<=? group by %s, %s''' % \
+              ('account', 'address', 'amount', 'ledger', 'category', 'height', \
+               'height', 'account', 'address')
+        SQL().execute(req, (self.height - minconf + 1,))
+        for row in SQL().fetchall():
+            received.setdefault(row[0], {})[row[1]] = row[2]
+        return received
+
+    def addresses(self, account):
+        '''Return the addresses of the account.'''
+        req = 'select %s from %s where %s=?' % ('address', 'ledger_addresses', 'account')
+        SQL().execute(req, (account,))
+        return [row[0] for row in SQL().fetchall()]
+
+    def transactions(self, account, count=None, start=0, otheraccount=None, address=None):
+        '''Return the entries of the account, most recent first, optionally
+           only those with the given counterpart account or address. Each
+           entry is a row, whose confirmations are computed (-1 for moves).'''
+        req = 'select * from %s where %s=?' % ('ledger', 'account')
+        values = [account]
+        if otheraccount is not None:
+            req += ' and %s=?' % 'otheraccount'
+            values.append(otheraccount)
+        if address is not None:
+            req += ' and %s=?' % 'address'
+            values.append(address)
+        req += ' order by %s desc, %s desc' % ('time', 'id')
+        if count is not None:
+            req += ' limit ? offset ?'
+            values.extend([count, start])
+        SQL().execute(req, tuple(values))
+        entries = []
+        for row in SQL().fetchall():
+            entry = dict(zip(row.keys(), row))
+            if 'move' == entry['category']:
+                entry['confirmations'] = -1
+            elif entry['height'] is None:
+                entry['confirmations'] = 0
+            else:
+                entry['confirmations'] = self.height - entry['height'] + 1
+            entries.append(entry)
+        return entries
+
+    def lastTransaction(self, account):
+        '''Return something that changes whenever an entry of the account is
+           added or updated, or a new block is seen.'''
+        req = 'select max(%s) from %s where %s=?' % ('id', 'ledger', 'account')
+        SQL().execute(req, (account,))
+        return (SQL().fetchone()[0], self.height)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Introspection of the memory used by a component: how many entries its
+   caches and its other long-lived structures hold, how much memory they
+   take (roughly), and which types of objects are the most numerous in the
+   process. Used by the "memory" admin command, to size hosts and catch
+   leaks.'''
+
+from gc import get_objects
+import i18n
+from ratelimit import prune as pruneRateLimits
+from sys import getsizeof
+from types import ClassType, FunctionType, MethodType, ModuleType
+
+MAX_DEPTH = 6
+'''How deep sizeOf() follows references'''
+
+TOP_TYPES = 15
+'''Number of object types listed by topTypes()'''
+
+_opaque = (ClassType, FunctionType, MethodType, ModuleType, type)
+'''Objects whose references aren't followed by sizeOf(): they belong to the
+   code, not to the data'''
+
+def sizeOf(obj, seen=None, depth=MAX_DEPTH):
+    '''Return an estimate of the memory taken by `obj` and what it refers
+       to: the contents of containers and the attributes of instances, up to
+       `depth` levels. Objects already in `seen` (a set of ids) aren't
+       counted again.'''
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = getsizeof(obj)
+    if (0 == depth) or isinstance(obj, _opaque):
+        return size
+    if isinstance(obj, dict):
+        for (key, value) in obj.iteritems():
+            size += sizeOf(key, seen, depth - 1) + sizeOf(value, seen, depth - 1)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += sizeOf(item, seen, depth - 1)
+    elif hasattr(obj, '__dict__'):
+        size += sizeOf(obj.__dict__, seen, depth - 1)
+    return size
+
+def structures(component):
+    '''Return the long-lived structures of the component, as a list of
+       tuples (name, entries, estimated size in bytes). Objects shared by
+       several structures (e.g. the UserAccount instances, in both caches)
+       are counted in each of them.'''
+    context = component.context
+    found = [('cacheByJID', context.cacheByJID),
+             ('cacheByUsername', context.cacheByUsername),
+             ('connectedUsers', component.connectedUsers),
+             ('sentPresences', component.sentPresences),
+             ('lastSeen', component.lastSeen),
+             ('i18n._parsers', i18n._parsers),
+             ('templates', component.templates.templates)]
+    for (name, limiter) in sorted(component.rateLimits.items()):
+        limiter.lock.acquire()
+        try:
+            found.append(('rateLimits.' + name, dict(limiter.buckets)))
+        finally:
+            limiter.lock.release()
+    dispatcher = getattr(component, 'Dispatcher', None)
+    if dispatcher is not None:
+        found.append(('dispatcher.handlers', dispatcher.handlers))
+        found.append(('dispatcher._expected', dispatcher._expected))
+        found.append(('dispatcher._cycleHandlers', dispatcher._cycleHandlers))
+    # Don't count the component itself, should anything refer to it.
+    context.lock.acquire()
+    try:
+        return [(name, len(value), sizeOf(value, set([id(component)]))) \
+                for (name, value) in found]
+    finally:
+        context.lock.release()
+
+def hitRates(component):
+    '''Return the hit rates of the component's caches, as a list of tuples
+       (name, hits, misses).'''
+    context = component.context
+    return [('useraccounts', context.hits, context.misses),
+            ('templates', component.templates.hits, component.templates.misses)]
+
+def topTypes(count=TOP_TYPES):
+    '''Return the most numerous types among the objects tracked by the
+       garbage collector, as a list of tuples (type name, number of
+       objects), most numerous first.'''
+    counts = {}
+    for obj in get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return sorted(counts.items(), key=lambda c: -c[1])[:count]
+
+def trim(component):
+    '''Forget what the component remembers about the users who are offline:
+       their UserAccount instances (except the admins', whose rights are
+       held by the instance), the presences sent to them and when they were
+       last seen. Full rate limit buckets are dropped too. Return the
+       number of UserAccount instances dropped.'''
+    context = component.context
+    dropped = 0
+    context.lock.acquire()
+    try:
+        online = set([user.jid for user in component.connectedUsers])
+        for (jid, user) in context.cacheByJID.items():
+            if (jid not in online) and not user.isAdmin():
+                del context.cacheByJID[jid]
+                dropped += 1
+        for (username, user) in context.cacheByUsername.items():
+            if user.jid not in context.cacheByJID:
+                del context.cacheByUsername[username]
+        for key in component.sentPresences.keys():
+            if key[1] not in online:
+                del component.sentPresences[key]
+        for jid in component.lastSeen.keys():
+            if jid not in online:
+                del component.lastSeen[jid]
+    finally:
+        context.lock.release()
+    pruneRateLimits(component)
+    return dropped
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Offloading of CPU-bound work to a pool of processes, so that it neither
+   holds the component's loop nor the GIL. Jobs are submitted with a
+   callback, and their results are handed back to the component's loop,
+   which runs the callbacks between two stanzas. The number of jobs in
+   flight is bounded: when the pool is busy, submit() refuses new jobs and
+   the caller should do without (e.g. send a vCard without its photo).
+   Only the QR codes are worth it: encoding the JID of an address (see
+   address.encodeNode()) takes about 13 microseconds, less than sending it
+   to a worker process and back, even for a whole roster at once.'''
+
+from base64 import b64encode
+from collections import deque
+from logging import exception, info, warning
+from multiprocessing import Pool, cpu_count
+from threading import Lock
+from traceback import format_exc
+
+PROCESSES = None
+'''Number of processes in the pool, None for one per CPU'''
+
+MAX_PENDING = 64
+'''Number of jobs in flight above which new ones are refused'''
+
+def call(function, args):
+    '''Run a job in a worker process. Return a tuple (success, result),
+       where result is the traceback if the job failed.'''
+    try:
+        return (True, function(*args))
+    except Exception:
+        return (False, format_exc())
+
+def renderPhoto(address):
+    '''Return the QR code of a bitcoin address, as a base64-encoded PNG image,
+       or None if it can't be made. The address was validated by the
+       component already: it isn't validated again.'''
+    from bitcoin.address import Address
+    bcAddress = object.__new__(Address)
+    bcAddress.address = address
+    pic = bcAddress.qrCode(level='H', formt='PNG')
+    if pic is None:
+        return None
+    return b64encode(pic)
+
+
+class Offloader(object):
+    '''A pool of processes for the CPU-bound work of a component. Set the
+       component's `offloader` attribute before calling its start() method
+       to use it.'''
+
+    def __init__(self, processes=PROCESSES, maxPending=MAX_PENDING):
+        self.processes = processes
+        self.maxPending = maxPending
+        self.pool = None
+        self.lock = Lock()
+        self.pending = 0
+        self.results = deque()
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def start(self, component):
+        '''Start the processes, and have the results delivered by the
+           component's loop. The processes are forked: start them before
+           any thread.'''
+        self.pool = Pool(self.processes)
+        component.addPeriodicTask(0, self.deliver)
+        info("Offloading CPU-bound work to %s processes" % (self.processes or cpu_count()))
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def submit(self, function, args, callback):
+        '''Have function(*args) run by a worker process, then
+           callback(result) run by the component's loop, or callback(None)
+           if the job failed. The function must be picklable, i.e. defined
+           at the top level of a module. Return False, without running
+           anything, if there are too many jobs in flight.'''
+        self.lock.acquire()
+        try:
+            if self.pending >= self.maxPending:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            self.submitted += 1
+        finally:
+            self.lock.release()
+        def done(outcome):
+            self.results.append((callback, outcome))
+        self.pool.apply_async(call, (function, args), callback=done)
+        return True
+
+    def deliver(self, component):
+        '''Periodic task: run the callbacks of the jobs that are done.'''
+        while True:
+            try:
+                (callback, (success, result)) = self.results.popleft()
+            except IndexError:
+                return
+            self.lock.acquire()
+            try:
+                self.pending -= 1
+            finally:
+                self.lock.release()
+            if not success:
+                self.failed += 1
+                warning("An offloaded job failed:\n%s" % result)
+                result = None
+            try:
+                callback(result)
+            except Exception:
+                exception("The callback of an offloaded job failed")
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Buffered writing of the outbound stanzas. Without it, xmpppy writes each
+   stanza to the socket as soon as it's sent, so sending a presence from
+   each address of a roster makes as many system calls. An OutboundBuffer
+   serializes the stanzas into a buffer instead, which is written at once:
+   at each iteration of the component's loop, as soon as it's large enough,
+   or after a short delay (by its own thread, for stanzas sent while the
+   loop waits, e.g. by the runtime's workers). When the socket can't keep
+   up and the buffer grows too large, senders write it themselves, and thus
+   wait for the socket.'''
+
+from logging import debug
+from threading import Condition, Lock, Thread
+from time import sleep
+from xmpp.simplexml import ustr
+
+FLUSH_SIZE = 65536
+'''Size (in bytes) of buffered data above which it's written without delay'''
+
+FLUSH_DELAY = 0.01
+'''How long (in seconds) data may wait in the buffer for more to come'''
+
+MAX_BUFFER = 1048576
+'''Size (in bytes) of buffered data above which senders wait for the socket'''
+
+class OutboundBuffer(object):
+    '''The buffer of a component's outbound stanzas. Set the component's
+       `outbound` attribute to None before calling its start() method to
+       write each stanza as soon as it's sent.'''
+
+    def __init__(self, flushSize=FLUSH_SIZE, flushDelay=FLUSH_DELAY, maxBuffer=MAX_BUFFER):
+        self.flushSize = flushSize
+        self.flushDelay = flushDelay
+        self.maxBuffer = maxBuffer
+        self.chunks = []
+        self.size = 0
+        self.lock = Lock()
+        self.ready = Condition(self.lock)
+        self.writeLock = Lock()
+        self.write = None
+        self.running = False
+        self.stanzas = 0
+        self.writes = 0
+
+    def start(self, component):
+        '''Buffer what the component's dispatcher writes to the socket. The
+           component must be connected.'''
+        dispatcher = component.Dispatcher
+        self.write = dispatcher._owner_send
+        dispatcher._owner_send = self.send
+        component.addPeriodicTask(0, self.flush)
+        self.running = True
+        thread = Thread(target=self.run, name='bitcoim-outbound')
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        '''Write what's left, and stop buffering.'''
+        self.lock.acquire()
+        try:
+            self.running = False
+            self.ready.notify()
+        finally:
+            self.lock.release()
+        self.flush()
+        debug("Wrote %s stanzas in %s writes" % (self.stanzas, self.writes))
+
+    def send(self, data):
+        '''Buffer a stanza (or raw data), serialized as xmpppy would.'''
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        elif not isinstance(data, str):
+            data = ustr(data).encode('utf-8')
+        if not self.running:
+            return self.write(data)
+        self.lock.acquire()
+        try:
+            self.chunks.append(data)
+            self.size += len(data)
+            self.stanzas += 1
+            size = self.size
+            if 1 == len(self.chunks) or size >= self.flushSize:
+                self.ready.notify()
+        finally:
+            self.lock.release()
+        if size >= self.maxBuffer:
+            self.flush()
+
+    def flush(self, component=None):
+        '''Write the buffered data to the socket. Also a periodic task, run
+           at each iteration of the component's loop.'''
+        self.writeLock.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                chunks = self.chunks
+                self.chunks = []
+                self.size = 0
+            finally:
+                self.lock.release()
+            if 0 != len(chunks):
+                self.writes += 1
+                self.write(''.join(chunks))
+        finally:
+            self.writeLock.release()
+
+    def run(self):
+        '''Write the buffered data a short while after it was sent, unless
+           the loop did it in the meantime.'''
+        while True:
+            self.lock.acquire()
+            try:
+                while self.running and (0 == self.size):
+                    self.ready.wait()
+                if not self.running:
+                    return
+                full = self.size >= self.flushSize
+            finally:
+                self.lock.release()
+            if not full:
+                sleep(self.flushDelay)
+            self.flush()
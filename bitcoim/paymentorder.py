@@ -1,21 +1,87 @@
 from bitcoin.address import Address, InvalidBitcoinAddressError
-from bitcoin.controller import Controller
 from datetime import datetime
 from db import SQL
 from i18n import _, TX
+from json import dumps, loads
 from jsonrpc.proxy import JSONRPCException
+import ledger
 from logging import debug, info, warning
-import random
+from random import SystemRandom
+from rpc import Controller
+from sqlite3 import IntegrityError
+from threading import Lock
+from time import time
 from xmpp import JID
 
+CODE_ALPHABET = 'abcdefghjkmnpqrstuvwxyz23456789'
+'''Characters used in confirmation codes. Lowercase letters (except o, i and
+   l to avoid confusion) and numbers (except 0 and 1, for the same reason).'''
+
+CODE_LENGTH = 4
+'''Initial length of confirmation codes'''
+
+CODE_ATTEMPTS = 5
+'''Number of collisions after which confirmation codes get one char longer'''
+
+STATE_PENDING = 'pending'
+'''State of a payment order waiting for its sender's confirmation'''
+
+STATE_QUEUED = 'queued'
+'''State of a confirmed payment order, waiting to be sent'''
+
+STATE_SENDING = 'sending'
+'''State of a payment order being sent: its payments may have been made'''
+
+STATE_SENT = 'sent'
+'''State of a payment order that was sent, whose receipt wasn't delivered'''
+
+STATE_FAILED = 'failed'
+'''State of a payment order that couldn't be sent, whose receipt wasn't
+   delivered'''
+
+RECONCILE_COUNT = 100
+'''Number of the sender's latest transactions searched by reconcile()'''
+
+CLOCK_SKEW = 60
+'''Transactions up to that many seconds older than an attempt to send a
+   payment order may have been made by it (see reconcile())'''
+
+RESUME_DELAY = 60
+'''How long (in seconds) after the start of an interrupted attempt to send
+   a payment order it may be resumed: a call that timed out may still be
+   processed by the wallet in the meantime'''
+
+_random = SystemRandom()
+
+_claimed = set()
+_claimedLock = Lock()
+
 class PaymentOrder(object):
     '''A payment order.'''
 
-    def __init__(self, sender, target=None, amount=None, comment='', fee=0, code=None):
+    def __init__(self, sender, target=None, amount=None, comment='', fee=0, code=None, items=None, \
+                 state=STATE_PENDING):
+        '''Constructor. If code is given, the payment order in the given state
+           (pending by default) is fetched from the database, otherwise a new
+           one is prepared. A grouped payment order is made by giving a list
+           of (target, amount) tuples as items, instead of a target and an
+           amount.'''
         from useraccount import UserAccount
         self.sender = sender
+        self.state = state
         self.target = target
-        if isinstance(target, Address):
+        self.items = []
+        if items:
+            for (itemTarget, itemAmount) in items:
+                if isinstance(itemTarget, Address):
+                    if sender.ownsAddress(itemTarget):
+                        raise PaymentToSelfError
+                elif sender == itemTarget:
+                    raise PaymentToSelfError
+                self.items.append((itemTarget, itemAmount))
+            self.recipient = ''
+            amount = sum([itemAmount for (itemTarget, itemAmount) in self.items])
+        elif isinstance(target, Address):
             if sender.ownsAddress(target):
                 raise PaymentToSelfError
             self.recipient = target.address
@@ -33,11 +99,13 @@ class PaymentOrder(object):
             self.fee = fee
             self.date = None
             self.entryId = None
+            self.started = None
+            self.progress = None
         else:
             debug("We want to fetch payment with code '%s'" % code)
             self.code = code
-            condition = 'from_jid=? and confirmation_code=?'
-            values = [sender.jid, code]
+            condition = 'from_jid=? and confirmation_code=? and state=?'
+            values = [sender.jid, code, state]
             if self.recipient is not None:
                 condition += ' and recipient=?'
                 values.append(self.recipient)
@@ -50,9 +118,9 @@ class PaymentOrder(object):
             if fee != 0:
                 condition += ' and fee=?'
                 values.append(fee)
-            req = 'select %s, %s, %s, %s, %s, %s from %s where %s' % \
+            req = 'select %s, %s, %s, %s, %s, %s, %s, %s, %s from %s where %s' % \
                   ('id', 'date', 'recipient', 'amount', 'comment', 'fee', \
-                   'payments', condition)
+                   'items', 'started', 'progress', 'payments', condition)
             debug("SQL query: %s" % req)
             SQL().execute(req, tuple(values))
             paymentOrder = SQL().fetchone()
@@ -60,64 +128,388 @@ class PaymentOrder(object):
                 raise PaymentNotFoundError
             else:
                 (self.entryId, self.date, self.recipient, self.amount, \
-                 self.comment, self.fee) = tuple(paymentOrder)
-            try:
-                self.target = Address(self.recipient)
-            except InvalidBitcoinAddressError:
-                # may raise UnknownUserError
-                self.target = UserAccount(self.recipient)
+                 self.comment, self.fee, itemCount, self.started, progress) = tuple(paymentOrder)
+                self.progress = progress and loads(progress)
+            if 0 == itemCount:
+                self.target = PaymentOrder.resolve(self.recipient)
+            else:
+                self.target = None
+                req = 'select %s, %s from %s where %s=? order by %s' % \
+                      ('recipient', 'amount', 'payment_items', 'payment_id', 'id')
+                SQL().execute(req, (self.entryId,))
+                for row in SQL().fetchall():
+                    self.items.append((PaymentOrder.resolve(row['recipient']), row['amount']))
 
     @staticmethod
-    def genConfirmationCode(length=4, alphabet='abcdefghjkmnpqrstuvwxyz23456789'):
+    def resolve(recipient):
+        '''Return the Address or the UserAccount a recipient stands for. Raise
+           UnknownUserError if it's neither an address nor a known username.
+        '''
+        from useraccount import UserAccount
+        try:
+            return Address(recipient)
+        except InvalidBitcoinAddressError:
+            return UserAccount(recipient)
+
+    @staticmethod
+    def itemRecipient(target):
+        '''Return the string stored as recipient for an item's target.'''
+        if isinstance(target, Address):
+            return target.address
+        else:
+            return target.username
+
+    @staticmethod
+    def genConfirmationCode(length=CODE_LENGTH, alphabet=CODE_ALPHABET):
         '''Generate a random confirmation code of variable length, taken from a
-           given set of characters. By default, the length is 6 and the possible
-           characters are lowercase letters (except o, i and l to avoid confusion)
-           and numbers (except 0 and 1, for the same reason).
+           given set of characters. The characters are picked using the
+           system's cryptographically secure random generator.
         '''
         debug("Trying to pick a %s-char word out of %s" % (length, alphabet))
-        return ''.join(random.sample(alphabet, length)) 
+        return ''.join([_random.choice(alphabet) for i in range(length)])
+
+    def claim(self):
+        '''Make sure no other thread of the gateway sends the payment order
+           at the same time: return False if one does, True otherwise. The
+           payment order must be released (see release()) once sent.'''
+        _claimedLock.acquire()
+        try:
+            if self.entryId in _claimed:
+                return False
+            _claimed.add(self.entryId)
+            return True
+        finally:
+            _claimedLock.release()
+
+    def release(self):
+        _claimedLock.acquire()
+        try:
+            _claimed.discard(self.entryId)
+        finally:
+            _claimedLock.release()
+
+    def resumable(self):
+        '''Return True if an interrupted attempt to send the payment order
+           is old enough to be resumed (see RESUME_DELAY).'''
+        return (self.started or 0) + RESUME_DELAY <= time()
 
     def queue(self):
-        '''Insert a payment order into the database.'''
-        self.code = PaymentOrder.genConfirmationCode()
+        '''Insert a payment order into the database. The confirmation code is
+           unique for the sender: the database refuses duplicates, in which
+           case another code is tried, getting longer after CODE_ATTEMPTS
+           collisions.'''
         self.date = datetime.now()
-        req = 'insert into %s (%s, %s, %s, %s, %s, %s, %s) values (?, ?, ?, ?, ?, ?, ?)' % \
-              ('payments', 'from_jid', 'date', 'recipient', 'amount', 'comment', 'confirmation_code', 'fee')
-        SQL().execute(req, (self.sender.jid, self.date, self.recipient, self.amount, self.comment, self.code, self.fee))
-        self.entryId = SQL().lastrowid
-        debug("Inserted a payment into database (id = %s)" % self.entryId)
-
-    def confirm(self):
-        '''Actually send the bitcoins to the recipient. Check first if the
-           user has enough bitcoins to do the payment.
+        req = 'insert into %s (%s, %s, %s, %s, %s, %s, %s, %s) values (?, ?, ?, ?, ?, ?, ?, ?)' % \
+              ('payments', 'from_jid', 'date', 'recipient', 'amount', 'comment', 'confirmation_code', 'fee', 'items')
+        attempt = 0
+        SQL().execute('begin')
+        try:
+            while True:
+                self.code = PaymentOrder.genConfirmationCode(CODE_LENGTH + attempt // CODE_ATTEMPTS)
+                try:
+                    SQL().execute(req, (self.sender.jid, self.date, self.recipient, self.amount, self.comment, self.code, self.fee, len(self.items)))
+                    break
+                except IntegrityError:
+                    debug("Confirmation code '%s' already used by %s" % (self.code, self.sender))
+                    attempt += 1
+            self.entryId = SQL().cursor.lastrowid
+            req = 'insert into %s (%s, %s, %s) values (?, ?, ?)' % \
+                  ('payment_items', 'payment_id', 'recipient', 'amount')
+            for (target, amount) in self.items:
+                SQL().execute(req, (self.entryId, PaymentOrder.itemRecipient(target), amount))
+        except:
+            SQL().execute('rollback')
+            raise
+        SQL().execute('commit')
+        debug("Inserted a payment into database (id = %s, %s items)" % (self.entryId, len(self.items)))
+
+    def enqueue(self):
+        '''Have the payment order sent by the payment worker (see
+           paymentworker.py). Return False if it's no longer pending, e.g.
+           because it was confirmed in the meantime.'''
+        req = 'update %s set %s=? where %s=? and %s=?' % ('payments', 'state', 'id', 'state')
+        SQL().execute(req, (STATE_QUEUED, self.entryId, STATE_PENDING))
+        if 0 == SQL().cursor.rowcount:
+            return False
+        self.state = STATE_QUEUED
+        return True
+
+    def setState(self, state, **fields):
+        '''Record the state of the payment order, along with the given
+           fields (txid, error, attempts, started, progress).'''
+        names = ['state'] + fields.keys()
+        req = 'update %s set %s where %s=?' % \
+              ('payments', ', '.join(['%s=?' % name for name in names]), 'id')
+        SQL().execute(req, tuple([state] + fields.values() + [self.entryId]))
+        self.state = state
+
+    def steps(self):
+        '''Return the calls to the controller that make the payment, as a
+           list of tuples (kind, destination, amount): kind is 'send' (to an
+           address), 'sendmany' (destination is a tuple of (address, amount)
+           tuples) or 'move' (to an account).
            If the recipient is a username, the corresponding bitcoin account
-           is resolved, and the coins are simply moved to that account.
-        '''
+           is resolved, and the coins are simply moved to that account.'''
         from useraccount import UserAccount
-        info("User %s is about to send BTC %s to %s" % (self.sender, self.amount, self.recipient))
-        try:
+        if not self.items:
             if Controller().validateaddress(self.recipient)['isvalid']:
-                self.code = Controller().sendfrom(self.sender.jid,
-                              self.recipient, self.amount, 1, self.comment)
-            else:
-                # If there's an UnknownUserError, let it go up one level
-                destAccount = UserAccount(self.recipient).jid
-                debug("We resolved %s into account '%s'" % (self.recipient, destAccount))
-                Controller().move(self.sender.jid, destAccount, self.amount, 1, self.comment)
-                self.code = 0
-        except JSONRPCException, inst:
-            info("Couldn't do payment, probably not enough bitcoins (%s)" % inst)
+                return [('send', self.recipient, self.amount)]
+            # If there's an UnknownUserError, let it go up one level
+            destAccount = UserAccount(self.recipient).jid
+            debug("We resolved %s into account '%s'" % (self.recipient, destAccount))
+            return [('move', destAccount, self.amount)]
+        amounts = {}
+        for (target, amount) in self.items:
+            if isinstance(target, Address):
+                amounts[target.address] = amounts.get(target.address, 0) + amount
+        steps = []
+        if amounts:
+            steps.append(('sendmany', tuple(sorted(amounts.items())), sum(amounts.values())))
+        for (target, amount) in self.items:
+            if not isinstance(target, Address):
+                steps.append(('move', target.jid, amount))
+        return steps
+
+    def makeStep(self, kind, destination, amount):
+        '''Make one of the calls returned by steps(). Return the transaction
+           ID, or 0 for a move.'''
+        if 'send' == kind:
+            return Controller().sendfrom(self.sender.jid, destination, amount, 1, self.comment)
+        elif 'sendmany' == kind:
+            return Controller().sendmany(self.sender.jid, dict(destination), 1, self.comment)
+        Controller().move(self.sender.jid, destination, amount, 1, self.comment)
+        return 0
+
+    @staticmethod
+    def match(step, entries):
+        '''Find the transaction made by one of the calls returned by steps()
+           among the given entries of listtransactions, and take its entries
+           out of the list. Return its transaction ID (0 for a move), or None
+           if it's not there.'''
+        same = lambda a, b: abs(a - b) < 1e-8
+        (kind, destination, amount) = step
+        if 'move' == kind:
+            for entry in entries:
+                if ('move' == entry['category']) and (destination == entry.get('otheraccount')) \
+                   and same(-amount, entry['amount']):
+                    entries.remove(entry)
+                    return 0
+            return None
+        if 'send' == kind:
+            destination = ((destination, amount),)
+        outputs = {}
+        for entry in entries:
+            if 'send' == entry['category']:
+                outputs.setdefault(entry['txid'], []).append(entry)
+        for (txid, sent) in outputs.iteritems():
+            matched = []
+            for (address, value) in destination:
+                for entry in sent:
+                    if (entry not in matched) and (address == entry.get('address')) \
+                       and same(-value, entry['amount']):
+                        matched.append(entry)
+                        break
+            if len(matched) == len(destination):
+                for entry in matched:
+                    entries.remove(entry)
+                return txid
+        return None
+
+    def reconcile(self, steps, since, done=None):
+        '''An attempt to send the payment order, started at `since` (a
+           timestamp), was interrupted: find out which of its steps were
+           made, from the sender's latest transactions. `done` tells which
+           steps are already known to be made: their transactions are left
+           aside first. Return a list giving, for each step, its transaction
+           ID (0 for a move) if it was made, None otherwise. Each transaction
+           is matched by at most one step. If `since` is None, the attempt
+           never got to call the controller: nothing is matched.'''
+        if done is None:
+            done = [None] * len(steps)
+        if since is None:
+            info("Payment order #%s was interrupted before any step was made" % self.entryId)
+            return list(done)
+        entries = [entry for entry in Controller().listtransactions(self.sender.jid, RECONCILE_COUNT) \
+                   if (entry['time'] >= since - CLOCK_SKEW) and \
+                      ((entry.get('comment') or '') == (self.comment or ''))]
+        for (step, txid) in zip(steps, done):
+            if txid is not None:
+                PaymentOrder.match(step, entries)
+        found = []
+        for (step, txid) in zip(steps, done):
+            if txid is None:
+                txid = PaymentOrder.match(step, entries)
+            found.append(txid)
+        info("Payment order #%s was interrupted, steps made: %s" % (self.entryId, found))
+        return found
+
+    def resume(self):
+        '''The payment order was interrupted while it was being sent: return
+           which of its steps were made (see reconcile()), from the progress
+           recorded by confirm() and the sender's latest transactions. The
+           steps found in the transactions are recorded too.'''
+        steps = self.steps()
+        progress = self.progress
+        if (progress is None) or (len(progress) != len(steps)):
+            progress = [None] * len(steps)
+        done = self.reconcile(steps, self.started, progress)
+        recorded = list(progress)
+        for (i, step) in enumerate(steps):
+            if (recorded[i] is None) and (done[i] is not None):
+                recorded[i] = done[i]
+                self.recordStep(step, recorded)
+        return done
+
+    def confirm(self, done=None, receipt=False):
+        '''Actually send the bitcoins to the recipient, or recipients. For a
+           grouped payment order, check first if the user has enough bitcoins.
+           All the payments to bitcoin addresses are made by a single
+           transaction, payments to other users are moves between accounts.
+           `done` tells which steps were already made (see resume()): they
+           are skipped. Return the transaction ID, or 0 if there was no
+           payment to a bitcoin address.
+           The payment order is marked as sending before the first call to
+           the controller, and each step is recorded as soon as it's made.
+           Once sent, it's deleted, or marked as sent if its sender expects
+           a receipt. If the controller refuses the first step made,
+           NotEnoughBitcoinsError is raised, and the payment order is pending
+           again unless a receipt is expected; if it refuses a later one, PartialPaymentError is
+           raised, and the payment order is deleted unless a receipt is
+           expected: it can't be confirmed again. If the wallet becomes
+           unavailable, the payment order stays marked as sending, and can
+           be resumed.
+        '''
+        steps = self.steps()
+        if done is None:
+            done = [None] * len(steps)
+        else:
+            done = list(done)
+        if self.items and (done.count(None) == len(done)) and \
+           (self.sender.getBalance() < self.amount):
             raise NotEnoughBitcoinsError
+        info("User %s is about to send BTC %s to %s" % (self.sender, self.amount, \
+             self.recipient or ("%s recipients" % len(self.items))))
+        previous = self.state
+        if self.started is None:
+            self.started = time()
+        # Only one attempt may send a payment order.
+        req = 'update %s set %s=?, %s=?, %s=? where %s=? and %s=?' % \
+              ('payments', 'state', 'started', 'progress', 'id', 'state')
+        SQL().execute(req, (STATE_SENDING, self.started, dumps(done), self.entryId, previous))
+        if 0 == SQL().cursor.rowcount:
+            raise PaymentNotFoundError
+        self.state = STATE_SENDING
+        txid = 0
+        try:
+            for (i, step) in enumerate(steps):
+                if done[i] is None:
+                    self.takeStep(i, steps, done)
+                if 0 != done[i]:
+                    txid = done[i]
+        except JSONRPCException, inst:
+            made = [step for (step, stepTxid) in zip(steps, done) if stepTxid is not None]
+            if not made:
+                info("Couldn't do payment, probably not enough bitcoins (%s)" % inst)
+                if not receipt:
+                    self.setState(STATE_PENDING, started=None, progress=None)
+                    self.started = None
+                raise NotEnoughBitcoinsError
+            warning("Payment order #%s was only partly made, the controller refused a step (%s)" % \
+                    (self.entryId, inst))
+            self.syncLedger(txid)
+            if not receipt:
+                self.cancel()
+            raise PartialPaymentError, self.describe(made)
         info("Payment made by %s to %s (BTC %s). Comment: %s" % \
-              (self.sender, self.recipient, self.amount, self.comment))
-        self.cancel()
-        return self.code
+              (self.sender, self.recipient or ("%s recipients" % len(self.items)), \
+               self.amount, self.comment))
+        self.syncLedger(txid)
+        if receipt:
+            self.setState(STATE_SENT, txid=(txid or None))
+        else:
+            self.cancel()
+        return txid
+
+    def takeStep(self, i, steps, done):
+        '''Make the i-th step, and record it (see recordStep()). A move is
+           made holding the ledger's lock: the first sync, which imports the
+           moves of the wallet, must neither miss it nor import it twice.'''
+        recorder = ledger.recorder()
+        if ('move' == steps[i][0]) and (recorder is not None):
+            recorder.lock.acquire()
+        else:
+            recorder = None
+        try:
+            done[i] = self.makeStep(*steps[i])
+            self.recordStep(steps[i], done)
+        finally:
+            if recorder is not None:
+                recorder.lock.release()
+
+    def recordStep(self, step, done):
+        '''Record that a step of the payment order was made: `done` is the
+           progress of the payment order, as given to confirm(). A move is
+           recorded by the ledger, if there's one, in the same transaction.'''
+        (kind, destination, amount) = step
+        recorder = ledger.recorder()
+        if ('move' != kind) or (recorder is None):
+            recorder = None
+        else:
+            # Taken before the transaction, like the ledger's sync does.
+            recorder.lock.acquire()
+        try:
+            SQL().execute('begin')
+            try:
+                req = 'update %s set %s=? where %s=?' % ('payments', 'progress', 'id')
+                SQL().execute(req, (dumps(done), self.entryId))
+                if recorder is not None:
+                    recorder.recordMove(self.sender.jid, destination, amount, self.comment)
+            except:
+                SQL().execute('rollback')
+                raise
+            SQL().execute('commit')
+        finally:
+            if recorder is not None:
+                recorder.lock.release()
+        self.progress = list(done)
+
+    def syncLedger(self, txid):
+        '''If a transaction was sent, sync the ledger, if there's one, to
+           include it.'''
+        current = ledger.current()
+        if (current is None) or (0 == txid):
+            return
+        try:
+            current.sync()
+        except Exception, e:
+            warning("Couldn't sync the ledger after a payment, it will be at the next sync (%s)" % e)
+
+    def describe(self, steps):
+        '''Return a readable list of the payments made by the given steps.'''
+        from useraccount import UserAccount
+        payments = []
+        for (kind, destination, amount) in steps:
+            if 'move' == kind:
+                payments.append((UserAccount(JID(destination)).username, amount))
+            elif 'send' == kind:
+                payments.append((destination, amount))
+            else:
+                payments.extend(destination)
+        return ', '.join([_(TX, 'payment_partial_item').format(amount=amount, recipient=recipient) \
+                          for (recipient, amount) in payments])
 
     def cancel(self):
         '''Delete the payment order from the database.'''
-        debug("About to delete payment order #%s" % self.entryId)
+        PaymentOrder.delete(self.entryId)
+
+    @staticmethod
+    def delete(entryId):
+        '''Delete the payment order with the given id from the database.'''
+        debug("About to delete payment order #%s" % entryId)
+        req = 'delete from %s where %s=?' % ('payment_items', 'payment_id')
+        SQL().execute(req, (entryId,))
         req = 'delete from %s where %s=?' % ('payments', 'id')
-        SQL().execute(req, (self.entryId,))
+        SQL().execute(req, (entryId,))
 
 class PaymentNotFoundError(Exception):
     '''The requested payment was not found.'''
@@ -128,5 +520,9 @@ class PaymentError(Exception):
 class NotEnoughBitcoinsError(PaymentError):
     '''The user doesn't have enough bitcoins on their account'''
 
+class PartialPaymentError(PaymentError):
+    '''Only some of the payments of a payment order were made, the
+       controller refused the others'''
+
 class PaymentToSelfError(PaymentError):
     '''The sender and the destination address represent the same account'''
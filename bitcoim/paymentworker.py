@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Sending of the confirmed payment orders, out of the way of the stanzas.
+   When a payment worker is used, confirming a payment order only queues it,
+   and the sender gets a receipt once it's sent. Payment orders go through
+   these states, recorded in the database:
+     pending -> queued -> sending -> sent or failed
+   A payment order is marked as sending before any call to the controller,
+   each call is recorded once made, and the payment order is marked as sent
+   once all of them were made. If the process stops in between, the payment
+   order is still marked as sending when the worker starts again: it then
+   looks for the payments in the recorded progress and the sender's latest
+   transactions (see PaymentOrder.resume()), and only makes the missing
+   ones, so that nothing is paid twice.'''
+
+from collections import deque
+from context import activate
+from db import SQL
+from i18n import _, TX
+from jid import JID
+from logging import debug, info, warning, exception
+from paymentorder import PaymentOrder, PaymentError, PaymentNotFoundError, \
+                         NotEnoughBitcoinsError, PartialPaymentError, STATE_QUEUED, \
+                         STATE_SENDING, STATE_SENT, STATE_FAILED
+from rpc import WalletUnavailableError
+from threading import Event, Thread
+from useraccount import UserAccount, UnknownUserError
+from xmpp.protocol import Message
+
+POLL_INTERVAL = 5
+'''How often (in seconds) the worker looks for payment orders to send, when
+   nobody woke it up'''
+
+RETRY_DELAY = 60
+'''How long (in seconds) the worker waits when the wallet is unavailable'''
+
+MAX_ATTEMPTS = 10
+'''Number of attempts after which a payment order fails, if the wallet
+   couldn't be reached'''
+
+class PaymentWorker(object):
+    '''Sends the confirmed payment orders, from its own thread. Set the
+       component's `paymentWorker` attribute before calling its start()
+       method to use it. The following counters are kept: sent, failed.'''
+
+    def __init__(self, pollInterval=POLL_INTERVAL, retryDelay=RETRY_DELAY, maxAttempts=MAX_ATTEMPTS):
+        self.pollInterval = pollInterval
+        self.retryDelay = retryDelay
+        self.maxAttempts = maxAttempts
+        self.wakeup = Event()
+        self.receipts = deque()
+        self.delivering = set()
+        self.thread = None
+        self.running = False
+        self.sent = 0
+        self.failed = 0
+
+    def start(self, component):
+        '''Start the worker thread. The payment orders left over by a
+           previous run are taken care of first. Receipts are delivered by
+           the component's loop.'''
+        self.context = component.context
+        component.addPeriodicTask(0, self.deliver)
+        self.running = True
+        self.thread = Thread(target=self.run, name='bitcoim-payments')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        '''Let the worker finish the payment order it's sending, if any, then
+           stop it.'''
+        self.running = False
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def notify(self):
+        '''A payment order was queued: send it now.'''
+        self.wakeup.set()
+
+    def run(self):
+        activate(self.context)
+        while self.running:
+            self.wakeup.clear()
+            delay = self.pollInterval
+            try:
+                if not self.process():
+                    delay = self.retryDelay
+            except WalletUnavailableError:
+                delay = self.retryDelay
+            except Exception:
+                exception("The payment worker failed")
+            self.wakeup.wait(delay)
+
+    def process(self):
+        '''Send the queued payment orders, resume the interrupted ones, and
+           have the receipts delivered. Return False if the wallet was
+           unavailable.'''
+        req = '''select %s, %s, %s, %s, %s, %s, %s, %s from %s where %s in (?, ?, ?, ?)
+                 order by %s''' % ('id', 'from_jid', 'confirmation_code', 'state', 'txid', \
+                                   'error', 'attempts', 'started', 'payments', 'state', 'id')
+        SQL().execute(req, (STATE_QUEUED, STATE_SENDING, STATE_SENT, STATE_FAILED))
+        for row in SQL().fetchall():
+            if not self.running:
+                break
+            if row['id'] in self.delivering:
+                continue
+            if row['state'] in [STATE_SENT, STATE_FAILED]:
+                self.queueReceipt(row['id'], row['from_jid'], row['confirmation_code'], \
+                                  row['state'], row['txid'], row['error'])
+            elif not self.send(row):
+                return False
+        return True
+
+    def send(self, row):
+        '''Send a queued payment order, or resume an interrupted one. Return
+           False if the wallet was unavailable.'''
+        state = row['state']
+        attempts = row['attempts'] + 1
+        try:
+            order = PaymentOrder(UserAccount(JID(row['from_jid'])), \
+                                 code=row['confirmation_code'], state=state)
+        except (PaymentNotFoundError, UnknownUserError), e:
+            return self.fail(row, _(TX, 'error_payment_impossible').format(reason=e))
+        if attempts > self.maxAttempts:
+            return self.fail(row, _(TX, 'error_payment_attempts'))
+        # confirm() marks it as sending, along with the time it started.
+        order.setState(state, attempts=attempts)
+        try:
+            done = None
+            if STATE_SENDING == state:
+                done = order.resume()
+            txid = order.confirm(done, receipt=True)
+        except PartialPaymentError, made:
+            return self.fail(row, _(TX, 'error_payment_partial').format(made=made))
+        except NotEnoughBitcoinsError:
+            return self.fail(row, _(TX, 'error_insufficient_funds'))
+        except (PaymentError, UnknownUserError), message:
+            return self.fail(row, _(TX, 'error_payment_impossible').format(reason=message))
+        except WalletUnavailableError:
+            warning("The wallet is unavailable, payment order #%s will be sent later" % row['id'])
+            return False
+        self.sent += 1
+        info("Payment order #%s sent. Transaction ID: %s" % (row['id'], txid))
+        self.queueReceipt(row['id'], row['from_jid'], row['confirmation_code'], \
+                          STATE_SENT, txid or None, None)
+        return True
+
+    def fail(self, row, error):
+        '''The payment order couldn't be sent: tell its sender. Return True.'''
+        self.failed += 1
+        info("Payment order #%s failed: %s" % (row['id'], error))
+        req = 'update %s set %s=?, %s=? where %s=?' % ('payments', 'state', 'error', 'id')
+        SQL().execute(req, (STATE_FAILED, error, row['id']))
+        self.queueReceipt(row['id'], row['from_jid'], row['confirmation_code'], \
+                          STATE_FAILED, None, error)
+        return True
+
+    def queueReceipt(self, entryId, jid, code, state, txid, error):
+        self.delivering.add(entryId)
+        self.receipts.append((entryId, jid, code, state, txid, error))
+
+    def deliver(self, component):
+        '''Periodic task: send the receipts of the payment orders that were
+           sent or failed, and forget about these payment orders.'''
+        while True:
+            try:
+                (entryId, jid, code, state, txid, error) = self.receipts.popleft()
+            except IndexError:
+                return
+            if STATE_FAILED == state:
+                body = _(TX, 'receipt_failed').format(code=code, reason=error)
+            elif txid is None:
+                body = _(TX, 'receipt_sent').format(code=code, message=_(TX, 'pay_recap_user'))
+            else:
+                body = _(TX, 'receipt_sent').format(code=code, \
+                                                    message=_(TX, 'pay_recap').format(txid=txid))
+            component.send(Message(to=jid, frm=component.jid, typ='chat', body=body))
+            PaymentOrder.delete(entryId)
+            self.delivering.discard(entryId)
+            debug("Delivered the receipt of payment order #%s" % entryId)
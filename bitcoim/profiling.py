@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Profiling of the stanza handlers, to find out why some stanzas take long.
+   A StanzaProfiler is opt-in: it profiles a fraction of the stanzas with
+   cProfile, and samples the stack of any stanza that runs longer than a
+   threshold. Each trace is written to a file in a directory where only the
+   latest ones are kept, along with the stanza type, the command and the
+   time spent in calls to the controller and to the database.'''
+
+from cProfile import Profile
+from logging import debug, exception
+from os import listdir, remove
+from os.path import join
+from pstats import Stats
+from random import random
+from StringIO import StringIO
+from sys import _current_frames
+from threading import Thread, Lock, local, currentThread
+from time import time, sleep, strftime
+from traceback import extract_stack
+
+SAMPLE_RATE = 0.001
+'''Fraction of the stanzas profiled with cProfile'''
+
+THRESHOLD = 1.0
+'''Stanzas taking longer than this (in seconds) are traced, sampled or not'''
+
+STACK_INTERVAL = 0.05
+'''How often (in seconds) the stack of a slow stanza is sampled'''
+
+MAX_FILES = 200
+'''Number of traces kept in the directory'''
+
+timings = local()
+
+def record(kind, name, duration):
+    '''Note that a call of the given kind ('rpc' or 'sql') took `duration`
+       seconds, if the current thread is handling a traced stanza.'''
+    try:
+        timings.calls.append((kind, name, duration))
+    except AttributeError:
+        pass # Not in a stanza handler, or no profiler.
+
+def percentile(values, fraction):
+    '''Return the value below which the given fraction of the (sorted)
+       values are.'''
+    if 0 == len(values):
+        return 0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def describe(stanza):
+    '''Return the type and the command (or query namespace) of a stanza.'''
+    name = stanza.getName()
+    if 'message' == name:
+        from command import parse as parseCommand
+        command = parseCommand(stanza.getBody() or '')[0]
+    elif 'iq' == name:
+        queries = stanza.getChildren()
+        if 0 == len(queries):
+            command = None
+        else:
+            command = queries[0].getNamespace()
+    else:
+        command = stanza.getType()
+    return (name, command)
+
+
+class StanzaProfiler(object):
+    '''Wraps the handlers of a component. Set the component's `profiler`
+       attribute before calling its start() method to use it.'''
+
+    def __init__(self, directory, sampleRate=SAMPLE_RATE, threshold=THRESHOLD, \
+                 maxFiles=MAX_FILES):
+        self.directory = directory
+        self.sampleRate = sampleRate
+        self.threshold = threshold
+        self.maxFiles = maxFiles
+        self.running = {}
+        self.lock = Lock()
+        self.watchdog = None
+        self.count = 0
+
+    def wrap(self, handler):
+        '''Return a handler, to be registered instead of `handler`, that
+           profiles the stanzas it handles.'''
+        def profiled(cnx, stanza, *args):
+            return self.run(handler, cnx, stanza, *args)
+        return profiled
+
+    def run(self, handler, cnx, stanza, *args):
+        if self.watchdog is None:
+            self.startWatchdog()
+        thread = currentThread().ident
+        samples = {}
+        timings.calls = []
+        self.running[thread] = (time(), samples)
+        profile = None
+        if random() < self.sampleRate:
+            profile = Profile()
+            profile.enable()
+        start = time()
+        try:
+            return handler(cnx, stanza, *args)
+        finally:
+            duration = time() - start
+            if profile is not None:
+                profile.disable()
+            del self.running[thread]
+            calls = timings.calls
+            del timings.calls
+            if (profile is not None) or (duration >= self.threshold):
+                try:
+                    self.write(stanza, duration, calls, profile, samples)
+                except Exception:
+                    exception("Couldn't write the trace of a stanza")
+
+    def startWatchdog(self):
+        self.lock.acquire()
+        try:
+            if self.watchdog is None:
+                self.watchdog = Thread(target=self.sample, name='bitcoim-profiler')
+                self.watchdog.setDaemon(True)
+                self.watchdog.start()
+        finally:
+            self.lock.release()
+
+    def sample(self):
+        '''Periodically sample the stack of the stanzas running for longer
+           than the threshold. Samples are counted per distinct stack.'''
+        while True:
+            sleep(STACK_INTERVAL)
+            now = time()
+            frames = _current_frames()
+            for (thread, (start, samples)) in self.running.items():
+                if (now - start < self.threshold) or (thread not in frames):
+                    continue
+                stack = tuple(extract_stack(frames[thread]))
+                samples[stack] = samples.get(stack, 0) + 1
+
+    def write(self, stanza, duration, calls, profile, samples):
+        (kind, command) = describe(stanza)
+        self.lock.acquire()
+        try:
+            self.count += 1
+            name = "%s-%06d-%s.txt" % (strftime('%Y%m%d-%H%M%S'), self.count, kind)
+        finally:
+            self.lock.release()
+        out = StringIO()
+        out.write("Stanza: %s\nCommand: %s\nDuration: %.3fs\n" % (kind, command, duration))
+        for what in ['rpc', 'sql']:
+            spent = [call for call in calls if what == call[0]]
+            out.write("%s: %s calls, %.3fs\n" % (what.upper(), len(spent), sum([call[2] for call in spent])))
+        out.write("\nCalls:\n")
+        for (what, call, spent) in calls:
+            out.write("  %.3fs %s %s\n" % (spent, what, ' '.join(unicode(call).split())))
+        if profile is not None:
+            out.write("\nProfile:\n")
+            Stats(profile, stream=out).sort_stats('cumulative').print_stats(40)
+        if 0 != len(samples):
+            out.write("\nStack samples (every %ss after %ss):\n" % (STACK_INTERVAL, self.threshold))
+            for (stack, count) in sorted(samples.items(), key=lambda s: -s[1]):
+                out.write("\n%s samples:\n" % count)
+                for (filename, line, function, text) in stack:
+                    out.write("  %s:%s in %s\n" % (filename, line, function))
+        f = open(join(self.directory, name), 'w')
+        try:
+            f.write(out.getvalue().encode('utf-8'))
+        finally:
+            f.close()
+        debug("Wrote the trace of a %.3fs %s stanza to %s" % (duration, kind, name))
+        self.rotate()
+
+    def rotate(self):
+        '''Delete the oldest traces, keeping at most maxFiles of them.'''
+        traces = sorted([f for f in listdir(self.directory) if f.endswith('.txt')])
+        for name in traces[:-self.maxFiles]:
+            try:
+                remove(join(self.directory, name))
+            except OSError:
+                pass
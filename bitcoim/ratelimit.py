@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''This module protects the component against floods: per-user rate limits
+   and global load shedding.'''
+
+from random import random
+import rpc
+from threading import Lock
+from time import time
+
+RATE = 2.0
+'''Stanzas per second a user may send in the long run'''
+
+BURST = 20
+'''Stanzas a user may send in a row'''
+
+EXPENSIVE_RATE = 0.2
+'''Expensive requests (history, confirmation, vCard) per second a user may
+   send in the long run'''
+
+EXPENSIVE_BURST = 3
+'''Expensive requests a user may send in a row'''
+
+MAX_IN_FLIGHT = 8
+'''Maximum number of expensive requests being handled at the same time'''
+
+MAX_LATENCY = 1.0
+'''Average duration of controller calls (in seconds) above which expensive
+   requests start being refused'''
+
+PRUNE_INTERVAL = 300
+'''How often (in seconds) the rate limits of inactive users are forgotten'''
+
+def prune(component):
+    '''Periodic task: forget the rate limits of users that were quiet long
+       enough for their buckets to be full again.'''
+    for limiter in component.rateLimits.itervalues():
+        limiter.prune()
+
+class TokenBucket(object):
+    '''A bucket holding at most `capacity` tokens, refilled at `rate` tokens
+       per second.'''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time()
+
+    def refill(self):
+        now = time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def consume(self, tokens=1):
+        '''Take tokens from the bucket if there are enough of them. Return
+           whether it was possible.'''
+        self.refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def isFull(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+
+class RateLimiter(object):
+    '''Rate limits, with one token bucket per key (typically a bare JID).
+       The buckets are shared by the threads handling stanzas and the
+       periodic tasks: they're only used holding the lock.'''
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+        self.lock = Lock()
+
+    def allow(self, key):
+        '''Return whether `key` may do one more request right now.'''
+        self.lock.acquire()
+        try:
+            try:
+                bucket = self.buckets[key]
+            except KeyError:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.capacity)
+            return bucket.consume()
+        finally:
+            self.lock.release()
+
+    def prune(self):
+        '''Forget about keys whose bucket is full again: they are in the same
+           state as keys never seen before.'''
+        self.lock.acquire()
+        try:
+            for key in [key for (key, bucket) in self.buckets.items() if bucket.isFull()]:
+                del self.buckets[key]
+        finally:
+            self.lock.release()
+
+
+class LoadShedder(object):
+    '''Global limit on expensive requests. No more than maxInFlight of them
+       are handled at the same time, and when controller calls take longer
+       than maxLatency on average, a growing part of them is refused.'''
+
+    def __init__(self, maxInFlight=MAX_IN_FLIGHT, maxLatency=MAX_LATENCY):
+        self.maxInFlight = maxInFlight
+        self.maxLatency = maxLatency
+        self.inFlight = 0
+        self.shed = 0
+        self.lock = Lock()
+
+    def acquire(self):
+        '''Return True, and count the request as in flight, if it can be
+           handled now. Return False otherwise.'''
+        average = rpc.latency.average
+        self.lock.acquire()
+        try:
+            if (self.inFlight >= self.maxInFlight) or \
+               ((average > self.maxLatency) and (random() > self.maxLatency / average)):
+                self.shed += 1
+                return False
+            self.inFlight += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self):
+        '''The request is done.'''
+        self.lock.acquire()
+        self.inFlight -= 1
+        self.lock.release()
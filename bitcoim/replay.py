@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Replay of a capture (see capture.py). The captured stanzas are fed back
+   into the handlers of a component that isn't connected to any server, at
+   their original pace or faster, against a copy of the database and the
+   bitcoin controller given (which should be a test wallet). Throughput and
+   latency are reported per kind of stanza.
+   Usage: python -m bitcoim.replay [options] <capture> <database>'''
+
+from capture import read, anonymizeDatabase
+from component import Component
+from db import SQL, Database
+from logging import exception, info
+from optparse import OptionParser
+from os import close, remove
+from profiling import percentile
+from ratelimit import RateLimiter
+import rpc
+from shutil import copyfile
+from tempfile import mkstemp
+from time import time, sleep
+from xmpp.protocol import Iq, Message, Presence, NodeProcessed
+from xmpp.simplexml import XML2Node
+
+class ReplayComponent(Component):
+    '''A component that isn't connected: the stanzas it sends are only
+       counted.'''
+
+    def __init__(self, jid):
+        Component.__init__(self, jid, None, 'localhost')
+        self.sent = 0
+
+    def send(self, stanza):
+        self.sent += 1
+
+
+class Replayer(object):
+    '''Feeds captured stanzas to a component. With a speed of 1, stanzas
+       are handled when they were received during the capture; with a speed
+       of 10, ten times faster; with a speed of 0, as fast as possible. If
+       limits is False, the component's rate limits are lifted.'''
+
+    def __init__(self, component, speed=1.0, limits=True):
+        self.component = component
+        self.speed = speed
+        if not limits:
+            component.rateLimits = {'default': RateLimiter(1e9, 1e9),
+                                    'expensive': RateLimiter(1e9, 1e9)}
+            component.loadShedder.maxInFlight = 1e9
+            component.loadShedder.maxLatency = 1e9
+        self.latencies = {}
+        self.errors = 0
+        self.duration = 0.0
+
+    def run(self, entries):
+        start = time()
+        for entry in entries:
+            if 0 != self.speed:
+                delay = start + entry['t'] / self.speed - time()
+                if delay > 0:
+                    sleep(delay)
+            self.handle(entry)
+        self.duration = time() - start
+
+    def handle(self, entry):
+        component = self.component
+        node = XML2Node(entry['xml'].encode('utf-8'))
+        kind = node.getName()
+        if entry['what'] is not None:
+            stanza = Iq(node=node)
+            kind = 'disco#' + entry['what']
+            handler = lambda cnx, iq: component.discoHandler(cnx, iq, entry['what'])
+        elif 'message' == kind:
+            stanza = Message(node=node)
+            handler = component.messageHandler
+        elif 'presence' == kind:
+            stanza = Presence(node=node)
+            handler = component.presenceHandler
+        else:
+            stanza = Iq(node=node)
+            handler = component.iqHandler
+        start = time()
+        try:
+            handler(component, stanza)
+        except NodeProcessed:
+            pass
+        except Exception:
+            self.errors += 1
+            exception("Error while replaying %s" % entry['xml'])
+        self.latencies.setdefault(kind, []).append(time() - start)
+
+    def report(self):
+        '''Return the report of the replay, as text.'''
+        count = sum([len(latencies) for latencies in self.latencies.itervalues()])
+        lines = ["%s stanzas in %.3fs (%.1f stanzas/s), %s sent, %s errors" % \
+                 (count, self.duration, count / max(self.duration, 1e-9), \
+                  self.component.sent, self.errors)]
+        lines.append("%-14s %8s %9s %9s %9s %9s" % ('', 'count', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'max (ms)'))
+        for (kind, latencies) in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            lines.append("%-14s %8s %9.2f %9.2f %9.2f %9.2f" % (kind, len(latencies), \
+                         percentile(latencies, 0.5) * 1000, percentile(latencies, 0.9) * 1000, \
+                         percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+        return "\n".join(lines)
+
+def main():
+    parser = OptionParser(usage="%prog [options] <capture> <database>")
+    parser.add_option('-s', '--speed', type='float', default=1.0,
+                      help="replay speed factor, 0 for as fast as possible")
+    parser.add_option('-c', '--controller', metavar='URL',
+                      help="URL of the bitcoin controller (a test wallet)")
+    parser.add_option('-k', '--key',
+                      help="anonymize the copy of the database with this key, as the capture")
+    parser.add_option('-n', '--no-limits', action='store_false', dest='limits', default=True,
+                      help="lift the rate limits")
+    (options, args) = parser.parse_args()
+    if 2 != len(args):
+        parser.error("a capture file and a database are needed")
+    (header, entries) = read(args[0])
+    (fd, copy) = mkstemp(suffix='.db')
+    close(fd)
+    try:
+        copyfile(args[1], copy)
+        SQL(copy)
+        Database(copy).upgrade()
+        if options.controller is not None:
+            rpc.usePool(options.controller)
+        component = ReplayComponent(header['domain'])
+        if options.key is not None:
+            anonymizeDatabase(options.key, header['domain'])
+        replayer = Replayer(component, options.speed, options.limits)
+        info("Replaying %s" % args[0])
+        replayer.run(entries)
+        print replayer.report()
+    finally:
+        SQL.close(copy)
+        remove(copy)
+
+if __name__ == '__main__':
+    main()
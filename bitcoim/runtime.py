@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Concurrent runtime for the component. With xmpppy alone, stanzas are read
+   and handled by a single loop, so a stanza waiting for the bitcoin
+   controller or the database holds all the others. With a Runtime, the loop
+   only reads stanzas and hands them to a pool of worker threads, which run
+   the component's usual handlers.
+   Stanzas from a given user are always handled by the same worker, in the
+   order they were received. Disco queries aren't deferred: they're answered
+   by xmpppy's Browser, which comes after the component's handlers.'''
+
+from logging import debug, exception, warning
+from Queue import Queue, Full
+from threading import Thread, RLock
+from xmpp.protocol import NodeProcessed, Error, ERR_FEATURE_NOT_IMPLEMENTED, \
+                          ERR_RESOURCE_CONSTRAINT, NS_DISCO_INFO, NS_DISCO_ITEMS
+from zlib import crc32
+
+WORKERS = 8
+'''Number of worker threads'''
+
+QUEUE_SIZE = 200
+'''Number of stanzas waiting for each worker, above which the reading loop
+   waits for the worker, which slows down reading'''
+
+PUT_TIMEOUT = 5
+'''How long (in seconds) the reading loop waits for a busy worker before
+   refusing the stanza'''
+
+class Runtime(object):
+    '''A pool of worker threads running the handlers of a component. Set
+       the component's `runtime` attribute before calling its start() method
+       to use it.'''
+
+    def __init__(self, workers=WORKERS, queueSize=QUEUE_SIZE, putTimeout=PUT_TIMEOUT):
+        self.queues = [Queue(queueSize) for i in range(workers)]
+        self.putTimeout = putTimeout
+        self.threads = []
+        self.sendLock = RLock()
+
+    def start(self, component):
+        '''Start the workers. From now on, the component's send() method may
+           be called from any thread.'''
+        send = component.send
+        def lockedSend(stanza):
+            self.sendLock.acquire()
+            try:
+                return send(stanza)
+            finally:
+                self.sendLock.release()
+        component.send = lockedSend
+        for queue in self.queues:
+            thread = Thread(target=self.work, args=(queue,), name='bitcoim-worker')
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+        debug("Started %s workers" % len(self.threads))
+
+    def stop(self):
+        '''Let the workers handle the stanzas they already received, then
+           stop them.'''
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def defer(self, handler):
+        '''Return a handler, to be registered to the dispatcher instead of
+           `handler`, that has the stanza handled by a worker. If the worker is
+           busy for too long, the stanza is refused with a
+           "resource-constraint" error, rather than handled out of order.'''
+        def deferred(cnx, stanza):
+            if ('iq' == stanza.getName()) and \
+               (stanza.getQueryNS() in [NS_DISCO_INFO, NS_DISCO_ITEMS]):
+                return
+            jid = stanza.getFrom()
+            if jid is None:
+                key = 0
+            else:
+                key = crc32(jid.getStripped().encode('utf-8'))
+            queue = self.queues[key % len(self.queues)]
+            try:
+                queue.put((handler, cnx, stanza), True, self.putTimeout)
+            except Full:
+                warning("Workers are busy, refusing a %s stanza from %s" % (stanza.getName(), jid))
+                if stanza.getName() in ['iq', 'message'] and \
+                   stanza.getType() not in ['error', 'result']:
+                    cnx.send(Error(stanza, ERR_RESOURCE_CONSTRAINT))
+            raise NodeProcessed
+        return deferred
+
+    def work(self, queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            self.handle(*item)
+
+    def handle(self, handler, cnx, stanza):
+        '''Run a handler. Like the dispatcher's default handler does, reply
+           to IQ requests with an error if the handler didn't process them.'''
+        try:
+            handler(cnx, stanza)
+            if ('iq' == stanza.getName()) and (stanza.getType() in ['get', 'set']):
+                cnx.send(Error(stanza, ERR_FEATURE_NOT_IMPLEMENTED))
+        except NodeProcessed:
+            pass
+        except Exception:
+            exception("Error while handling stanza %s" % stanza)
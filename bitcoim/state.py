@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Snapshots of the component's state, for warm restarts. The online users,
+   their resources and the last presences they were sent are saved to a
+   file, so that after a restart, the component only has to deal with the
+   users that were online instead of probing every registered user.'''
+
+from jid import JID
+from json import dump, load
+from logging import debug, info, warning
+from os import rename
+from time import time
+from xmpp.protocol import Presence
+
+SAVE_INTERVAL = 60
+'''How often (in seconds) the state is saved while the component runs'''
+
+MAX_AGE = 600
+'''A snapshot older than this (in seconds) is ignored: too many users may
+   have logged in meanwhile'''
+
+USER_MAX_AGE = 3600
+'''Users from whom nothing was received for this long (in seconds) before the
+   snapshot was taken are probed instead of being trusted'''
+
+def save(component):
+    '''Save the state of the component to its statePath. The file is
+       replaced atomically.'''
+    presences = {}
+    users = {}
+    now = time()
+    component.context.lock.acquire()
+    try:
+        for ((frm, to), (fingerprint, status)) in component.sentPresences.items():
+            presences.setdefault(to, {})[frm] = status
+        for user in component.connectedUsers:
+            users[user.jid] = {'resources': list(user.resources),
+                               'seen': component.lastSeen.get(user.jid, now),
+                               'presences': presences.get(user.jid, {})}
+    finally:
+        component.context.lock.release()
+    tmp = component.statePath + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        dump({'time': now, 'users': users}, f)
+    finally:
+        f.close()
+    rename(tmp, component.statePath)
+    debug("Saved the state of %s online users" % len(users))
+
+def restore(component):
+    '''Restore the state of the component from its statePath. Users seen
+       recently are considered online again, and are sent the presences they
+       had before, others are probed. Return False if there was no usable
+       snapshot, in which case nothing was done.'''
+    from useraccount import UserAccount
+    try:
+        f = open(component.statePath)
+        try:
+            state = load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError), e:
+        warning("Couldn't read the saved state (%s)" % e)
+        return False
+    now = time()
+    if now - state['time'] > MAX_AGE:
+        info("The saved state is too old, ignoring it")
+        return False
+    restored = 0
+    for (jid, entry) in state['users'].iteritems():
+        if not component.isInShard(jid):
+            continue
+        user = UserAccount(JID(jid))
+        if not user.isRegistered():
+            continue
+        if state['time'] - entry['seen'] > USER_MAX_AGE:
+            component.send(Presence(to=jid, frm=component.jid, typ='probe'))
+            continue
+        component.context.lock.acquire()
+        try:
+            for resource in entry['resources']:
+                user.resourceConnects(resource)
+            component.connectedUsers.add(user)
+            component.lastSeen[jid] = entry['seen']
+        finally:
+            component.context.lock.release()
+        for (frm, status) in entry['presences'].iteritems():
+            component.sendPresence(Presence(to=jid, frm=frm, typ='available', \
+                                            show='online', status=status))
+        restored += 1
+    info("Restored the state of %s online users" % restored)
+    return True
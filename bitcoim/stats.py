@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Statistics about the gateway, for admins (see the "stats" command). They
+   are computed in bulk: a few aggregate SQL queries and one listaccounts
+   call (none if the ledger is current), never anything per user. The
+   result is kept for a short while, since admins tend to ask again.'''
+
+from addresspool import POOL_ACCOUNT
+from db import SQL
+import ledger
+from paymentorder import STATE_PENDING, STATE_QUEUED, STATE_SENDING
+from rpc import Controller, WalletUnavailableError
+from time import time
+
+CACHE_DURATION = 60
+'''How long (in seconds) the statistics are kept before being computed again'''
+
+TOP_ACCOUNTS = 5
+'''Number of accounts with the largest balance listed'''
+
+_cache = None
+
+def compute():
+    '''Return the statistics that depend on the database and the wallet, as
+       a dictionary. If the wallet is unavailable, 'accounts' is None.'''
+    result = {}
+    SQL().execute('select count(*) from registrations')
+    result['registered'] = SQL().fetchone()[0]
+    req = 'select count(*), coalesce(sum(%s), 0), coalesce(sum(%s), 0) from %s where %s=?' % \
+          ('amount', 'fee', 'payments', 'state')
+    SQL().execute(req, (STATE_PENDING,))
+    (result['pending'], result['pending_amount'], result['pending_fees']) = SQL().fetchone()
+    # Sent and failed payment orders only wait for their receipt.
+    SQL().execute('select count(*) from %s where %s in (?, ?)' % ('payments', 'state'), \
+                  (STATE_QUEUED, STATE_SENDING))
+    result['sending'] = SQL().fetchone()[0]
+    SQL().execute('select registered_jid from registrations')
+    members = set([row[0] for row in SQL().fetchall()])
+    try:
+        if ledger.current() is not None:
+            balances = ledger.current().balances()
+        else:
+            balances = Controller().listaccounts()
+    except WalletUnavailableError:
+        result['accounts'] = None
+        return result
+    balances.pop(POOL_ACCOUNT, None)
+    result['accounts'] = len(balances)
+    result['total'] = sum(balances.itervalues())
+    result['users_total'] = sum([balance for (account, balance) in balances.iteritems() \
+                                 if account in members])
+    result['gateway'] = balances.get('', 0)
+    result['top'] = sorted(balances.items(), key=lambda b: -b[1])[:TOP_ACCOUNTS]
+    return result
+
+def gather(component, maxAge=CACHE_DURATION):
+    '''Return the statistics of the gateway as a dictionary, along with
+       their age in seconds. The online users are counted live, the rest
+       comes from compute(), unless it was computed less than `maxAge`
+       seconds ago.'''
+    global _cache
+    now = time()
+    if (_cache is None) or (now - _cache[0] > maxAge):
+        _cache = (now, compute())
+    result = dict(_cache[1])
+    component.context.lock.acquire()
+    try:
+        result['online'] = len(component.connectedUsers)
+        result['resources'] = sum([len(user.resources) for user in component.connectedUsers])
+    finally:
+        component.context.lock.release()
+    return (result, now - _cache[0])
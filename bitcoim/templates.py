@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vi: sts=4 et sw=4
+
+'''Prebuilt replies. Many replies (software version, vCard of the gateway,
+   service discovery information...) are always the same, except for their
+   "to", "from" and "id" attributes, and sometimes a few values. They are
+   built and serialized once per language, and only those attributes and
+   values are filled in when the reply is sent.'''
+
+from i18n import fallbackLangs
+from xmpp.protocol import Iq, NS_DISCO_INFO
+from xmpp.simplexml import Node, XMLescape
+
+# Placeholders are delimited by characters from a private use area, which
+# can't appear in our messages.
+PLACEHOLDER = u'\ue000%s\ue001'
+TO = PLACEHOLDER % 'to'
+FROM = PLACEHOLDER % 'from'
+ID = PLACEHOLDER % 'id'
+
+def field(name):
+    '''Return the placeholder for the value called `name` in a template.'''
+    return PLACEHOLDER % ('field:' + name)
+
+class Template(object):
+    '''A serialized stanza with placeholders.'''
+
+    def __init__(self, stanza, namespace):
+        '''Serialize the stanza, as the dispatcher would do for a stream
+           whose namespace is `namespace`.'''
+        stanza.setAttr('to', TO)
+        stanza.setAttr('from', FROM)
+        stanza.setAttr('id', ID)
+        stanza.setNamespace(namespace)
+        stanza.setParent(Node(namespace + ' stream'))
+        self.xml = unicode(stanza)
+
+    def render(self, to, frm, id, **fields):
+        '''Return the stanza, with its attributes and values filled in.'''
+        xml = self.xml.replace(TO, XMLescape(unicode(to)))
+        xml = xml.replace(FROM, XMLescape(unicode(frm)))
+        xml = xml.replace(ID, XMLescape(unicode(id or '')))
+        for (name, value) in fields.iteritems():
+            xml = xml.replace(field(name), XMLescape(unicode(value)))
+        return xml
+
+
+class TemplateCache(object):
+    '''The templates of a component, per language.'''
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.templates = {}
+        self.hits = 0
+        self.misses = 0
+
+    def reply(self, name, request, builder, **fields):
+        '''Return the serialized reply to the `request` stanza, made from
+           the template called `name`. The first time (for the current
+           language), the template is made from the stanza returned by
+           builder(), in which the values given by `fields` are represented
+           by their placeholder (see field()).'''
+        key = (name, tuple(fallbackLangs))
+        try:
+            template = self.templates[key]
+            self.hits += 1
+        except KeyError:
+            template = self.templates[key] = Template(builder(), self.namespace)
+            self.misses += 1
+        return template.render(request.getFrom(), request.getTo(), request.getID(), **fields)
+
+
+def discoInfo(node, info, fields={}):
+    '''Build a disco#info result from what discoReceived() returned, like
+       xmpp.browser does, with the given values replaced by placeholders.'''
+    values = dict([(value, field(name)) for (name, value) in fields.iteritems()])
+    reply = Iq(typ='result', queryNS=NS_DISCO_INFO)
+    query = reply.getTag('query')
+    if node is not None:
+        query.setAttr('node', node)
+    for identity in info['ids']:
+        identity = dict(identity)
+        if 'name' in identity:
+            identity['name'] = values.get(identity['name'], identity['name'])
+        query.addChild('identity', identity)
+    for feature in info['features']:
+        query.addChild('feature', {'var': feature})
+    return reply
@@ -3,12 +3,16 @@
 
 from address import Address
 from addressable import Addressable
-from bitcoin.controller import Controller
+import addresspool
 from bitcoin.transaction import Transaction
+from context import current
 from db import SQL
 from i18n import _, DISCO, ROSTER
 from jid import JID
+import ledger
 from logging import debug, info, error, warning
+from paymentorder import STATE_PENDING
+from rpc import Controller, WalletUnavailableError
 from xmpp.jep0106 import JIDEncode, JIDDecode
 from xmpp.protocol import Presence, NodeProcessed, NS_VCARD, NS_VERSION, \
                           NS_DISCO_INFO, NS_DISCO_ITEMS, JID as XJID
@@ -16,16 +20,32 @@ from xmpp.protocol import Presence, NodeProcessed, NS_VCARD, NS_VERSION, \
 FIELD_ID = 'id'
 FIELD_JID = 'registered_jid'
 FIELD_USERNAME = 'username'
+FIELD_USERNAME_LOWER = 'username_lower'
 TABLE_REG = 'registrations'
 
+SEARCH_LIMIT = 50
+'''Maximum number of users returned by a search'''
+
+class _CacheAccess(type):
+    '''Metaclass of UserAccount, for compatibility: the caches used to be
+       class attributes, they're now those of the current context.'''
+
+    cacheByJID = property(lambda cls: current().cacheByJID)
+    cacheByUsername = property(lambda cls: current().cacheByUsername)
+
+
 class UserAccount(Addressable):
     '''Represents a user that's registered on the gateway.
        This class has a unique field: jid, which is the string
        representation of the user's bare JID.
+       UserAccount.cacheByJID and UserAccount.cacheByUsername are the
+       caches of the current context (see context.py).
     '''
 
-    cacheByJID = {}
-    cacheByUsername = {}
+    __metaclass__ = _CacheAccess
+
+    cacheByJID = property(lambda self: current().cacheByJID)
+    cacheByUsername = property(lambda self: current().cacheByUsername)
 
     def __new__(cls, name):
         '''Create the UserAccount instance, based on their JID.
@@ -33,13 +53,28 @@ class UserAccount(Addressable):
            is looked up as subscriber JID. If the name is a string, then it is
            looked up as a username. Raise an UnknownUserError exception if the
            username is not found.
+           Instances are cached by the current context, i.e. each component
+           has its own instances.
         '''
+        context = current()
+        context.lock.acquire()
+        try:
+            return cls._lookup(context, name)
+        finally:
+            context.lock.release()
+
+    @classmethod
+    def _lookup(cls, context, name):
+        cacheByJID = context.cacheByJID
+        cacheByUsername = context.cacheByUsername
         if isinstance(name, XJID):
             username = None
             jid = name.getStripped()
         else:
-            if name in cls.cacheByUsername:
-                return cls.cacheByUsername[name]
+            if name in cacheByUsername:
+                context.hits += 1
+                return cacheByUsername[name]
+            context.misses += 1
             req = "select %s from %s where %s=?" % (FIELD_JID, TABLE_REG, FIELD_USERNAME)
             SQL().execute(req, (name,))
             res = SQL().fetchone()
@@ -48,16 +83,22 @@ class UserAccount(Addressable):
             else:
                 username = name
                 jid = res[0]
-        if jid not in cls.cacheByJID:
-            cls.cacheByJID[jid] = object.__new__(cls)
-            cls.cacheByJID[jid].jid = jid
-            cls.cacheByJID[jid].resources = set()
-            cls.cacheByJID[jid]._lastBalance = 0
-            cls.cacheByJID[jid]._isAdmin = False
+        if jid not in cacheByJID:
             if username is None:
-                username = cls.cacheByJID[jid]._updateUsername()
-            cls.cacheByUsername[username] = cls.cacheByJID[jid]
-        return cls.cacheByJID[jid]
+                context.misses += 1
+            cacheByJID[jid] = object.__new__(cls)
+            cacheByJID[jid].jid = jid
+            cacheByJID[jid].resources = set()
+            cacheByJID[jid]._lastBalance = 0
+            cacheByJID[jid]._isAdmin = False
+            cacheByJID[jid]._historyCache = None
+            cacheByJID[jid]._known = {}
+            if username is None:
+                username = cacheByJID[jid]._updateUsername()
+            cacheByUsername[username] = cacheByJID[jid]
+        elif username is None:
+            context.hits += 1
+        return cacheByJID[jid]
 
     def __str__(self):
         '''The textual representation of a UserAccount is the bare JID.'''
@@ -70,8 +111,9 @@ class UserAccount(Addressable):
         if 'username' == name:
             username = value.strip()
             if self.canUseUsername(username):
-                req = "update %s set %s=? where %s=?" % (TABLE_REG, FIELD_USERNAME, FIELD_JID)
-                SQL().execute(req, (username, self.jid))
+                req = "update %s set %s=?, %s=? where %s=?" % \
+                      (TABLE_REG, FIELD_USERNAME, FIELD_USERNAME_LOWER, FIELD_JID)
+                SQL().execute(req, (username, username.lower(), self.jid))
                 object.__setattr__(self, 'username', username)
             else:
                 raise UsernameNotAvailableError
@@ -107,6 +149,32 @@ class UserAccount(Addressable):
         result = SQL().fetchall()
         return [result[i][0] for i in range(len(result))]
 
+    @staticmethod
+    def getUsernames(jids):
+        '''Return a dictionary giving the username of each of the given JIDs,
+           with a single request. Unregistered JIDs are left out.'''
+        jids = list(jids)
+        if 0 == len(jids):
+            return {}
+        req = "select %s, %s from %s where %s in (%s)" % \
+              (FIELD_JID, FIELD_USERNAME, TABLE_REG, FIELD_JID, ', '.join(['?'] * len(jids)))
+        SQL().execute(req, tuple(jids))
+        return dict([(row[0], row[1]) for row in SQL().fetchall()])
+
+    @staticmethod
+    def search(prefix, limit=SEARCH_LIMIT):
+        '''Return the usernames starting with the given prefix, regardless of
+           case, sorted. At most `limit` usernames are returned. The search is
+           a range scan of the index on the lowercase usernames.'''
+        prefix = prefix.strip().lower()
+        if 0 == len(prefix):
+            return []
+        req = "select %s from %s where %s>=? and %s<? order by %s limit ?" % \
+              (FIELD_USERNAME, TABLE_REG, FIELD_USERNAME_LOWER, FIELD_USERNAME_LOWER, \
+               FIELD_USERNAME_LOWER)
+        SQL().execute(req, (prefix, prefix + u'\uffff', limit))
+        return [row[0] for row in SQL().fetchall()]
+
     def canUseUsername(self, username):
         '''Is that username available to this user? For the moment, everything
            is valid except:
@@ -140,8 +208,9 @@ class UserAccount(Addressable):
         if self.isRegistered():
             raise AlreadyRegisteredError
         info("Inserting entry for user %s into database" % self.jid)
-        req = "insert into %s (%s, %s) values (?, ?)" % (TABLE_REG, FIELD_JID, FIELD_USERNAME)
-        SQL().execute(req, (self.jid,self.username))
+        req = "insert into %s (%s, %s, %s) values (?, ?, ?)" % \
+              (TABLE_REG, FIELD_JID, FIELD_USERNAME, FIELD_USERNAME_LOWER)
+        SQL().execute(req, (self.jid, self.username, self.username.lower()))
 
     def unregister(self):
         '''Remove given JID from subscribers if it exists. Raise exception otherwise.'''
@@ -167,16 +236,61 @@ class UserAccount(Addressable):
         except KeyError:
             pass # An "unavailable" presence is sent twice. Ignore.
 
+    def _lastKnown(self, key, fetch, default=None):
+        '''Return fetch(), a call to the controller, and remember its result
+           under `key`. If the wallet is unavailable, return the last known
+           result instead, or `default` if there's none (if the default is
+           None, WalletUnavailableError is raised).'''
+        try:
+            self._known[key] = fetch()
+        except WalletUnavailableError:
+            if key in self._known:
+                debug("Wallet unavailable, using the last known %s of %s" % (key, self))
+            elif default is not None:
+                return default
+            else:
+                raise
+        return self._known[key]
+
     def getAddresses(self):
-        '''Return the set of all addresses the user has control over'''
-        return Controller().getaddressesbyaccount(self.jid)
+        '''Return the set of all addresses the user has control over. If the
+           wallet is unavailable, return the last known ones.'''
+        if ledger.current() is not None:
+            return ledger.current().addresses(self.jid)
+        return self._lastKnown('addresses', lambda: Controller().getaddressesbyaccount(self.jid), [])
 
     def getTotalReceived(self):
         '''Returns the total amount received on all addresses the user has control over.'''
-        total =  Controller().getreceivedbyaccount(self.jid)
+        if ledger.current() is not None:
+            total = sum(self.getReceivedByAddress().values())
+        else:
+            total = Controller().getreceivedbyaccount(self.jid)
         debug("User %s has received a total of BTC %s" % (self.jid, total))
         return total
 
+    def getReceivedByAddress(self, received=None):
+        '''Return the amount received on each address the user has control
+           over, as a dictionary {address: amount}. Addresses that didn't
+           receive anything are included. `received` is the result of
+           getAllReceived(), if it's already known. If the wallet is
+           unavailable, return the last known amounts.'''
+        if received is None:
+            return self._lastKnown('received', lambda: UserAccount.getAllReceived().get(self.jid, {}), {})
+        self._known['received'] = received.get(self.jid, {})
+        return self._known['received']
+
+    @staticmethod
+    def getAllReceived():
+        '''Return the amount received on each address of the wallet, with a
+           single call to the controller (or from the ledger), as a
+           dictionary {account: {address: amount}}.'''
+        if ledger.current() is not None:
+            return ledger.current().received()
+        received = {}
+        for entry in Controller().listreceivedbyaddress(1, True):
+            received.setdefault(entry['account'], {})[entry['address']] = entry['amount']
+        return received
+
     def getRoster(self):
         '''Return the set of all the address JIDs the user has in her/his roster.
            This is different from the addresses the user has control over:
@@ -193,9 +307,17 @@ class UserAccount(Addressable):
             roster.add(Address(addr).jid)
         return roster
 
-    def getBalance(self):
-        '''Return the user's current balance'''
-        return Controller().getbalance(self.jid)
+    def getBalance(self, cached=False):
+        '''Return the user's current balance. If cached is True and the
+           wallet is unavailable, return the last known balance instead. This
+           is only suitable for information purposes, not for payments: the
+           balance then comes from the ledger, if there's one.'''
+        if cached and (ledger.current() is not None):
+            return ledger.current().balance(self.jid)
+        if cached:
+            return self._lastKnown('balance', lambda: Controller().getbalance(self.jid))
+        self._known['balance'] = Controller().getbalance(self.jid)
+        return self._known['balance']
 
     def checkBalance(self):
         '''Return the user's current balance if it has changed since last
@@ -210,10 +332,22 @@ class UserAccount(Addressable):
             return newBalance
 
     def createAddress(self):
-        '''Create a new bitcoin address, associate it with the user, and return it'''
-        address = Address()
-        info("Just created address %s. Associating it to user %s" % (address, self.jid))
-        Controller().setaccount(address.address, self.jid)
+        '''Create a new bitcoin address, associate it with the user, and return it.
+           If there's an address pool, the address is taken from it.'''
+        pool = addresspool.current()
+        if pool is not None:
+            address = pool.take(self.jid)
+        else:
+            address = None
+        if address is not None:
+            address = Address.assigned(address)
+            info("Assigned address %s from the pool to user %s" % (address, self.jid))
+        else:
+            address = Address()
+            info("Just created address %s. Associating it to user %s" % (address, self.jid))
+            Controller().setaccount(address.address, self.jid)
+        if ledger.recorder() is not None:
+            ledger.recorder().recordAddress(address.address, self.jid)
         return address
 
     def ownsAddress(self, address):
@@ -230,10 +364,10 @@ class UserAccount(Addressable):
     def pendingPayments(self, target=None):
         '''List all pending payments of the user. If a valid target is given,
            only list pending payments to that target.'''
-        req = "select %s, %s, %s, %s, %s from %s where %s=?" % \
+        req = "select %s, %s, %s, %s, %s, %s from %s where %s=? and %s=?" % \
               ('date', 'recipient', 'amount', 'comment', 'confirmation_code', \
-               'payments', 'from_jid')
-        values = [self.jid]
+               'items', 'payments', 'from_jid', 'state')
+        values = [self.jid, STATE_PENDING]
         if isinstance(target, UserAccount):
             req += " and %s=?" % ('recipient')
             values.append(target.username)
@@ -243,18 +377,43 @@ class UserAccount(Addressable):
         SQL().execute(req, tuple(values))
         return SQL().fetchall()
 
-    def pastPayments(self, count=None):
-        '''List all past payments (known to the wallet) for this account.'''
-        if count is None:
+    def pastPayments(self, count=None, start=0, counterpart=None):
+        '''List all past payments (known to the wallet) for this account. If
+           count is given, only list the `count` most recent ones, skipping
+           the `start` most recent ones. If counterpart (a UserAccount or an
+           Address) is given, only list the payments with it. With a ledger,
+           they are selected by the database before counting; otherwise,
+           the page is filtered afterwards.'''
+        otheraccount = address = None
+        if isinstance(counterpart, UserAccount):
+            otheraccount = counterpart.jid
+        elif isinstance(counterpart, Address):
+            address = counterpart.address
+        if ledger.current() is not None:
+            items = ledger.current().transactions(self.jid, count, start, otheraccount, address)
+        elif count is None:
             items = Controller().listtransactions(self.jid)
         else:
-            items = Controller().listtransactions(self.jid, count)
+            items = Controller().listtransactions(self.jid, count, start)
         payments = []
         for item in items:
             debug("Listtransactions says %s" % item)
-            if 'txid' in item:
-                payment = Transaction(item['txid'])
-                payment.read()
+            if (otheraccount is not None) and (item.get('otheraccount') != otheraccount):
+                continue
+            if (address is not None) and (item.get('address') != address):
+                continue
+            if ledger.current() is not None:
+                payment = Transaction(amount=item['amount'], \
+                                      message=item['comment'], \
+                                      fee=item['fee'], \
+                                      otheraccount=item['otheraccount'])
+                payment.confirmations = item['confirmations']
+            elif 'txid' in item:
+                payment = Transaction(amount=item['amount'], \
+                                      message=item.get('comment'), \
+                                      fee=item.get('fee', 0), \
+                                      otheraccount=item.get('otheraccount'))
+                payment.confirmations = item['confirmations']
             else:
                 payment = Transaction(amount=item['amount'], \
                                       message=item.get('message'), \
@@ -264,6 +423,29 @@ class UserAccount(Addressable):
             payments.append(payment)
         return payments
 
+    def lastTransaction(self):
+        '''Return something identifying the most recent transaction of the
+           account, or None if there's none. It changes as soon as a new
+           transaction is known to the wallet.'''
+        if ledger.current() is not None:
+            return ledger.current().lastTransaction(self.jid)
+        items = Controller().listtransactions(self.jid, 1)
+        if 0 == len(items):
+            return None
+        item = items[-1]
+        return (item.get('txid'), item.get('time'), item['category'], item['amount'])
+
+    def cachedHistory(self, key, marker):
+        '''Return the history reply cached for `key` if no transaction
+           happened since (according to `marker`), None otherwise.'''
+        if (self._historyCache is not None) and (self._historyCache[:2] == (key, marker)):
+            return self._historyCache[2]
+        return None
+
+    def cacheHistory(self, key, marker, reply):
+        '''Remember the last history reply. Only one is kept per user.'''
+        self._historyCache = (key, marker, reply)
+
     def discoReceived(self, fromUser, what, node):
         if (fromUser == self) or (fromUser.isAdmin()):
             if fromUser == self:
@@ -287,6 +469,13 @@ class UserAccount(Addressable):
                         items.append({'jid': Address(address).jid, 'name': address})
                 return items
 
+    def discoTemplate(self, fromUser, what, node):
+        if ('info' == what) and ((fromUser == self) or (fromUser.isAdmin())):
+            if node is None:
+                return (('disco-account', node), {'name': self.username})
+            elif 'addresses' == node:
+                return (('disco-account', node, fromUser == self), {})
+
     def iqReceived(self, cnx, iq):
         queries = iq.getChildren() # there should be only one
         if 0 == len(queries):
@@ -322,24 +511,29 @@ class UserAccount(Addressable):
         typ = prs.getType()
         if typ == 'subscribe':
             cnx.send(Presence(typ='subscribed', frm=to, to=fromUser.jid))
-            self.sendBitcoinPresence(cnx, fromUser, isUsername)
+            self.sendBitcoinPresence(cnx, fromUser, isUsername, force=True)
         elif typ == 'unsubscribe':
             cnx.send(Presence(typ='unsubscribed', frm=to, to=fromUser.jid))
         elif typ == 'probe':
-            self.sendBitcoinPresence(cnx, fromUser, isUsername)
+            self.sendBitcoinPresence(cnx, fromUser, isUsername, force=True)
         raise NodeProcessed
 
-    def sendBitcoinPresence(self, cnx, user, fromUsername=True):
+    def sendBitcoinPresence(self, cnx, user, fromUsername=True, force=False):
         '''Send a presence information to 'user', from us.
            If fromUsername is True, use username@gateway.tld as a "from" field.
            If fromUsername is False and the recipient is an admin, use the
            "hosted" form of their real JID.
            Otherwise, don't send anything.
+           Unless force is True, the presence is not sent if it's the same as
+           the last one.
            Return True if anything was sent, False otherwise.'''
         if not user.isRegistered():
             return
         if (user == self) or (user.isAdmin()):
-            status = _(ROSTER, 'current_balance').format(amount=self.getBalance())
+            try:
+                status = _(ROSTER, 'current_balance').format(amount=self.getBalance(cached=True))
+            except WalletUnavailableError:
+                status = _(ROSTER, 'wallet_unavailable')
         else:
             status = None
         if fromUsername:
@@ -350,8 +544,8 @@ class UserAccount(Addressable):
             warning("Possible programming error: Trying to send %s's bitcoin presence. As a username? %s. To an admin? %s" \
                     % (self, fromUsername, user.isAdmin()))
             return False
-        cnx.send(Presence(to=user.jid, typ='available', show='online', \
-                          status=status, frm=JID(node=JIDEncode(node))))
+        cnx.sendPresence(Presence(to=user.jid, typ='available', show='online', \
+                                  status=status, frm=JID(node=JIDEncode(node))), force)
         return True
 
 